@@ -6,15 +6,33 @@
 #If it's easier for the user to simply edit the variable, then the code can be easily adjusted. 
 
 import os
+import time
+import shutil
+import hashlib
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from Bio import Entrez
 import requests
+from instrumentation import metrics
+
+SRA_URL_TEMPLATE = "https://sra-download.ncbi.nlm.nih.gov/traces/sra/sra-instant/reads/ByRun/sra/SRR/{prefix}/{sra_id}/{sra_id}.sra"
 
 class MAPseqDataDownloader:
-    def __init__(self, email, num_files_to_download):
+    def __init__(self, email, num_files_to_download, max_workers=4, chunk_size=4 * 1024 * 1024, max_retries=5,
+                 url_template=SRA_URL_TEMPLATE, checksums=None, converter_command=("fastq-dump",), max_conversions=2,
+                 compress_fastq=False):
         self.email = email
         self.num_files_to_download = num_files_to_download
         self.accession_ids = []
+        self.max_workers = max_workers  # Number of concurrent downloads
+        self.chunk_size = chunk_size  # Bytes read from the network per write
+        self.max_retries = max_retries  # Attempts per file; each retry resumes from the partial file
+        self.url_template = url_template
+        self.checksums = checksums or {}  # Optional mapping of accession to expected MD5 hex digest
+        self.converter_command = list(converter_command)  # Converter writing fastq to stdout when given "-Z"
+        self.max_conversions = max_conversions  # Number of concurrent converter processes
+        self.compress_fastq = compress_fastq  # Write .fastq.gz instead of .fastq files
     
     # Search for MAPseq data in the SRA database
     def search_mapseq_data(self):
@@ -26,24 +44,169 @@ class MAPseqDataDownloader:
 
         self.accession_ids = search_results["IdList"]
 
-    # Download SRA files from the NCBI server
+    def sra_url(self, sra_id):
+        return self.url_template.format(prefix=sra_id[:6], sra_id=sra_id)
+
+    # Create an HTTP session whose connection pool is shared by all download threads
+    def create_session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    # Return the size of the remote file, or None if the server does not report it
+    def remote_size(self, session, url):
+        try:
+            response = session.head(url, allow_redirects=True, timeout=60)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200 or "Content-Length" not in response.headers:
+            return None
+        return int(response.headers["Content-Length"])
+
+    # Check the size and, if known, the MD5 checksum of a downloaded file
+    def verify_download(self, sra_id, file_path, expected_size):
+        if expected_size is not None and os.path.getsize(file_path) != expected_size:
+            return False
+        if sra_id in self.checksums:
+            md5 = hashlib.md5()
+            with open(file_path, "rb") as file:
+                for chunk in iter(lambda: file.read(self.chunk_size), b""):
+                    md5.update(chunk)
+            return md5.hexdigest() == self.checksums[sra_id].lower()
+        return True
+
+    # Download one SRA file and record the download metrics
+    def download_sra_file(self, sra_id, output_dir, session):
+        try:
+            with metrics.timer("download"):
+                output_file = self.fetch_sra_file(sra_id, output_dir, session)
+        except (requests.RequestException, IOError):
+            metrics.count("download.failures")
+            raise
+        metrics.count("download.files")
+        return output_file
+
+    # Download one SRA file, resuming from a partial .part file with an HTTP Range request
+    def fetch_sra_file(self, sra_id, output_dir, session):
+        url = self.sra_url(sra_id)
+        output_file = os.path.join(output_dir, f"{sra_id}.sra")
+        part_file = output_file + ".part"
+
+        expected_size = self.remote_size(session, url)
+        if os.path.exists(output_file) and self.verify_download(sra_id, output_file, expected_size):
+            return output_file  # Already complete
+
+        for attempt in range(self.max_retries):
+            try:
+                offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+                if expected_size is not None and offset >= expected_size:
+                    offset = expected_size  # Nothing left to fetch; verify below
+                else:
+                    headers = {"Range": f"bytes={offset}-"} if offset else {}
+                    with session.get(url, headers=headers, stream=True, timeout=60) as response:
+                        if response.status_code == 200:
+                            offset = 0  # The server ignored the Range header; start over
+                        elif response.status_code == 416:
+                            response = None  # The partial file already holds every byte; verify below
+                        elif response.status_code != 206:
+                            response.raise_for_status()
+                            raise IOError(f"Unexpected HTTP status {response.status_code} for {url}")
+                        if response is not None:
+                            with open(part_file, "ab" if offset else "wb") as file:
+                                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                                    file.write(chunk)
+                                    metrics.count("download.bytes", len(chunk))
+
+                if self.verify_download(sra_id, part_file, expected_size):
+                    os.replace(part_file, output_file)
+                    return output_file
+                if expected_size is None or os.path.getsize(part_file) >= expected_size:
+                    os.remove(part_file)  # Complete but corrupt; download again from scratch
+                raise IOError(f"Incomplete or corrupt download of {sra_id}")
+            except (requests.RequestException, IOError) as error:
+                if isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code < 500:
+                    raise  # Client errors (e.g. 404) will not go away on retry
+                if attempt == self.max_retries - 1:
+                    raise
+                metrics.count("download.retries")
+                time.sleep(min(2 ** attempt, 30))
+
+    # Download SRA files from the NCBI server, several at a time
     def download_sra_files(self, output_dir):
-        for sra_id in self.accession_ids:
-            url = f"https://sra-download.ncbi.nlm.nih.gov/traces/sra/sra-instant/reads/ByRun/sra/SRR/{sra_id[:6]}/{sra_id}/{sra_id}.sra"
-            response = requests.get(url, stream=True)
+        downloaded_files = []
+        with self.create_session() as session, ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.download_sra_file, sra_id, output_dir, session): sra_id
+                       for sra_id in self.accession_ids}
+            for future in as_completed(futures):
+                try:
+                    downloaded_files.append(future.result())
+                except (requests.RequestException, IOError) as error:
+                    print(f"Failed to download {futures[future]}: {error}")
+        return downloaded_files
+
+    # Build the converter command line that writes the fastq records of an SRA file to stdout
+    def converter_args(self, sra_path, compress=False):
+        return self.converter_command + [sra_path, "-Z"] + (["--gzip"] if compress else [])
+
+    # Convert one SRA file to fastq format using fastq-dump from the SRA Toolkit, and return the fastq path
+    def convert_sra_file(self, sra_path, output_dir):
+        fastq_path = os.path.join(output_dir, os.path.splitext(os.path.basename(sra_path))[0] + ".fastq")
+        if self.compress_fastq:
+            fastq_path += ".gz"
+        part_file = fastq_path + ".part"
+        with open(part_file, "wb") as fastq_file, metrics.timer("conversion"):
+            result = subprocess.run(self.converter_args(sra_path, self.compress_fastq), stdout=fastq_file,
+                                    stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            os.remove(part_file)
+            metrics.count("conversion.failures")
+            raise subprocess.CalledProcessError(result.returncode, result.args, stderr=result.stderr)
+        os.replace(part_file, fastq_path)
+        metrics.count("conversion.files")
+        metrics.count("conversion.bytes", os.path.getsize(fastq_path))
+        return fastq_path
 
-            if response.status_code == 200:
-                output_file = os.path.join(output_dir, f"{sra_id}.sra")
-                with open(output_file, "wb") as file:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        file.write(chunk)
+    # Count the barcodes of one SRA file straight from the converter's stdout, without writing a fastq file
+    def stream_sra_file(self, sra_path, barcode_extractor):
+        file_name = os.path.splitext(os.path.basename(sra_path))[0] + ".fastq"
+        work_directory = tempfile.mkdtemp(prefix="sra_stream_", dir=barcode_extractor.output_directory)
+        try:
+            count_file = os.path.join(work_directory, "counts.tsv")
+            with metrics.timer("conversion"), \
+                    subprocess.Popen(self.converter_args(sra_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
+                # Drain stderr on a thread so that a chatty converter cannot block on a full pipe
+                stderr_reader = ThreadPoolExecutor(max_workers=1)
+                stderr = stderr_reader.submit(process.stderr.read)
+                try:
+                    barcode_extractor.count_barcodes_from_stream(process.stdout, count_file)
+                except Exception:
+                    process.kill()
+                    raise
+                finally:
+                    stderr_reader.shutdown()
+                returncode = process.wait()
+            if returncode != 0:
+                metrics.count("conversion.failures")
+                raise subprocess.CalledProcessError(returncode, process.args, stderr=stderr.result())
+            metrics.count("conversion.files")
+            return barcode_extractor.write_sample_counts(file_name, [count_file], work_directory)
+        finally:
+            shutil.rmtree(work_directory, ignore_errors=True)
 
-    # Convert SRA files to fastq format using fastq-dump from the SRA Toolkit
+    # Convert SRA files to fastq format using fastq-dump from the SRA Toolkit, several at a time
     def convert_sra_to_fastq(self, sra_files, output_dir):
-        for sra_file in sra_files:
-            sra_path = os.path.join(output_dir, sra_file)
-            fastq_path = os.path.splitext(sra_path)[0] + ".fastq"
-            subprocess.run(["fastq-dump", sra_path, "-O", output_dir, "--gzip", "-Z", ">", fastq_path])
+        fastq_files = []
+        with ThreadPoolExecutor(max_workers=self.max_conversions) as executor:
+            futures = {executor.submit(self.convert_sra_file, os.path.join(output_dir, sra_file), output_dir): sra_file
+                       for sra_file in sra_files}
+            for future in as_completed(futures):
+                try:
+                    fastq_files.append(future.result())
+                except (subprocess.CalledProcessError, OSError) as error:
+                    print(f"Failed to convert {futures[future]}: {error}")
+        return fastq_files
 
     # Run the entire data downloading and conversion process
     def run(self, output_dir):
@@ -51,10 +214,10 @@ class MAPseqDataDownloader:
             os.makedirs(output_dir)
 
         self.search_mapseq_data()
-        self.download_sra_files(output_dir)
+        downloaded_files = self.download_sra_files(output_dir)
 
-        sra_files = [f"{sra_id}.sra" for sra_id in self.accession_ids]
-        self.convert_sra_to_fastq(sra_files, output_dir)
+        sra_files = [os.path.basename(file_path) for file_path in downloaded_files]
+        return self.convert_sra_to_fastq(sra_files, output_dir)
 
 if __name__ == "__main__":
     # Replace with your actual email address
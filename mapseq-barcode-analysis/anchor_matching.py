@@ -0,0 +1,80 @@
+"""
+THIS SCRIPT LOCATES THE ANCHOR SEQUENCE IN READS WHILE TOLERATING SEQUENCING ERRORS.
+
+An anchor with at most k mismatches must contain at least one of k + 1 non-overlapping anchor segments without
+errors (pigeonhole principle). The segments are precomputed once; for each read, bytes.find locates exact seed hits
+in C, and only the anchor positions implied by those hits are checked for mismatches. Reads with an exact anchor
+never reach the approximate search, so exact-match throughput is unchanged.
+"""
+
+
+class AnchorLocator:
+    """
+    This class finds the position of an anchor sequence in a read with up to max_mismatches substitutions.
+    """
+
+    def __init__(self, anchor_sequence, max_mismatches=0):
+        """
+        Initialize the locator and precompute the seed segments of the anchor.
+
+        :param anchor_sequence: str, the anchor sequence
+        :param max_mismatches: int, maximum number of mismatched bases allowed in the anchor (default: 0)
+        """
+        if not 0 <= max_mismatches < len(anchor_sequence):
+            raise ValueError("max_mismatches must be at least 0 and smaller than the anchor length.")
+        self.anchor = anchor_sequence.encode('ascii')
+        self.max_mismatches = max_mismatches
+
+        # Split the anchor into max_mismatches + 1 seeds: (offset of the seed in the anchor, seed bytes)
+        num_seeds = max_mismatches + 1
+        self.seeds = []
+        start = 0
+        for i in range(num_seeds):
+            end = start + (len(self.anchor) - start) // (num_seeds - i)
+            self.seeds.append((start, self.anchor[start:end]))
+            start = end
+
+    def mismatches(self, sequence, position):
+        """
+        Count the mismatches between the anchor and the read at a given position.
+
+        :param sequence: bytes, read sequence
+        :param position: int, start of the anchor in the read
+        :return: int, number of mismatched bases
+        """
+        return sum(base1 != base2 for base1, base2 in zip(self.anchor, sequence[position:position + len(self.anchor)]))
+
+    def find_approximate(self, sequence):
+        """
+        Find the anchor with up to max_mismatches substitutions, choosing the position with the fewest mismatches
+        (the leftmost one on ties).
+
+        :param sequence: bytes, read sequence
+        :return: int, start of the anchor in the read, or -1 if it is not found
+        """
+        last_position = len(sequence) - len(self.anchor)
+        checked = set()
+        best_position, best_mismatches = -1, self.max_mismatches + 1
+        for seed_offset, seed in self.seeds:
+            hit = sequence.find(seed)
+            while hit >= 0:
+                position = hit - seed_offset
+                if 0 <= position <= last_position and position not in checked:
+                    checked.add(position)
+                    mismatches = self.mismatches(sequence, position)
+                    if mismatches < best_mismatches or (mismatches == best_mismatches and position < best_position):
+                        best_position, best_mismatches = position, mismatches
+                hit = sequence.find(seed, hit + 1)
+        return best_position
+
+    def find(self, sequence):
+        """
+        Find the anchor in a read, trying an exact match first.
+
+        :param sequence: bytes, read sequence
+        :return: int, start of the anchor in the read, or -1 if it is not found
+        """
+        position = sequence.find(self.anchor)
+        if position < 0 and self.max_mismatches:
+            position = self.find_approximate(sequence)
+        return position
@@ -0,0 +1,189 @@
+"""
+THIS SCRIPT PACKS BARCODE SEQUENCES INTO 2-BIT-PER-BASE UNSIGNED 64-BIT INTEGERS AND COMPUTES HAMMING DISTANCES ON WHOLE ARRAYS.
+
+Bases are encoded as A=0, C=1, G=2, T=3 with the first base in the most significant bits, so barcodes of up to
+32 nucleotides fit into one np.uint64 and sorting packed barcodes sorts them alphabetically. The Hamming distance
+between two packed barcodes is the number of 2-bit fields in which they differ, computed with XOR and a popcount.
+"""
+
+import numpy as np
+
+MAX_BARCODE_LENGTH = 32
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# Lookup table from ASCII codes to 2-bit base codes; 255 marks characters that cannot be encoded (e.g. 'N')
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    BASE_CODES[base] = code
+
+_LOW_BITS = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(values):
+    """
+    Count the set bits of each element of an unsigned 64-bit integer array.
+
+    :param values: np.ndarray of uint64
+    :return: np.ndarray of uint8, number of set bits of each element
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    values = values - ((values >> np.uint64(1)) & _LOW_BITS)
+    values = (values & _M2) + ((values >> np.uint64(2)) & _M2)
+    values = (values + (values >> np.uint64(4))) & _M4
+    return ((values * _H01) >> np.uint64(56)).astype(np.uint8)
+
+
+def pack_ascii_matrix(sequences):
+    """
+    Pack a matrix of ASCII-encoded sequences, one sequence per row.
+
+    :param sequences: np.ndarray of uint8 with shape (n, barcode_length), ASCII codes of the bases
+    :return: tuple (np.ndarray of uint64, np.ndarray of bool), packed barcodes and whether each row contained
+             only A, C, G and T (rows with other characters are packed with those characters as A)
+    """
+    sequences = np.asarray(sequences, dtype=np.uint8)
+    if sequences.ndim != 2 or sequences.shape[1] > MAX_BARCODE_LENGTH:
+        raise ValueError(f"Expected a 2-D array of sequences of at most {MAX_BARCODE_LENGTH} bases.")
+    codes = BASE_CODES[sequences]
+    valid = (codes != 255).all(axis=1)
+    codes &= 3
+
+    packed = np.zeros(len(sequences), dtype=np.uint64)
+    for column in range(sequences.shape[1]):
+        packed <<= np.uint64(2)
+        packed |= codes[:, column]
+    return packed, valid
+
+
+def ascii_matrix(barcodes):
+    """
+    Convert a list of equal-length barcode strings into a matrix of ASCII codes.
+
+    :param barcodes: list of str, barcode sequences of the same length
+    :return: np.ndarray of uint8 with shape (n, barcode_length)
+    """
+    barcode_length = len(barcodes[0]) if len(barcodes) else 0
+    if any(len(barcode) != barcode_length for barcode in barcodes):
+        raise ValueError("All barcodes must have the same length to be packed.")
+    joined = ''.join(barcodes).encode('ascii', errors='replace')
+    return np.frombuffer(joined, dtype=np.uint8).reshape(len(barcodes), barcode_length)
+
+
+def encode_barcodes(barcodes):
+    """
+    Pack a list of equal-length barcode strings.
+
+    :param barcodes: list of str, barcode sequences of the same length made of A, C, G and T
+    :return: tuple (np.ndarray of uint64, int), packed barcodes and the barcode length
+    """
+    sequences = ascii_matrix(barcodes)
+    packed, valid = pack_ascii_matrix(sequences)
+    if not valid.all():
+        raise ValueError(f"Barcode {barcodes[int(np.argmin(valid))]} contains characters other than A, C, G and T.")
+    return packed, sequences.shape[1]
+
+
+def pack_barcodes(barcodes, barcode_length):
+    """
+    Pack the barcodes that have the given length and contain only A, C, G and T.
+
+    :param barcodes: list of str, barcode sequences
+    :param barcode_length: int, length of the barcodes to pack
+    :return: tuple (np.ndarray of uint64, np.ndarray of bool), packed barcodes (0 where not packable) and whether
+             each barcode was packed
+    """
+    packable = np.fromiter((len(barcode) == barcode_length for barcode in barcodes), dtype=bool, count=len(barcodes))
+    packed = np.zeros(len(barcodes), dtype=np.uint64)
+    if packable.any() and barcode_length <= MAX_BARCODE_LENGTH:
+        correct_length = np.flatnonzero(packable)
+        packed_correct, valid = pack_ascii_matrix(ascii_matrix([barcodes[i] for i in correct_length]))
+        packed[correct_length] = packed_correct
+        packable[correct_length[~valid]] = False
+    else:
+        packable[:] = False
+    return packed, packable
+
+
+def can_encode(barcodes):
+    """
+    Check whether a list of barcode strings can be packed: equal lengths of at most 32 bases made of A, C, G and T.
+
+    :param barcodes: list of str, barcode sequences
+    :return: bool
+    """
+    try:
+        encode_barcodes(barcodes)
+    except ValueError:
+        return False
+    return True
+
+
+def decode_barcodes(packed, barcode_length):
+    """
+    Unpack packed barcodes into strings.
+
+    :param packed: np.ndarray of uint64, packed barcodes
+    :param barcode_length: int, length of the barcodes
+    :return: list of str, barcode sequences
+    """
+    packed = np.asarray(packed, dtype=np.uint64).reshape(-1)
+    sequences = np.empty((len(packed), barcode_length), dtype=np.uint8)
+    for column in range(barcode_length):
+        shift = np.uint64(2 * (barcode_length - 1 - column))
+        sequences[:, column] = BASES[(packed >> shift) & np.uint64(3)]
+    if barcode_length == 0:
+        return [''] * len(packed)
+    return sequences.view(f'S{barcode_length}').reshape(-1).astype(f'U{barcode_length}').tolist()
+
+
+def segment_keys(packed, barcode_length, start, end):
+    """
+    Extract the bases start:end of packed barcodes as packed integers.
+
+    :param packed: np.ndarray of uint64, packed barcodes
+    :param barcode_length: int, length of the barcodes
+    :param start: int, first base of the segment
+    :param end: int, end (exclusive) of the segment
+    :return: np.ndarray of uint64, packed segment of each barcode
+    """
+    shift = np.uint64(2 * (barcode_length - end))
+    mask = np.uint64((1 << (2 * (end - start))) - 1)
+    return (np.asarray(packed, dtype=np.uint64) >> shift) & mask
+
+
+def hamming_distance(packed1, packed2):
+    """
+    Compute the Hamming distance between packed barcodes, element-wise with NumPy broadcasting.
+    Pass a single barcode and an array for one-vs-many distances.
+
+    :param packed1: np.uint64 or np.ndarray of uint64, packed barcodes
+    :param packed2: np.uint64 or np.ndarray of uint64, packed barcodes
+    :return: np.ndarray of uint8, number of mismatched bases
+    """
+    difference = np.bitwise_xor(np.asarray(packed1, dtype=np.uint64), np.asarray(packed2, dtype=np.uint64))
+    mismatches = (difference | (difference >> np.uint64(1))) & _LOW_BITS
+    return popcount(mismatches)
+
+
+def pairwise_hamming_distances(packed1, packed2, block_size=4096):
+    """
+    Compute the Hamming distance between every barcode of one array and every barcode of another,
+    processing block_size rows at a time to bound the size of temporary arrays.
+
+    :param packed1: np.ndarray of uint64, packed barcodes (rows)
+    :param packed2: np.ndarray of uint64, packed barcodes (columns)
+    :param block_size: int, number of rows per block (default: 4096)
+    :return: np.ndarray of uint8 with shape (len(packed1), len(packed2)), Hamming distances
+    """
+    packed1 = np.asarray(packed1, dtype=np.uint64).reshape(-1)
+    packed2 = np.asarray(packed2, dtype=np.uint64).reshape(-1)
+    distances = np.empty((len(packed1), len(packed2)), dtype=np.uint8)
+    for start in range(0, len(packed1), block_size):
+        block = packed1[start:start + block_size]
+        distances[start:start + len(block)] = hamming_distance(block[:, None], packed2[None, :])
+    return distances
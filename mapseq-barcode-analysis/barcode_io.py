@@ -0,0 +1,388 @@
+"""
+THIS SCRIPT READS, WRITES AND MERGES BARCODE COUNT TABLES ON DISK.
+
+A text count table file holds one "barcode<TAB>count" line per unique barcode, sorted by barcode, so several tables
+can be merged in a single streaming pass with bounded memory.
+
+A binary barcode table stores 2-bit packed barcodes and counts as a .npy array of records (see barcode_encoding.py)
+with a .json metadata file next to it; it can be memory-mapped and read without parsing text.
+
+In memory, the read counts of a whole run are held as PackedBarcodeCounts: arrays of packed barcodes and counts, plus
+a small dictionary of the barcodes that cannot be packed, so that no string is created per unique barcode.
+"""
+
+import heapq
+import json
+import os
+from collections import Counter, namedtuple
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
+from barcode_encoding import ascii_matrix, decode_barcodes, pack_ascii_matrix, pack_barcodes
+
+BARCODE_TABLE_DTYPE = np.dtype([('barcode', '<u8'), ('count', '<u8')])
+BARCODE_TABLE_VERSION = 1
+# Per-sample output files of fastq_data_parsing.py
+SAMPLE_FILE_SUFFIXES = ('_barcode_counts.tsv', '_barcodes.npy', '_barcodes.txt')
+
+
+class PackedBarcodeCounts(namedtuple('PackedBarcodeCounts', ['packed', 'counts', 'other_barcodes', 'barcode_length'])):
+    """
+    Counts of unique barcodes: the packed barcodes of barcode_length bases with their counts, and a dict of the counts
+    of the barcodes that cannot be packed (e.g. containing 'N'). Barcode i is packed[i] for i < len(packed) and the
+    (i - len(packed))-th key of other_barcodes after that. Extraction returns the packed barcodes sorted.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_barcodes(cls, barcodes, counts, barcode_length=None):
+        """
+        Pack unique barcode strings and their counts.
+
+        :param barcodes: list of str, unique barcode sequences
+        :param counts: array-like of int, count of each barcode
+        :param barcode_length: int, length of the barcodes to pack (default: None, the most common length)
+        :return: PackedBarcodeCounts, with the packed barcodes sorted
+        """
+        barcodes = list(barcodes)
+        counts = np.asarray(counts, dtype=np.int64)
+        if barcode_length is None:
+            barcode_length = Counter(len(barcode) for barcode in barcodes).most_common(1)[0][0] if barcodes else 30
+        packed, packable = pack_barcodes(barcodes, barcode_length)
+        other_barcodes = {barcodes[i]: int(counts[i]) for i in np.flatnonzero(~packable)}
+        order = np.argsort(packed[packable], kind='stable')
+        return cls(packed[packable][order], counts[packable][order], other_barcodes, barcode_length)
+
+    @classmethod
+    def from_dict(cls, barcode_counts, barcode_length=None):
+        """
+        Pack a dictionary of barcodes and their counts (see from_barcodes).
+        """
+        return cls.from_barcodes(list(barcode_counts), list(barcode_counts.values()), barcode_length)
+
+    @property
+    def num_barcodes(self):
+        return len(self.packed) + len(self.other_barcodes)
+
+    def all_counts(self):
+        """
+        Return the count of every barcode, in barcode order.
+
+        :return: np.ndarray of int64
+        """
+        other_counts = np.fromiter(self.other_barcodes.values(), dtype=np.int64, count=len(self.other_barcodes))
+        return np.concatenate((np.asarray(self.counts, dtype=np.int64), other_counts))
+
+    def barcodes(self, ids=None):
+        """
+        Decode barcodes into strings.
+
+        :param ids: array-like of int, barcode indices (default: None, every barcode)
+        :return: list of str, barcode sequences
+        """
+        other_barcodes = list(self.other_barcodes)
+        if ids is None:
+            return decode_barcodes(self.packed, self.barcode_length) + other_barcodes
+        ids = np.asarray(ids, dtype=np.int64)
+        barcodes = np.empty(len(ids), dtype=object)
+        is_packed = ids < len(self.packed)
+        barcodes[is_packed] = decode_barcodes(self.packed[ids[is_packed]], self.barcode_length)
+        barcodes[~is_packed] = [other_barcodes[i - len(self.packed)] for i in ids[~is_packed].tolist()]
+        return barcodes.tolist()
+
+    def sort_rank(self):
+        """
+        Rank every barcode in alphabetical order, with the barcodes that cannot be packed after the packed ones.
+
+        :return: np.ndarray of int64, rank of each barcode
+        """
+        ranks = np.empty(self.num_barcodes, dtype=np.int64)
+        ranks[np.argsort(self.packed, kind='stable')] = np.arange(len(self.packed))
+        other_order = np.argsort(np.array(list(self.other_barcodes), dtype=str), kind='stable')
+        ranks[len(self.packed) + other_order] = len(self.packed) + np.arange(len(other_order))
+        return ranks
+
+    def to_counter(self):
+        """
+        Return the counts as a Counter of barcode strings.
+        """
+        barcode_counts = Counter(dict(zip(decode_barcodes(self.packed, self.barcode_length), np.asarray(self.counts).tolist())))
+        barcode_counts.update(self.other_barcodes)
+        return barcode_counts
+
+
+def sum_sorted_counts(packed, counts):
+    """
+    Sum the counts of equal packed barcodes. The barcodes must be sorted, so equal barcodes are adjacent.
+
+    :param packed: np.ndarray of uint64, sorted packed barcodes
+    :param counts: np.ndarray of int, count of each barcode
+    :return: tuple (np.ndarray of uint64, np.ndarray), unique packed barcodes and their summed counts
+    """
+    if len(packed) == 0:
+        return packed, counts
+    starts = np.flatnonzero(np.concatenate(([True], packed[1:] != packed[:-1])))
+    return packed[starts], np.add.reduceat(counts, starts)
+
+
+def merge_packed_barcode_counts(parts, barcode_length=30):
+    """
+    Sum the counts of several sets of barcode counts. The sorted packed barcodes of each part are merged into the
+    running totals one part at a time, so parts can be memory-mapped tables and memory holds the unique barcodes seen
+    so far plus one part.
+
+    :param parts: iterable of PackedBarcodeCounts or (np.ndarray of uint64, np.ndarray of int, dict), sorted packed
+                  barcodes, their counts and the counts of the barcodes that cannot be packed
+    :param barcode_length: int, length of the packed barcodes (default: 30)
+    :return: PackedBarcodeCounts, with the packed barcodes sorted
+    """
+    unique_packed = np.zeros(0, dtype=np.uint64)
+    counts = np.zeros(0, dtype=np.int64)
+    other_barcodes = Counter()
+    for part in parts:
+        part_packed, part_counts, part_other_barcodes = part[:3]
+        if len(part_packed):
+            packed = np.concatenate((unique_packed, part_packed))
+            # Both parts are sorted, so the stable sort (timsort) only merges two runs
+            order = np.argsort(packed, kind='stable')
+            unique_packed, counts = sum_sorted_counts(packed[order], np.concatenate((counts, np.asarray(part_counts, dtype=np.int64)))[order])
+        other_barcodes.update(part_other_barcodes)
+    return PackedBarcodeCounts(unique_packed, counts, dict(other_barcodes), barcode_length)
+
+
+def write_barcode_counts(file_path, barcode_counts):
+    """
+    Write a barcode count table sorted by barcode.
+
+    :param file_path: str, path to the output file
+    :param barcode_counts: dict or iterable of (str or bytes, int), barcodes and their counts
+    :return: int, number of unique barcodes written
+    """
+    items = barcode_counts.items() if hasattr(barcode_counts, 'items') else barcode_counts
+    num_barcodes = 0
+    with open(file_path, 'w') as f:
+        for barcode, count in sorted(items):
+            if isinstance(barcode, bytes):
+                barcode = barcode.decode('ascii')
+            f.write(f"{barcode}\t{count}\n")
+            num_barcodes += 1
+    return num_barcodes
+
+
+def iter_barcode_counts(file_path):
+    """
+    Read a barcode count table one line at a time.
+
+    :param file_path: str, path to a count table file
+    :return: generator of (str, int), barcodes and their counts in file order
+    """
+    with open(file_path, 'r') as f:
+        for line in f:
+            barcode, count = line.rstrip('\n').split('\t')
+            yield barcode, int(count)
+
+
+def read_barcode_counts(file_path):
+    """
+    Read a whole barcode count table into a dictionary.
+
+    :param file_path: str, path to a count table file
+    :return: dict, mapping of each barcode to its count
+    """
+    return dict(iter_barcode_counts(file_path))
+
+
+def _pack_count_lines(data, barcode_length):
+    """
+    Parse whole lines of a barcode count table, packing the barcodes and parsing the counts of all lines at once.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buffer == ord('\n'))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    tabs = np.flatnonzero(buffer == ord('\t'))
+    if len(tabs) != len(ends):
+        raise ValueError("Expected one barcode and one count per line.")
+
+    # Right-align the digits of each count so that column j holds the digit of place value 10 ** (width - 1 - j)
+    num_digits = ends - tabs - 1
+    width = int(num_digits.max(initial=0))
+    positions = ends[:, None] - width + np.arange(width)
+    digits = np.where(positions > tabs[:, None], buffer[np.maximum(positions, 0)].astype(np.int64) - ord('0'), 0)
+    counts = digits @ (10 ** np.arange(width - 1, -1, -1, dtype=np.int64))
+
+    packable = np.flatnonzero(tabs - starts == barcode_length)
+    packed, valid = pack_ascii_matrix(buffer[starts[packable, None] + np.arange(barcode_length)])
+    other = np.setdiff1d(np.arange(len(ends)), packable[valid])
+    other_barcodes = {data[starts[i]:tabs[i]].decode('ascii'): int(counts[i]) for i in other.tolist()}
+    return packed[valid], counts[packable[valid]], other_barcodes
+
+
+def read_packed_barcode_counts(file_path, barcode_length=30, block_size=16 * 1024 ** 2):
+    """
+    Read a barcode count table into PackedBarcodeCounts. The barcodes are packed straight from the bytes of each
+    block of lines, so no string is created per barcode; the table is sorted, so the packed barcodes are too.
+
+    :param file_path: str, path to a count table file
+    :param barcode_length: int, length of the barcodes to pack (default: 30)
+    :param block_size: int, number of bytes read at a time (default: 16 MB)
+    :return: PackedBarcodeCounts
+    """
+    packed_blocks, count_blocks = [np.zeros(0, dtype=np.uint64)], [np.zeros(0, dtype=np.int64)]
+    other_barcodes = {}
+    remainder = b''
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            data = remainder + block
+            if block:
+                end = data.rfind(b'\n') + 1
+                data, remainder = data[:end], data[end:]
+            elif data and not data.endswith(b'\n'):
+                data += b'\n'
+            if data:
+                packed, counts, block_other_barcodes = _pack_count_lines(data, barcode_length)
+                packed_blocks.append(packed)
+                count_blocks.append(counts)
+                other_barcodes.update(block_other_barcodes)
+            if not block:
+                break
+    return PackedBarcodeCounts(np.concatenate(packed_blocks), np.concatenate(count_blocks), other_barcodes, barcode_length)
+
+
+def merge_barcode_count_files(file_paths, output_file):
+    """
+    Merge sorted count table files into one, summing the counts of barcodes present in several files.
+    Only one line per input file is held in memory at a time.
+
+    :param file_paths: list of str, paths to sorted count table files
+    :param output_file: str, path to the merged count table file
+    :return: int, number of unique barcodes written
+    """
+    merged = heapq.merge(*(iter_barcode_counts(file_path) for file_path in file_paths), key=itemgetter(0))
+    num_barcodes = 0
+    with open(output_file, 'w') as f:
+        for barcode, entries in groupby(merged, key=itemgetter(0)):
+            f.write(f"{barcode}\t{sum(count for _, count in entries)}\n")
+            num_barcodes += 1
+    return num_barcodes
+
+
+def write_barcode_table(file_path, barcodes, counts=None, barcode_length=30, metadata=None):
+    """
+    Write barcodes and their counts in the binary columnar format: a .npy file of (packed barcode, count) records
+    sorted by barcode, which loaders can memory-map, and a .json sidecar file with the table metadata.
+    Barcodes that cannot be packed (wrong length or characters other than A, C, G and T) are left out and counted
+    in the metadata.
+
+    :param file_path: str, path to the .npy file to write
+    :param barcodes: list of str, unique barcode sequences
+    :param counts: array-like of int, count of each barcode (default: None, a count of 1 per barcode)
+    :param barcode_length: int, length of the barcodes (default: 30)
+    :param metadata: dict, additional metadata to store, e.g. the sample name (default: None)
+    :return: int, number of barcodes written
+    """
+    counts = np.ones(len(barcodes), dtype=np.uint64) if counts is None else np.asarray(counts, dtype=np.uint64)
+    correct_length = np.fromiter((len(barcode) == barcode_length for barcode in barcodes), dtype=bool, count=len(barcodes))
+    packed, valid = pack_ascii_matrix(ascii_matrix([barcode for barcode in barcodes if len(barcode) == barcode_length])
+                                      if correct_length.any() else np.zeros((0, barcode_length), dtype=np.uint8))
+    kept_counts = counts[correct_length][valid]
+    return write_packed_barcode_table(file_path, packed[valid], kept_counts, barcode_length, metadata,
+                                      num_skipped_barcodes=len(barcodes) - len(kept_counts),
+                                      skipped_count=int(counts.sum() - kept_counts.sum()))
+
+
+def write_packed_barcode_table(file_path, packed, counts, barcode_length=30, metadata=None, num_skipped_barcodes=0,
+                               skipped_count=0):
+    """
+    Write already packed unique barcodes and their counts as a binary barcode table (see write_barcode_table).
+
+    :param file_path: str, path to the .npy file to write
+    :param packed: np.ndarray of uint64, unique packed barcodes
+    :param counts: array-like of int, count of each barcode
+    :param barcode_length: int, length of the barcodes (default: 30)
+    :param metadata: dict, additional metadata to store, e.g. the sample name (default: None)
+    :param num_skipped_barcodes: int, number of barcodes that could not be packed and are left out (default: 0)
+    :param skipped_count: int, total count of the barcodes left out (default: 0)
+    :return: int, number of barcodes written
+    """
+    table = np.empty(len(packed), dtype=BARCODE_TABLE_DTYPE)
+    table['barcode'] = packed
+    table['count'] = counts
+    table.sort(order='barcode')
+    np.save(file_path, table)
+
+    table_metadata = dict(metadata or {})
+    table_metadata.update({
+        'format_version': BARCODE_TABLE_VERSION,
+        'barcode_length': barcode_length,
+        'num_barcodes': int(len(table)),
+        'total_count': int(table['count'].sum()),
+        'num_skipped_barcodes': int(num_skipped_barcodes),
+        'skipped_count': int(skipped_count),
+    })
+    with open(metadata_path(file_path), 'w') as f:
+        json.dump(table_metadata, f, indent=2)
+    return len(table)
+
+
+def metadata_path(file_path):
+    """
+    Return the path of the .json metadata file that accompanies a binary barcode table.
+    """
+    return os.path.splitext(file_path)[0] + '.json'
+
+
+def load_barcode_table(file_path, mmap=True):
+    """
+    Load a binary barcode table. With mmap=True the columns are read-only views of the memory-mapped file,
+    so no data is copied until it is used.
+
+    :param file_path: str, path to the .npy file
+    :param mmap: bool, set to False to read the whole table into memory (default: True)
+    :return: tuple (np.ndarray of uint64, np.ndarray of uint64, dict), packed barcodes, counts and metadata
+    """
+    with open(metadata_path(file_path), 'r') as f:
+        metadata = json.load(f)
+    # An empty table cannot be memory-mapped
+    table = np.load(file_path, mmap_mode='r' if mmap and metadata['num_barcodes'] else None)
+    return table['barcode'], table['count'], metadata
+
+
+def read_barcode_table_counts(file_path):
+    """
+    Read a binary barcode table into a dictionary of barcode strings and counts.
+
+    :param file_path: str, path to the .npy file
+    :return: dict, mapping of each barcode to its count
+    """
+    packed, counts, metadata = load_barcode_table(file_path)
+    return dict(zip(decode_barcodes(packed, metadata['barcode_length']), counts.tolist()))
+
+
+def sample_name(file_path):
+    """
+    Return the sample name of a per-sample output file, e.g. 'SRR123' for 'SRR123_barcode_counts.tsv'.
+    """
+    file_name = os.path.basename(file_path)
+    for suffix in SAMPLE_FILE_SUFFIXES:
+        if file_name.endswith(suffix):
+            return file_name[:-len(suffix)]
+    return os.path.splitext(file_name)[0]
+
+
+def read_sample_barcode_counts(file_path):
+    """
+    Read a per-sample read count file of either format into a dictionary of barcodes and read counts. Barcode lists
+    (<sample>_barcodes.txt, or binary tables of unique barcodes) hold no read counts and are refused.
+
+    :param file_path: str, path to a <sample>_barcode_counts.tsv or <sample>_barcodes.npy file
+    :return: dict, mapping of each barcode to its read count
+    """
+    if file_path.endswith('.npy'):
+        with open(metadata_path(file_path), 'r') as f:
+            if json.load(f).get('counts') == 'unique':
+                raise ValueError(f"{file_path} lists unique barcodes without read counts.")
+        return read_barcode_table_counts(file_path)
+    if file_path.endswith('.tsv'):
+        return read_barcode_counts(file_path)
+    raise ValueError(f"{file_path} is not a read count file (<sample>_barcode_counts.tsv or <sample>_barcodes.npy).")
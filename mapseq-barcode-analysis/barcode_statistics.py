@@ -0,0 +1,488 @@
+"""
+THIS SCRIPT COMPUTES QUALITY ASSURANCE STATISTICS OF EXTRACTED BARCODE FILES IN ONE STREAMING PASS WITH BOUNDED MEMORY.
+
+It reads the per-sample outputs of fastq_data_parsing.py: barcode lists (<sample>_barcodes.txt, one barcode per line),
+text count tables (<sample>_barcode_counts.tsv) and binary barcode tables (<sample>_barcodes.npy). Each file is read
+in blocks, and every statistic is updated from whole NumPy arrays per block:
+1. Number of barcodes, total count (reads) and number of unique barcodes.
+2. The top-k most abundant barcodes.
+3. Length histogram, number of invalid barcodes and counts of the characters other than A, C, G and T.
+4. Base composition at each position of the barcodes of the expected length.
+5. Abundance distribution: the number of unique barcodes seen a given number of times.
+
+Barcodes are weighted by their counts, so count tables give read-level statistics. Unique counts, top-k and abundances
+cover the valid barcodes (expected length, only A, C, G and T), which are tracked as 2-bit packed integers.
+
+Count tables hold each barcode once, so their rows are tracked without aggregation. Barcode lists are aggregated
+exactly until they hold more than max_exact_barcodes unique barcodes; beyond that, counts are estimated with a
+count-min sketch, the top-k with the sketch estimates of a bounded set of candidates and the number of unique
+barcodes with a HyperLogLog counter, and the abundance distribution is not reported.
+
+Several files are analysed in parallel, one file per worker process.
+"""
+
+import os
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+from barcode_encoding import BASE_CODES, decode_barcodes, pack_ascii_matrix
+from barcode_io import load_barcode_table
+from instrumentation import collect_metrics, merge_task_results
+
+DEFAULT_BLOCK_SIZE = 8 * 1024 * 1024  # Bytes of text, or rows of a binary table, per block
+COMPOSITION_BASES = ('A', 'C', 'G', 'T', 'other')
+
+_HLL_INDEX_BITS = 14
+_HLL_RANK_BITS = 64 - _HLL_INDEX_BITS  # 50 bits, exactly representable as float64 for the rank computation
+_HLL_REGISTERS = 1 << _HLL_INDEX_BITS
+_SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+                 0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53, 0x27D4EB2F165667C5, 0x94D049BB133111EB)
+
+
+def mix_hash(values, seed=0):
+    """
+    Hash unsigned 64-bit integers with the splitmix64 finalizer.
+
+    :param values: np.ndarray of uint64, values to hash
+    :param seed: int, seed that selects one of a family of hash functions (default: 0)
+    :return: np.ndarray of uint64, hashes
+    """
+    with np.errstate(over='ignore'):
+        hashes = np.asarray(values, dtype=np.uint64) ^ np.uint64(seed)
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return hashes ^ (hashes >> np.uint64(31))
+
+
+class CountMinSketch:
+    """
+    This class estimates the counts of packed barcodes in fixed memory. Estimates are never below the true counts.
+    """
+
+    def __init__(self, width=1 << 20, depth=4):
+        """
+        :param width: int, number of counters per row (default: 2**20)
+        :param depth: int, number of rows, each with its own hash function (default: 4, at most 8)
+        """
+        if not 1 <= depth <= len(_SKETCH_SEEDS):
+            raise ValueError(f"The sketch depth must be between 1 and {len(_SKETCH_SEEDS)}.")
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _columns(self, packed):
+        return [mix_hash(packed, seed) % np.uint64(self.width) for seed in _SKETCH_SEEDS[:len(self.table)]]
+
+    def add(self, packed, counts):
+        """
+        Add counts of packed barcodes.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        :param counts: np.ndarray of int, count of each barcode
+        """
+        for row, columns in zip(self.table, self._columns(packed)):
+            row += np.bincount(columns.astype(np.int64), weights=counts, minlength=self.width).astype(np.int64)
+
+    def estimate(self, packed):
+        """
+        Estimate the counts of packed barcodes.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        :return: np.ndarray of int64, estimated count of each barcode
+        """
+        return np.min([row[columns.astype(np.int64)] for row, columns in zip(self.table, self._columns(packed))], axis=0)
+
+
+class HyperLogLog:
+    """
+    This class estimates the number of distinct packed barcodes in fixed memory (standard error about 0.8%).
+    """
+
+    def __init__(self):
+        self.registers = np.zeros(_HLL_REGISTERS, dtype=np.uint8)
+
+    def add(self, packed):
+        """
+        Add packed barcodes.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        """
+        hashes = mix_hash(packed)
+        indices = (hashes >> np.uint64(_HLL_RANK_BITS)).astype(np.int64)
+        remainder = (hashes & np.uint64((1 << _HLL_RANK_BITS) - 1)).astype(np.float64)
+        # Position of the first set bit of the remainder, counting from its most significant bit
+        ranks = np.full(len(packed), _HLL_RANK_BITS + 1, dtype=np.uint8)
+        nonzero = remainder > 0
+        ranks[nonzero] = _HLL_RANK_BITS - np.floor(np.log2(remainder[nonzero])).astype(np.uint8)
+        np.maximum.at(self.registers, indices, ranks)
+
+    def estimate(self):
+        """
+        Estimate the number of distinct barcodes added.
+
+        :return: int, estimated number of distinct barcodes
+        """
+        alpha = 0.7213 / (1 + 1.079 / _HLL_REGISTERS)
+        estimate = alpha * _HLL_REGISTERS ** 2 / np.sum(2.0 ** -self.registers.astype(np.float64))
+        empty_registers = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * _HLL_REGISTERS and empty_registers:
+            estimate = _HLL_REGISTERS * np.log(_HLL_REGISTERS / empty_registers)  # Linear counting for small sets
+        return int(round(estimate))
+
+
+class BarcodeAbundance:
+    """
+    This class tracks the unique barcodes, the top-k barcodes and the abundance distribution of a stream of packed
+    barcodes and counts, exactly while it fits in max_exact_barcodes unique barcodes and with sketches beyond.
+    """
+
+    def __init__(self, top_k=10, unique_rows=False, max_exact_barcodes=2000000, sketch_width=1 << 20, sketch_depth=4):
+        """
+        :param top_k: int, number of most abundant barcodes to report (default: 10)
+        :param unique_rows: bool, set to True if every barcode appears once in the stream, as in count tables (default: False)
+        :param max_exact_barcodes: int, maximum number of unique barcodes aggregated exactly (default: 2000000)
+        :param sketch_width: int, width of the count-min sketch (default: 2**20)
+        :param sketch_depth: int, depth of the count-min sketch (default: 4)
+        """
+        self.top_k = top_k
+        self.unique_rows = unique_rows
+        self.max_exact_barcodes = max_exact_barcodes
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
+        self.num_unique = 0
+        self.abundance_histogram = Counter()  # count -> number of barcodes, for unique rows
+        self.top_packed = np.zeros(0, dtype=np.uint64)
+        self.top_counts = np.zeros(0, dtype=np.int64)
+        # Exact aggregation: sorted unique barcodes and their counts, plus blocks not yet merged into them
+        self.packed = np.zeros(0, dtype=np.uint64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.num_pending = 0
+        self.sketch = None
+        self.distinct = None
+
+    def _keep_top(self, packed, counts):
+        if len(packed) > self.top_k:
+            top = np.argpartition(counts, -self.top_k)[-self.top_k:]
+            packed, counts = packed[top], counts[top]
+        return packed, counts
+
+    def add(self, packed, counts):
+        """
+        Add a block of packed barcodes and their counts.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        :param counts: np.ndarray of int, count of each barcode
+        """
+        packed = np.asarray(packed, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.int64)
+        if not len(packed):
+            return
+        if self.unique_rows:
+            self.num_unique += len(packed)
+            values, frequencies = np.unique(counts, return_counts=True)
+            self.abundance_histogram.update(dict(zip(values.tolist(), frequencies.tolist())))
+            self.top_packed, self.top_counts = self._keep_top(np.concatenate([self.top_packed, packed]),
+                                                              np.concatenate([self.top_counts, counts]))
+        elif self.sketch is not None:
+            self._add_to_sketch(packed, counts)
+        else:
+            self.pending.append((packed, counts))
+            self.num_pending += len(packed)
+            # Merge once the pending blocks are as large as the aggregate, so each barcode is merged O(log n) times
+            if self.num_pending >= max(len(self.packed), self.max_exact_barcodes // 16):
+                self._merge_pending()
+
+    def _merge_pending(self):
+        if not self.pending:
+            return
+        packed = np.concatenate([self.packed] + [block for block, _ in self.pending])
+        counts = np.concatenate([self.counts] + [block_counts for _, block_counts in self.pending])
+        self.pending, self.num_pending = [], 0
+        self.packed, inverse = np.unique(packed, return_inverse=True)
+        self.counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(self.packed)).astype(np.int64)
+        if len(self.packed) > self.max_exact_barcodes:
+            self._switch_to_sketch()
+
+    def _switch_to_sketch(self):
+        self.sketch = CountMinSketch(self.sketch_width, self.sketch_depth)
+        self.distinct = HyperLogLog()
+        packed, counts = self.packed, self.counts
+        self.packed, self.counts = np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+        self._add_to_sketch(packed, counts)
+
+    def _add_to_sketch(self, packed, counts):
+        packed, inverse = np.unique(packed, return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=counts, minlength=len(packed)).astype(np.int64)
+        self.sketch.add(packed, counts)
+        self.distinct.add(packed)
+        # Candidates are the current top barcodes and the most abundant barcodes of this block
+        candidates = np.union1d(self.top_packed, self._keep_top(packed, counts)[0])
+        self.top_packed, self.top_counts = self._keep_top(candidates, self.sketch.estimate(candidates))
+
+    def is_estimate(self):
+        """
+        Return whether the unique count and top-k counts are sketch estimates.
+        """
+        return self.sketch is not None
+
+    def summary(self, barcode_length):
+        """
+        Summarize the tracked barcodes.
+
+        :param barcode_length: int, length of the barcodes
+        :return: dict, number of unique barcodes, top barcodes as (barcode, count) pairs, most abundant first, and
+                 abundance histogram (None when counts are estimated)
+        """
+        if not self.unique_rows and self.sketch is None:
+            self._merge_pending()
+            if self.sketch is None:
+                self.num_unique = len(self.packed)
+                values, frequencies = np.unique(self.counts, return_counts=True)
+                self.abundance_histogram = Counter(dict(zip(values.tolist(), frequencies.tolist())))
+                self.top_packed, self.top_counts = self._keep_top(self.packed, self.counts)
+        if self.sketch is not None:
+            self.num_unique = self.distinct.estimate()
+
+        order = np.lexsort((self.top_packed, -self.top_counts))
+        top_barcodes = list(zip(decode_barcodes(self.top_packed[order], barcode_length), self.top_counts[order].tolist()))
+        return {
+            'unique_barcodes': int(self.num_unique),
+            'top_barcodes': top_barcodes,
+            'abundance_histogram': None if self.sketch is not None else dict(sorted(self.abundance_histogram.items())),
+        }
+
+
+class BarcodeStatistics:
+    """
+    This class accumulates the statistics of one barcode file block by block.
+    """
+
+    def __init__(self, barcode_length=30, top_k=10, unique_rows=False, max_exact_barcodes=2000000):
+        """
+        :param barcode_length: int, expected length of the barcodes (default: 30)
+        :param top_k: int, number of most abundant barcodes to report (default: 10)
+        :param unique_rows: bool, set to True if every barcode appears once, as in count tables (default: False)
+        :param max_exact_barcodes: int, maximum number of unique barcodes aggregated exactly (default: 2000000)
+        """
+        self.barcode_length = barcode_length
+        self.num_barcodes = 0
+        self.total_count = 0
+        self.length_histogram = Counter()
+        self.num_invalid_barcodes = 0
+        self.invalid_count = 0
+        self.invalid_characters = Counter()
+        self.base_composition = np.zeros((barcode_length, len(COMPOSITION_BASES)), dtype=np.int64)
+        self.abundance = BarcodeAbundance(top_k, unique_rows, max_exact_barcodes)
+
+    def add_sequences(self, barcodes, counts=None):
+        """
+        Add a block of barcodes read from a text file.
+
+        :param barcodes: list of bytes, barcode sequences
+        :param counts: np.ndarray of int, count of each barcode (default: None, a count of 1 per barcode)
+        """
+        if not barcodes:
+            return
+        counts = np.ones(len(barcodes), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        lengths = np.fromiter(map(len, barcodes), dtype=np.int64, count=len(barcodes))
+        self.num_barcodes += len(barcodes)
+        self.total_count += int(counts.sum())
+        values, inverse = np.unique(lengths, return_inverse=True)
+        self.length_histogram.update(dict(zip(values.tolist(), np.bincount(inverse.reshape(-1), weights=counts).astype(np.int64).tolist())))
+
+        # Characters other than A, C, G and T in all barcodes, weighted by the barcode counts
+        characters = np.frombuffer(b''.join(barcodes), dtype=np.uint8)
+        character_counts = np.bincount(characters, weights=np.repeat(counts, lengths), minlength=256).astype(np.int64)
+        character_counts[BASE_CODES != 255] = 0
+        for character in np.flatnonzero(character_counts):
+            self.invalid_characters[chr(character)] += int(character_counts[character])
+
+        correct_length = lengths == self.barcode_length
+        sequences = np.frombuffer(b''.join([barcode for barcode, is_correct in zip(barcodes, correct_length) if is_correct]),
+                                  dtype=np.uint8).reshape(-1, self.barcode_length)
+        correct_counts = counts[correct_length]
+        codes = BASE_CODES[sequences]
+        codes[codes == 255] = 4
+        self._add_composition(codes, correct_counts)
+
+        packed, valid = pack_ascii_matrix(sequences)
+        self.num_invalid_barcodes += len(barcodes) - int(valid.sum())
+        self.invalid_count += int(counts.sum() - correct_counts[valid].sum())
+        self.abundance.add(packed[valid], correct_counts[valid])
+
+    def add_packed(self, packed, counts):
+        """
+        Add a block of packed barcodes read from a binary barcode table.
+
+        :param packed: np.ndarray of uint64, packed barcodes of barcode_length bases
+        :param counts: np.ndarray of int, count of each barcode
+        """
+        packed = np.asarray(packed, dtype=np.uint64)
+        counts = np.asarray(counts, dtype=np.int64)
+        self.num_barcodes += len(packed)
+        self.total_count += int(counts.sum())
+        self.length_histogram[self.barcode_length] += int(counts.sum())
+        codes = np.empty((len(packed), self.barcode_length), dtype=np.uint8)
+        for position in range(self.barcode_length):
+            shift = np.uint64(2 * (self.barcode_length - 1 - position))
+            codes[:, position] = (packed >> shift) & np.uint64(3)
+        self._add_composition(codes, counts)
+        self.abundance.add(packed, counts)
+
+    def _add_composition(self, codes, counts):
+        # One bincount over (position, base) pairs for the whole block
+        cells = (np.arange(self.barcode_length) * len(COMPOSITION_BASES) + codes).reshape(-1)
+        self.base_composition += np.bincount(cells, weights=np.repeat(counts, self.barcode_length),
+                                             minlength=self.base_composition.size).astype(np.int64).reshape(self.base_composition.shape)
+
+    def report(self):
+        """
+        Summarize the statistics as plain data.
+
+        :return: dict, statistics of the file
+        """
+        report = {
+            'barcodes': self.num_barcodes,
+            'total_count': self.total_count,
+            'estimated': self.abundance.is_estimate(),
+            'length_histogram': dict(sorted(self.length_histogram.items())),
+            'invalid_barcodes': self.num_invalid_barcodes,
+            'invalid_count': self.invalid_count,
+            'invalid_characters': dict(self.invalid_characters.most_common()),
+            'base_composition': [dict(zip(COMPOSITION_BASES, row)) for row in self.base_composition.tolist()],
+        }
+        report.update(self.abundance.summary(self.barcode_length))
+        return report
+
+
+def iter_text_blocks(file_path, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Read a text file in blocks of whole lines.
+
+    :param file_path: str, path to the file
+    :param block_size: int, approximate number of bytes per block (default: 8 MB)
+    :return: generator of bytes, blocks ending at a line boundary
+    """
+    with open(file_path, 'rb') as f:
+        remainder = b''
+        for block in iter(lambda: f.read(block_size), b''):
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            if end:
+                yield block[:end]
+        if remainder:
+            yield remainder
+
+
+def barcode_file_statistics(file_path, barcode_length=30, top_k=10, max_exact_barcodes=2000000, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Compute the statistics of one barcode file: a barcode list (.txt), a text count table (.tsv) or a binary barcode
+    table (.npy).
+
+    :param file_path: str, path to the barcode file
+    :param barcode_length: int, expected length of the barcodes; binary tables use their own (default: 30)
+    :param top_k: int, number of most abundant barcodes to report (default: 10)
+    :param max_exact_barcodes: int, maximum number of unique barcodes of a barcode list aggregated exactly (default: 2000000)
+    :param block_size: int, approximate number of bytes per block (default: 8 MB)
+    :return: dict, statistics of the file (see BarcodeStatistics.report)
+    """
+    if file_path.endswith('.npy'):
+        packed, counts, metadata = load_barcode_table(file_path)
+        statistics = BarcodeStatistics(metadata['barcode_length'], top_k, unique_rows=True)
+        # Each packed row is expanded to several bytes per base while it is aggregated, so the blocks are counted in
+        # rows sized to keep that expansion near block_size bytes
+        block_rows = max(1, block_size // (8 * metadata['barcode_length']))
+        for start in range(0, len(packed), block_rows):
+            statistics.add_packed(packed[start:start + block_rows], counts[start:start + block_rows])
+        # Barcodes that could not be packed were left out of the table and are only known by number
+        statistics.num_barcodes += metadata.get('num_skipped_barcodes', 0)
+        statistics.num_invalid_barcodes += metadata.get('num_skipped_barcodes', 0)
+        statistics.total_count += metadata.get('skipped_count', 0)
+        statistics.invalid_count += metadata.get('skipped_count', 0)
+    elif file_path.endswith('.tsv'):
+        statistics = BarcodeStatistics(barcode_length, top_k, unique_rows=True)
+        for block in iter_text_blocks(file_path, block_size):
+            fields = block.split()
+            statistics.add_sequences(fields[0::2], np.array(fields[1::2]).astype(np.int64))
+    else:
+        statistics = BarcodeStatistics(barcode_length, top_k, max_exact_barcodes=max_exact_barcodes)
+        for block in iter_text_blocks(file_path, block_size):
+            statistics.add_sequences(block.split())
+
+    report = statistics.report()
+    report['file'] = os.path.basename(file_path)
+    return report
+
+
+def analyze_barcode_files(file_paths, num_processes=None, **options):
+    """
+    Compute the statistics of several barcode files in parallel, one file per worker process.
+
+    :param file_paths: list of str, paths to barcode files
+    :param num_processes: int, number of worker processes (default: None, use os.cpu_count())
+    :param options: keyword arguments of barcode_file_statistics
+    :return: list of dict, statistics of each file in the order of file_paths
+    """
+    num_processes = min(num_processes or os.cpu_count() or 1, len(file_paths))
+    if num_processes <= 1:
+        return [barcode_file_statistics(file_path, **options) for file_path in file_paths]
+    with Pool(num_processes) as pool:
+        return merge_task_results(pool.starmap(collect_metrics, [(_file_statistics_task, file_path, options) for file_path in file_paths]))
+
+
+def _file_statistics_task(file_path, options):
+    return barcode_file_statistics(file_path, **options)
+
+
+def abundance_bins(abundance_histogram):
+    """
+    Group an abundance histogram into powers of two.
+
+    :param abundance_histogram: dict, mapping of each count to the number of barcodes with that count
+    :return: list of (int, int, int, int), lowest and highest count of each bin, number of barcodes and their total count
+    """
+    bins = {}
+    for count, num_barcodes in abundance_histogram.items():
+        low = 1 << (int(count).bit_length() - 1) if count > 0 else 0
+        entry = bins.setdefault(low, [0, 0])
+        entry[0] += num_barcodes
+        entry[1] += count * num_barcodes
+    return [(low, max(low, 2 * low - 1), num_barcodes, total) for low, (num_barcodes, total) in sorted(bins.items())]
+
+
+def print_report(report, barcode_length=30):
+    """
+    Print the statistics of one barcode file.
+
+    :param report: dict, statistics as returned by barcode_file_statistics
+    :param barcode_length: int, expected length of the barcodes (default: 30)
+    """
+    approximate = "~" if report['estimated'] else ""
+    print(f"Analyzing {report['file']}:")
+    print(f"Barcodes: {report['barcodes']}, total count: {report['total_count']}")
+    print(f"Number of unique barcodes: {approximate}{report['unique_barcodes']}")
+    print(f"Top {len(report['top_barcodes'])} most frequent barcodes:")
+    for barcode, count in report['top_barcodes']:
+        print(f"{barcode}: {approximate}{count}")
+
+    print("Length histogram: " + ", ".join(f"{length}: {count}" for length, count in report['length_histogram'].items()))
+    if not report['invalid_barcodes']:
+        print(f"All barcodes are {barcode_length} nucleotides long and contain only A, C, G and T.")
+    else:
+        print(f"{report['invalid_barcodes']} barcodes ({report['invalid_count']} counts) have incorrect length or format.")
+    if report['invalid_characters']:
+        print("Invalid characters: " + ", ".join(f"{character!r}: {count}" for character, count in report['invalid_characters'].items()))
+
+    print("Base composition (%):")
+    print(f"{'position':>8} " + " ".join(f"{base:>6}" for base in COMPOSITION_BASES))
+    for position, composition in enumerate(report['base_composition'], 1):
+        total = sum(composition.values()) or 1
+        print(f"{position:>8} " + " ".join(f"{100 * composition[base] / total:6.1f}" for base in COMPOSITION_BASES))
+
+    if report['abundance_histogram'] is None:
+        print("Abundance distribution: not available, counts are estimated")
+    else:
+        print("Abundance distribution (count range: barcodes, total count):")
+        for low, high, num_barcodes, total in abundance_bins(report['abundance_histogram']):
+            print(f"{low}-{high}: {num_barcodes}, {total}" if high > low else f"{low}: {num_barcodes}, {total}")
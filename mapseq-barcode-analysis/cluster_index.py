@@ -0,0 +1,428 @@
+"""
+THIS SCRIPT KEEPS A PERSISTENT INDEX OF THE TRUE-BARCODE CLUSTERS OF A PROJECT, WHICH NEW SEQUENCING BATCHES UPDATE INCREMENTALLY.
+
+The index stores every barcode seen so far as a 2-bit packed integer (see barcode_encoding.py) with its total count,
+the connected component of the barcode similarity graph it belongs to and the true barcode of its group. Adding a
+batch of barcode counts:
+1. Looks up the batch barcodes; known barcodes only have their counts increased.
+2. Finds the neighbors of the new barcodes with the pigeonhole segment index (see neighbor_search.py) and merges the
+   components they connect with a growable union-find structure.
+3. Re-evaluates the groups of the affected components only, enumerating their members through a circular linked list
+   that is spliced on every merge.
+The work is proportional to the batch and the components it touches, not to the number of barcodes in the index.
+Groups are the same as those of MAPseqBarcodeAnalysis.cluster_barcodes on all counts added so far, because
+'cluster' groups are whole components and 'directional' groups never span two components.
+
+The segment index is a list of sorted runs, like a log-structured merge tree: each batch adds a run, and runs of
+similar size are merged, so every barcode is re-sorted O(log n) times in total. On disk, the per-barcode arrays are
+raw binary files that new barcodes are appended to, the runs are .npz files that are written once, and index.json
+records the parameters, the number of barcodes, the batches added and the files that make up the index. A save never
+overwrites data that index.json refers to: the new values of changed barcodes go to a journal file that is replayed on
+load, and once the journals hold half as many rows as the index, the columns are rewritten to new files instead. The
+save takes effect when index.json is replaced, so an interrupted save leaves the previous index intact.
+"""
+
+import json
+import os
+import tempfile
+import numpy as np
+from barcode_encoding import decode_barcodes, hamming_distance, pack_barcodes, segment_keys
+from barcode_io import PackedBarcodeCounts
+from instrumentation import metrics
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+from neighbor_search import segment_bounds
+from union_find import DisjointSet
+
+CLUSTER_INDEX_VERSION = 1
+METADATA_FILE = 'index.json'
+# Per-barcode arrays: packed barcode, total count, component root, true barcode (index of its representative) and
+# next member of the same component
+COLUMN_DTYPES = {'packed': np.dtype('<u8'), 'counts': np.dtype('<i8'), 'component': np.dtype('<i8'),
+                 'group': np.dtype('<i8'), 'next': np.dtype('<i8')}
+# Columns that change after a barcode is added; packed barcodes never do
+MUTABLE_COLUMNS = ('counts', 'component', 'group', 'next')
+
+
+class GrowableArray:
+    """
+    This class is a NumPy array that can be appended to in amortized constant time per element.
+    """
+
+    def __init__(self, values):
+        self.buffer = np.array(values)
+        self.size = len(self.buffer)
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def values(self):
+        return self.buffer[:self.size]
+
+    def append(self, values):
+        if self.size + len(values) > len(self.buffer):
+            buffer = np.empty(max(2 * len(self.buffer), self.size + len(values), 16), dtype=self.buffer.dtype)
+            buffer[:self.size] = self.values
+            self.buffer = buffer
+        self.buffer[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+
+class IndexRun:
+    """
+    This class is one sorted run of the segment index: the packed barcodes of a set of barcode indices, and their
+    pigeonhole segment keys, each sorted for binary search.
+    """
+
+    def __init__(self, ids, sorted_packed, segment_keys_sorted, segment_ids, name=None):
+        self.ids = ids  # Barcode indices in the order of sorted_packed
+        self.sorted_packed = sorted_packed
+        self.segment_keys = segment_keys_sorted
+        self.segment_ids = segment_ids
+        self.name = name  # File name once saved
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids, packed, barcode_length, bounds):
+        """
+        Sort the barcodes and segment keys of a set of barcode indices.
+
+        :param ids: np.ndarray of int64, barcode indices
+        :param packed: np.ndarray of uint64, packed barcodes of all indices
+        :param barcode_length: int, length of the barcodes
+        :param bounds: list of (int, int), pigeonhole segments
+        :return: IndexRun
+        """
+        run_packed = packed[ids]
+        order = np.argsort(run_packed, kind='stable')
+        keys, segment_ids = [], []
+        for start, end in bounds:
+            segment = segment_keys(run_packed, barcode_length, start, end)
+            segment_order = np.argsort(segment, kind='stable')
+            keys.append(segment[segment_order])
+            segment_ids.append(ids[segment_order])
+        return cls(ids[order], run_packed[order], keys, segment_ids)
+
+    def save(self, file_path):
+        arrays = {'ids': self.ids, 'sorted_packed': self.sorted_packed}
+        for number, (keys, ids) in enumerate(zip(self.segment_keys, self.segment_ids)):
+            arrays[f'segment_keys{number}'] = keys
+            arrays[f'segment_ids{number}'] = ids
+        np.savez(file_path, **arrays)
+
+    @classmethod
+    def load(cls, file_path, num_segments):
+        with np.load(file_path) as arrays:
+            return cls(arrays['ids'], arrays['sorted_packed'],
+                       [arrays[f'segment_keys{number}'] for number in range(num_segments)],
+                       [arrays[f'segment_ids{number}'] for number in range(num_segments)],
+                       name=os.path.basename(file_path))
+
+
+class ClusterIndex:
+    """
+    This class maintains the barcodes, counts, components and true barcodes of a project in an index directory.
+    """
+
+    def __init__(self, index_directory, barcode_length=30, max_hamming_distance=1, clustering_method='cluster', count_ratio=2):
+        """
+        Open the index in a directory, or create an empty index there.
+
+        :param index_directory: str, directory holding the index files
+        :param barcode_length: int, length of the barcodes; other barcodes are not indexed (default: 30)
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :param clustering_method: str, 'cluster' for connected components or 'directional' for abundance-ratio
+                                  network collapsing (default: 'cluster')
+        :param count_ratio: float, count ratio used by the 'directional' method (default: 2)
+        """
+        if clustering_method not in ('cluster', 'directional'):
+            raise ValueError(f"Unknown clustering method: {clustering_method}")
+        if barcode_length < max_hamming_distance + 1:
+            raise ValueError("The barcodes are too short to be split into max_hamming_distance + 1 segments.")
+        self.index_directory = index_directory
+        self.parameters = {'barcode_length': barcode_length, 'max_hamming_distance': max_hamming_distance,
+                           'clustering_method': clustering_method, 'count_ratio': count_ratio}
+        self.barcode_length = barcode_length
+        self.max_hamming_distance = max_hamming_distance
+        self.clustering_method = clustering_method
+        self.count_ratio = count_ratio
+        self.bounds = segment_bounds(barcode_length, max_hamming_distance + 1)
+        self.analyzer = MAPseqBarcodeAnalysis(None, None)
+        os.makedirs(index_directory, exist_ok=True)
+
+        metadata_file = os.path.join(index_directory, METADATA_FILE)
+        if os.path.exists(metadata_file):
+            self._load(metadata_file)
+        else:
+            self.columns = {name: GrowableArray(np.zeros(0, dtype=dtype)) for name, dtype in COLUMN_DTYPES.items()}
+            self.components = DisjointSet(0)
+            self.runs = []
+            self.batches = []
+            self.saved_size = 0
+            self.next_run_number = 0
+            self.column_files = {name: name + '.bin' for name in COLUMN_DTYPES}
+            self.journals = []  # Journal files with their numbers of rows
+            self.next_file_number = 0
+        self.dirty = []  # Indices changed since the last save
+        self.removed_runs = []  # Files of runs merged since the last save
+
+    def __len__(self):
+        return len(self.columns['packed'])
+
+    def _load(self, metadata_file):
+        with open(metadata_file, 'r') as f:
+            metadata = json.load(f)
+        if metadata['format_version'] != CLUSTER_INDEX_VERSION:
+            raise ValueError(f"Unsupported cluster index format version: {metadata['format_version']}")
+        for name, value in self.parameters.items():
+            if metadata[name] != value:
+                raise ValueError(f"The cluster index in {self.index_directory} was built with {name}={metadata[name]}, not {value}.")
+
+        size = metadata['num_barcodes']
+        self.column_files = metadata['column_files']
+        self.columns = {name: GrowableArray(np.fromfile(os.path.join(self.index_directory, self.column_files[name]), dtype=dtype, count=size))
+                        for name, dtype in COLUMN_DTYPES.items()}
+        # Replay the changes saved since the columns were last written
+        self.journals = metadata['journals']
+        for name, _ in self.journals:
+            with np.load(os.path.join(self.index_directory, name)) as journal:
+                for column in MUTABLE_COLUMNS:
+                    self.columns[column].values[journal['ids']] = journal[column]
+        self.next_file_number = metadata['next_file_number']
+        self.components = DisjointSet(size)
+        self.components.parent[:] = self.columns['component'].values
+        self.runs = [IndexRun.load(os.path.join(self.index_directory, name), len(self.bounds)) for name in metadata['runs']]
+        self.batches = metadata['batches']
+        self.saved_size = size
+        self.next_run_number = metadata['next_run_number']
+
+    def lookup(self, packed):
+        """
+        Find the indices of packed barcodes.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        :return: np.ndarray of int64, index of each barcode, or -1 for barcodes not in the index
+        """
+        packed = np.asarray(packed, dtype=np.uint64)
+        ids = np.full(len(packed), -1, dtype=np.int64)
+        for run in self.runs:
+            positions = np.minimum(np.searchsorted(run.sorted_packed, packed), len(run) - 1)
+            found = run.sorted_packed[positions] == packed
+            ids[found] = run.ids[positions[found]]
+        return ids
+
+    def _neighbor_pairs(self, ids):
+        """
+        Find all indexed barcodes within the maximum Hamming distance of the given barcodes.
+
+        :param ids: np.ndarray of int64, barcode indices
+        :return: np.ndarray of int64 with shape (n, 2), indices (i < j) of neighboring barcodes
+        """
+        packed = self.columns['packed'].values
+        query_packed = packed[ids]
+        pairs = [np.zeros((0, 2), dtype=np.int64)]
+        for run in self.runs:
+            for (start, end), keys, segment_ids in zip(self.bounds, run.segment_keys, run.segment_ids):
+                query_keys = segment_keys(query_packed, self.barcode_length, start, end)
+                low = np.searchsorted(keys, query_keys, side='left')
+                lengths = np.searchsorted(keys, query_keys, side='right') - low
+                if not lengths.any():
+                    continue
+                # Expand every query's bucket [low, low + length) into (query, candidate) pairs
+                queries = np.repeat(np.arange(len(ids)), lengths)
+                positions = np.arange(lengths.sum()) + np.repeat(low - np.cumsum(lengths) + lengths, lengths)
+                candidates = segment_ids[positions]
+                first = ids[queries]
+                within = (candidates != first) & (hamming_distance(query_packed[queries], packed[candidates]) <= self.max_hamming_distance)
+                pairs.append(np.stack([np.minimum(first, candidates)[within], np.maximum(first, candidates)[within]], axis=1))
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def _merge_runs(self):
+        # Merge the newest runs while they are of similar size, so the number of runs stays logarithmic
+        while len(self.runs) >= 2 and len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            newer, older = self.runs.pop(), self.runs.pop()
+            self.removed_runs += [run.name for run in (older, newer) if run.name]
+            self.runs.append(IndexRun.build(np.concatenate([older.ids, newer.ids]), self.columns['packed'].values,
+                                            self.barcode_length, self.bounds))
+
+    def _members(self, root):
+        """
+        Enumerate the members of a component by following its circular linked list.
+        """
+        next_member = self.columns['next'].values
+        members = [root]
+        member = int(next_member[root])
+        while member != root:
+            members.append(member)
+            member = int(next_member[member])
+        return np.array(members, dtype=np.int64)
+
+    def _evaluate_component(self, root, members):
+        """
+        Assign every member of a component to the true barcode of its group.
+        """
+        packed = self.columns['packed'].values
+        counts = self.columns['counts'].values
+        group = self.columns['group'].values
+        self.columns['component'].values[members] = root
+        if self.clustering_method == 'cluster' or len(members) == 1:
+            # The most abundant barcode, ties broken by the alphabetically smallest (= smallest packed) barcode
+            group[members] = members[np.lexsort((packed[members], -counts[members]))[0]]
+            return
+        barcodes = PackedBarcodeCounts(packed[members], counts[members], {}, self.barcode_length)
+        labels, roots = self.analyzer.label_barcodes_directional(barcodes, counts[members], self.max_hamming_distance,
+                                                                 self.count_ratio, packed[members])
+        group[members] = members[roots][labels]
+
+    def add_counts(self, barcode_counts, batch=None, save=True):
+        """
+        Add the barcode counts of a new batch and update the groups of the components it affects.
+
+        :param barcode_counts: dict, mapping of barcodes to their counts
+        :param batch: str, name of the batch, e.g. the sample; a batch already in the index is not added again (default: None)
+        :param save: bool, set to False to defer writing the changes to disk until save is called (default: True)
+        :return: dict, numbers of new, updated and skipped barcodes, new similarity edges, affected components and
+                 re-evaluated barcodes, or None if the batch was already added
+        """
+        if batch is not None and batch in self.batches:
+            return None
+        barcodes = list(barcode_counts)
+        counts = np.fromiter(barcode_counts.values(), dtype=np.int64, count=len(barcodes))
+        packed, packable = pack_barcodes(barcodes, self.barcode_length)
+        packed, inverse = np.unique(packed[packable], return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), weights=counts[packable], minlength=len(packed)).astype(np.int64)
+
+        ids = self.lookup(packed)
+        known = ids >= 0
+        self.columns['counts'].values[ids[known]] += counts[known]
+
+        new_ids = np.arange(len(self), len(self) + int((~known).sum()), dtype=np.int64)
+        self.columns['packed'].append(packed[~known])
+        self.columns['counts'].append(counts[~known])
+        for name in ('component', 'group', 'next'):
+            self.columns[name].append(new_ids)
+        self.components.extend(len(new_ids))
+        if len(new_ids):
+            self.runs.append(IndexRun.build(new_ids, self.columns['packed'].values, self.barcode_length, self.bounds))
+            self._merge_runs()
+
+        pairs = self._neighbor_pairs(new_ids)
+        next_member = self.columns['next'].values
+        for first, second in pairs.tolist():
+            if self.components.union(first, second):
+                # Splice the two circular member lists into one
+                next_member[first], next_member[second] = next_member[second], next_member[first]
+
+        touched = np.concatenate([ids[known], new_ids])
+        # Barcodes without neighbors form their own group, which needs no re-evaluation
+        singletons = touched[next_member[touched] == touched]
+        self.columns['component'].values[singletons] = singletons
+        self.columns['group'].values[singletons] = singletons
+        self.dirty.append(singletons)
+        touched = touched[next_member[touched] != touched]
+        roots = np.unique([self.components.find(i) for i in touched.tolist()]).astype(np.int64)
+        num_evaluated = len(singletons)
+        for root in roots.tolist():
+            members = self._members(root)
+            self._evaluate_component(root, members)
+            self.dirty.append(members)
+            num_evaluated += len(members)
+
+        if batch is not None:
+            self.batches.append(batch)
+        summary = {'new_barcodes': len(new_ids), 'updated_barcodes': int(known.sum()),
+                   'skipped_barcodes': int(len(barcodes) - packable.sum()), 'new_edges': len(pairs),
+                   'affected_components': len(singletons) + len(roots), 'reevaluated_barcodes': num_evaluated}
+        for name, value in summary.items():
+            metrics.count(f'cluster_index.{name}', value)
+        if save:
+            self.save()
+        return summary
+
+    def save(self):
+        """
+        Write the changes since the last save without touching the data index.json refers to: new barcodes are
+        appended to the column files, the new values of changed barcodes are written to a new journal file (or, once
+        the journals hold half as many rows as the index, every changed column to new files), and new runs are written.
+        Replacing index.json then switches in all of them at once; replaced files and merged runs are removed last.
+        """
+        size = len(self)
+        dirty = np.unique(np.concatenate(self.dirty)) if self.dirty else np.zeros(0, dtype=np.int64)
+        dirty = dirty[dirty < self.saved_size]
+        column_files = dict(self.column_files)
+        journals = list(self.journals)
+        removed_files = list(self.removed_runs)
+
+        rewrite = len(dirty) and sum(num_rows for _, num_rows in journals) + len(dirty) >= self.saved_size // 2
+        for name, column in self.columns.items():
+            if rewrite and name in MUTABLE_COLUMNS:
+                column_files[name] = f'{name}{self.next_file_number}.bin'
+                removed_files.append(self.column_files[name])
+                column.values.tofile(os.path.join(self.index_directory, column_files[name]))
+                continue
+            with open(os.path.join(self.index_directory, column_files[name]), 'a+b') as f:
+                f.truncate(self.saved_size * column.values.itemsize)  # Drop anything left by an interrupted save
+                f.write(column.values[self.saved_size:].tobytes())
+        if rewrite:
+            removed_files += [name for name, _ in journals]
+            journals = []
+        elif len(dirty):
+            journal = f'journal{self.next_file_number}.npz'
+            np.savez(os.path.join(self.index_directory, journal), ids=dirty,
+                     **{name: self.columns[name].values[dirty] for name in MUTABLE_COLUMNS})
+            journals.append([journal, len(dirty)])
+        next_file_number = self.next_file_number + 1 if len(dirty) else self.next_file_number
+
+        for run in self.runs:
+            if run.name is None:
+                run.name = f'run{self.next_run_number}.npz'
+                self.next_run_number += 1
+                run.save(os.path.join(self.index_directory, run.name))
+
+        metadata = dict(self.parameters, format_version=CLUSTER_INDEX_VERSION, num_barcodes=size,
+                        runs=[run.name for run in self.runs], batches=self.batches, next_run_number=self.next_run_number,
+                        column_files=column_files, journals=journals, next_file_number=next_file_number)
+        file_descriptor, temp_file = tempfile.mkstemp(suffix='.tmp', dir=self.index_directory)
+        with os.fdopen(file_descriptor, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(temp_file, os.path.join(self.index_directory, METADATA_FILE))
+
+        for name in removed_files:
+            os.remove(os.path.join(self.index_directory, name))
+        self.column_files = column_files
+        self.journals = journals
+        self.next_file_number = next_file_number
+        self.removed_runs = []
+        self.dirty = []
+        self.saved_size = size
+
+    def barcode_counts(self):
+        """
+        Return every indexed barcode with its total count.
+
+        :return: dict, mapping of each barcode to its count
+        """
+        return dict(zip(decode_barcodes(self.columns['packed'].values, self.barcode_length), self.columns['counts'].values.tolist()))
+
+    def true_barcodes(self):
+        """
+        Return the true barcode of every group, in order of their index.
+
+        :return: list of str, true underlying barcodes
+        """
+        return decode_barcodes(self.columns['packed'].values[np.unique(self.columns['group'].values)], self.barcode_length)
+
+    def assignments(self):
+        """
+        Return every indexed barcode with the true barcode of its group, in the form of
+        MAPseqBarcodeAnalysis.cluster_barcodes (e.g. for projection_matrix.ProjectionMatrixBuilder).
+
+        :return: tuple (barcode_io.PackedBarcodeCounts, np.ndarray of int64, list of str), indexed barcodes with their
+                 counts, index of the true barcode of each barcode, and true barcodes
+        """
+        representatives, labels = np.unique(self.columns['group'].values, return_inverse=True)
+        packed = self.columns['packed'].values
+        return (PackedBarcodeCounts(packed, self.columns['counts'].values, {}, self.barcode_length),
+                labels.reshape(-1).astype(np.int64), decode_barcodes(packed[representatives], self.barcode_length))
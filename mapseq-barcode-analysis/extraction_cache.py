@@ -0,0 +1,148 @@
+"""
+THIS SCRIPT KEEPS A PERSISTENT ON-DISK CACHE OF THE BARCODE COUNT TABLES EXTRACTED FROM FASTQ FILES.
+
+Each entry is a binary barcode table of packed barcodes and read counts (see barcode_io.py), whose file name is a hash
+of the FASTQ file's identity and the extraction parameters; the few barcodes that cannot be packed are kept in its
+.json metadata file. The identity is the file's path, size and modification time, or with hash_contents=True the
+SHA-256 of its contents, which also finds the entry again after the file is moved or copied. A changed file or changed
+parameters give a different key, so stale entries are never returned; they are removed by the size limit, which
+evicts the least recently used entries first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from barcode_io import PackedBarcodeCounts, load_barcode_table, metadata_path, write_packed_barcode_table
+
+DEFAULT_CACHE_SIZE_LIMIT = 10 * 1024 ** 3  # 10 GB
+
+
+class ExtractionCache:
+    """
+    This class stores and retrieves per-file barcode count tables keyed on the input file and extractor parameters.
+    """
+
+    def __init__(self, cache_directory, size_limit=DEFAULT_CACHE_SIZE_LIMIT, hash_contents=False):
+        """
+        Initialize the cache and create its directory.
+
+        :param cache_directory: str, directory holding the cache entries
+        :param size_limit: int, maximum total size of the entries in bytes (default: 10 GB)
+        :param hash_contents: bool, set to True to identify files by the hash of their contents instead of their path,
+                              size and modification time (default: False)
+        """
+        self.cache_directory = cache_directory
+        self.size_limit = size_limit
+        self.hash_contents = hash_contents
+        self.content_hashes = {}  # (path, size, mtime) -> SHA-256, so that each file is hashed once per run
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def file_identity(self, fastq_file):
+        """
+        Describe a FASTQ file so that any change to it changes the description.
+
+        :param fastq_file: str, path to the FASTQ file
+        :return: dict, identity of the file
+        """
+        stat = os.stat(fastq_file)
+        identity = {'path': os.path.abspath(fastq_file), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if not self.hash_contents:
+            return identity
+
+        stat_key = tuple(identity.values())
+        if stat_key not in self.content_hashes:
+            sha256 = hashlib.sha256()
+            with open(fastq_file, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    sha256.update(block)
+            self.content_hashes[stat_key] = sha256.hexdigest()
+        return {'sha256': self.content_hashes[stat_key]}
+
+    def entry_path(self, fastq_file, parameters):
+        """
+        Return the path of the cache entry of a FASTQ file extracted with the given parameters.
+
+        :param fastq_file: str, path to the FASTQ file
+        :param parameters: dict, extraction parameters that affect the counts (JSON-serializable)
+        :return: str, path to the entry's .npy barcode table
+        """
+        key = json.dumps({'file': self.file_identity(fastq_file), 'parameters': parameters}, sort_keys=True)
+        return os.path.join(self.cache_directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def load(self, fastq_file, parameters):
+        """
+        Look up the barcode counts of a FASTQ file.
+
+        :param fastq_file: str, path to the FASTQ file
+        :param parameters: dict, extraction parameters that affect the counts
+        :return: barcode_io.PackedBarcodeCounts, read counts of the file, or None if the file is not in the cache
+        """
+        entry = self.entry_path(fastq_file, parameters)
+        try:
+            # Read into memory rather than memory-mapped, so that evicting the entry cannot affect the counts
+            packed, counts, metadata = load_barcode_table(entry, mmap=False)
+            os.utime(entry)  # Mark the entry as recently used
+        except FileNotFoundError:
+            return None
+        return PackedBarcodeCounts(packed, counts, metadata['other_barcodes'], metadata['barcode_length'])
+
+    def store(self, fastq_file, parameters, barcode_counts):
+        """
+        Add the barcode counts of a FASTQ file to the cache, then evict old entries beyond the size limit.
+
+        :param fastq_file: str, path to the FASTQ file
+        :param parameters: dict, extraction parameters that affect the counts
+        :param barcode_counts: barcode_io.PackedBarcodeCounts, read counts of the file
+        :return: str, path to the entry's .npy barcode table
+        """
+        entry = self.entry_path(fastq_file, parameters)
+        # Write to a temporary directory first so that concurrent readers never see a partial entry. The metadata is
+        # moved in first: a reader that finds it without the table treats the entry as missing.
+        temp_directory = tempfile.mkdtemp(suffix='.tmp', dir=self.cache_directory)
+        try:
+            temp_file = os.path.join(temp_directory, os.path.basename(entry))
+            write_packed_barcode_table(temp_file, barcode_counts.packed, barcode_counts.counts, barcode_counts.barcode_length,
+                                       {'other_barcodes': dict(barcode_counts.other_barcodes)},
+                                       num_skipped_barcodes=len(barcode_counts.other_barcodes),
+                                       skipped_count=sum(barcode_counts.other_barcodes.values()))
+            os.replace(metadata_path(temp_file), metadata_path(entry))
+            os.replace(temp_file, entry)
+        finally:
+            shutil.rmtree(temp_directory, ignore_errors=True)
+        self.prune()
+        return entry
+
+    def prune(self):
+        """
+        Remove the least recently used entries until the total size of the cache is within the size limit.
+
+        :return: int, number of entries removed
+        """
+        entries = []
+        for file_name in os.listdir(self.cache_directory):
+            if not file_name.endswith('.npy'):
+                continue
+            entry = os.path.join(self.cache_directory, file_name)
+            try:
+                stat = os.stat(entry)
+                size = stat.st_size + os.path.getsize(metadata_path(entry))
+            except FileNotFoundError:
+                continue  # Removed by another process
+            entries.append((stat.st_mtime_ns, size, entry))
+
+        total_size = sum(size for _, size, _ in entries)
+        num_removed = 0
+        for _, size, entry in sorted(entries):
+            if total_size <= self.size_limit:
+                break
+            # The table first, so that the entry is never found with its metadata missing
+            for file_path in (entry, metadata_path(entry)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+            total_size -= size
+            num_removed += 1
+        return num_removed
@@ -3,119 +3,617 @@ THIS SCRIPT PARSES FASTQ FILES AND EXTRACTS THE BARCODE SEQUENCES USING THE ANCH
 """
 
 import os
-import gzip
-from Bio import SeqIO
+import shutil
+import tempfile
+import numpy as np
+from collections import Counter, namedtuple
 from multiprocessing import Pool
+from anchor_matching import AnchorLocator
+from barcode_encoding import pack_ascii_matrix
+from extraction_cache import DEFAULT_CACHE_SIZE_LIMIT, ExtractionCache
+from instrumentation import collect_metrics, merge_task_results, metrics
+from barcode_io import (BARCODE_TABLE_DTYPE, PackedBarcodeCounts, merge_barcode_count_files, merge_packed_barcode_counts,
+                        read_packed_barcode_counts, sum_sorted_counts, write_barcode_counts, write_packed_barcode_table)
+from fastq_reader import DECOMPRESSION_METHODS, iter_fastq_batches, open_fastq, open_fastq_chunk, plan_fastq_chunks
+
+# Increase whenever a change to the extraction changes its results, so that cached results are not reused
+EXTRACTOR_VERSION = 2
+
+QUALITY_POLICIES = ('mean', 'min', 'expected_errors')
+
+# Error probability of each Phred quality score from 0 to 93, the range of Phred+33 quality characters
+ERROR_PROBABILITIES = 10.0 ** (-np.arange(94) / 10.0)
+
+BARCODE_LENGTH = 30  # Number of bases extracted in front of the anchor sequence
+
+# What an extraction worker returns for one FASTQ file: the path to a .npy file of its sorted packed unique barcodes and
+# their read counts (records of barcode_io.BARCODE_TABLE_DTYPE), their number, and a dict of the read counts of the
+# few barcodes that cannot be packed (e.g. containing 'N')
+ExtractionResult = namedtuple('ExtractionResult', ['packed_file', 'num_barcodes', 'other_barcodes'])
+
+# Extractor of the tasks run in this worker process, set once per process by init_extraction_worker
+_worker_extractor = None
+
+
+def init_extraction_worker(barcode_extractor):
+    """
+    Pool initializer of extraction worker processes: the extractor is sent to each process once instead of with
+    every task.
+
+    :param barcode_extractor: BarcodeExtractor, extractor used by extract_file_task
+    """
+    global _worker_extractor
+    _worker_extractor = barcode_extractor
+
+
+def extract_file_task(file_name, result_directory):
+    """
+    Count the barcodes of one FASTQ file in a worker process started with init_extraction_worker, and hand them back
+    as a file of packed barcodes and read counts rather than pickling a dictionary of strings.
+
+    :param file_name: str, name of the FASTQ file in the input directory
+    :param result_directory: str, directory for the packed barcode file
+    :return: ExtractionResult
+    """
+    packed, counts, other_barcodes = _worker_extractor.process_fastq_files_helper(file_name)[:3]
+    table = np.empty(len(packed), dtype=BARCODE_TABLE_DTYPE)
+    table['barcode'] = packed
+    table['count'] = counts
+    packed_file = os.path.join(result_directory, file_name + ".npy")
+    np.save(packed_file, table)
+    return ExtractionResult(packed_file, len(table), other_barcodes)
+
+
+def extract_chunk_task(chunk, result_file):
+    """
+    Count the barcodes of one chunk of a FASTQ file in a worker process started with init_extraction_worker, and hand
+    them back as a file of sorted packed barcodes and read counts.
+
+    :param chunk: fastq_reader.FastqChunk, the chunk to process
+    :param result_file: str, path to the .npy file of packed barcodes to write
+    :return: ExtractionResult
+    """
+    packed, counts, other_barcodes = _worker_extractor.extract_packed_chunk(chunk)
+    table = np.empty(len(packed), dtype=BARCODE_TABLE_DTYPE)
+    table['barcode'] = packed
+    table['count'] = counts
+    np.save(result_file, table)
+    return ExtractionResult(result_file, len(table), other_barcodes)
+
+
+def count_chunk_task(chunk, output_file):
+    """
+    Count the barcodes of one chunk of a FASTQ file in a worker process started with init_extraction_worker.
+
+    :param chunk: fastq_reader.FastqChunk, the chunk to process
+    :param output_file: str, path to the sorted barcode count table to write
+    :return: int, number of unique barcodes written
+    """
+    return _worker_extractor.count_barcodes_chunk(chunk, output_file)
+
+
+def merge_extraction_results(results):
+    """
+    Sum the read counts of each barcode over the files of several extraction results. The sorted table of each file
+    is read through its memory map and merged into the running totals one file at a time (see
+    barcode_io.merge_packed_barcode_counts); no barcode is turned into a string.
+
+    :param results: list of ExtractionResult, results of extract_file_task
+    :return: barcode_io.PackedBarcodeCounts, total read count of each barcode
+    """
+    def parts():
+        for result in results:
+            table = np.load(result.packed_file, mmap_mode='r') if result.num_barcodes else np.zeros(0, dtype=BARCODE_TABLE_DTYPE)
+            yield table['barcode'], table['count'], result.other_barcodes
+    return merge_packed_barcode_counts(parts(), BARCODE_LENGTH)
+
 
 class BarcodeExtractor:
     """
     This class provides methods for extracting barcodes from FASTQ files based on a given anchor sequence.
     """
 
-    def __init__(self, input_directory, output_directory, anchor_sequence='GTACTGCGGCCGCTACCTA', quality_threshold=30):
+    def __init__(self, input_directory, output_directory, anchor_sequence='GTACTGCGGCCGCTACCTA', quality_threshold=30,
+                 streaming=False, flush_threshold=1000000, num_processes=None, min_chunk_size=64 * 1024 * 1024,
+                 max_anchor_mismatches=0, output_format='text', cache_directory=None,
+                 cache_size_limit=DEFAULT_CACHE_SIZE_LIMIT, hash_cached_files=False, quality_policy='mean',
+                 max_expected_errors=1.0, decompression='auto'):
         """
         Initialize the BarcodeExtractor with the input and output directories, anchor sequence, and quality threshold.
         
         :param input_directory: str, path to the input directory containing FASTQ files
         :param output_directory: str, path to the output directory where extracted barcode files will be saved
         :param anchor_sequence: str, the anchor sequence used to identify and extract barcodes (default: 'GTACTGCGGCCGCTACCTA')
-        :param quality_threshold: int, the minimum average quality score for a barcode to be included (default: 30)
+        :param quality_threshold: int, the minimum average (or with quality_policy='min', minimum) quality score of the barcode
+                                  of a read for the read to be included (default: 30)
+        :param streaming: bool, set to True to count barcodes per file with bounded memory instead of collecting them (default: False)
+        :param flush_threshold: int, number of unique barcodes held in memory per file before counts are flushed to disk (default: 1000000)
+        :param num_processes: int, number of worker processes (default: None, use os.cpu_count())
+        :param min_chunk_size: int, minimum number of bytes per chunk when a file is split across workers (default: 64 MB)
+        :param max_anchor_mismatches: int, maximum number of mismatched bases allowed in the anchor sequence (default: 0)
+        :param output_format: str, 'text' for one barcode (or barcode and count) per line, or 'binary' for a memory-mappable
+                              <sample>_barcodes.npy table of packed barcodes and counts with a .json metadata file (default: 'text')
+        :param cache_directory: str, directory of a persistent cache of per-file extraction results; files found in the
+                                cache with the same extraction parameters are not parsed again (default: None, no cache)
+        :param cache_size_limit: int, maximum size of the cache in bytes; least recently used entries are evicted (default: 10 GB)
+        :param hash_cached_files: bool, set to True to identify cached files by the hash of their contents instead of their
+                                  path, size and modification time (default: False)
+        :param quality_policy: str, how the base qualities of each read's barcode are judged: 'mean' (average quality of at
+                               least quality_threshold), 'min' (every base at least quality_threshold) or 'expected_errors'
+                               (sum of the base error probabilities at most max_expected_errors) (default: 'mean')
+        :param max_expected_errors: float, maximum expected number of errors per barcode with quality_policy='expected_errors' (default: 1.0)
+        :param decompression: str, how gzipped FASTQ files are decompressed: 'thread' (zlib in a read-ahead thread that overlaps
+                              with parsing), 'pigz' (an external pigz -dc process), 'inline' (zlib in the parsing thread) or
+                              'auto' (pigz when it is on PATH, otherwise 'thread') (default: 'auto')
         """
+        if output_format not in ('text', 'binary'):
+            raise ValueError(f"Unknown output format: {output_format}")
+        if quality_policy not in QUALITY_POLICIES:
+            raise ValueError(f"Unknown quality policy: {quality_policy}")
+        if decompression not in DECOMPRESSION_METHODS:
+            raise ValueError(f"Unknown decompression method: {decompression}")
         self.input_directory = input_directory
         self.output_directory = output_directory
         self.anchor_sequence = anchor_sequence
         self.quality_threshold = quality_threshold
+        self.streaming = streaming
+        self.flush_threshold = flush_threshold
+        self.num_processes = num_processes or os.cpu_count() or 1
+        self.min_chunk_size = min_chunk_size
+        self.anchor_locator = AnchorLocator(anchor_sequence, max_anchor_mismatches)
+        self.output_format = output_format
+        self.max_anchor_mismatches = max_anchor_mismatches
+        self.quality_policy = quality_policy
+        self.max_expected_errors = max_expected_errors
+        self.decompression = decompression
+        self.sample_files = []  # Per-sample read count outputs written by this extractor (see sample_count_file)
+        self.cache = ExtractionCache(cache_directory, cache_size_limit, hash_cached_files) if cache_directory else None
+
+    def cache_parameters(self, counts):
+        """
+        Describe the extraction parameters that affect the cached results.
+
+        :param counts: str, 'reads' for read counts or 'unique' for the unique barcodes of a file
+        :return: dict, extraction parameters
+        """
+        return {
+            'anchor_sequence': self.anchor_sequence,
+            'quality_threshold': self.quality_threshold,
+            'max_anchor_mismatches': self.max_anchor_mismatches,
+            'quality_policy': self.quality_policy,
+            'max_expected_errors': self.max_expected_errors,
+            'extractor_version': EXTRACTOR_VERSION,
+            'counts': counts,
+        }
 
     def get_average_quality(self, qualities):
         """
         Calculate the average quality score for a list of quality scores.
         
-        :param qualities: list of int, quality scores for each base in a barcode
+        :param qualities: list or np.ndarray of int, quality scores for each base in a barcode
         :return: float, average quality score
         """
-        return sum(qualities) / len(qualities)
+        return float(np.mean(qualities))
+
+    def passes_quality(self, quality_scores):
+        """
+        Apply the quality policy to the barcodes of many reads at once.
+
+        :param quality_scores: np.ndarray of int, one row of Phred quality scores per barcode
+        :return: np.ndarray of bool, whether each barcode passes the quality policy
+        """
+        if self.quality_policy == 'mean':
+            return quality_scores.mean(axis=1) >= self.quality_threshold
+        if self.quality_policy == 'min':
+            return quality_scores.min(axis=1) >= self.quality_threshold
+        return ERROR_PROBABILITIES[np.clip(quality_scores, 0, 93)].sum(axis=1) <= self.max_expected_errors
 
     def filter_barcodes(self, barcode_qualities):
         """
-        Filter barcodes based on their average quality scores.
+        Filter barcodes based on their quality scores, using the quality policy.
         
         :param barcode_qualities: dict, a dictionary mapping barcodes to their list of quality scores
         :return: list of str, filtered barcodes that meet the quality threshold
         """
         return [barcode for barcode, qualities in barcode_qualities.items()
-                if self.get_average_quality(qualities) >= self.quality_threshold]
+                if self.passes_quality(np.asarray(qualities).reshape(1, -1))[0]]
 
     def extract_barcodes(self, fastq_file, is_gzipped=True): #Modify depending on use case
         """
-        Extract barcodes from a FASTQ file using the anchor sequence.
+        Extract barcodes from a FASTQ file using the anchor sequence. A barcode is kept if at least one of its reads
+        passes the quality policy.
         
         :param fastq_file: str, path to the FASTQ file to be processed
         :param is_gzipped: bool, set to True if the file is compressed with gzip
-        :return: list of str, extracted and filtered barcodes
+        :return: list of str, unique extracted and filtered barcodes, in order of first appearance
+        """
+        return list(self.extract_barcode_counts(fastq_file, is_gzipped))
+
+    def extract_barcode_counts(self, fastq_file, is_gzipped=True):
+        """
+        Count the reads of each barcode of a FASTQ file that pass the quality policy.
+
+        :param fastq_file: str, path to the FASTQ file to be processed
+        :param is_gzipped: bool, set to True if the file is compressed with gzip
+        :return: dict, mapping of each barcode to its read count, in order of first appearance
+        """
+        barcode_counts = Counter()
+        with open_fastq(fastq_file, is_gzipped, self.decompression) as f:
+            for barcodes in self.iter_filtered_barcodes(f):
+                barcode_counts.update(barcodes)
+        return {barcode.decode('ascii'): count for barcode, count in barcode_counts.items()}
+
+    def extract_packed_barcode_counts(self, fastq_file, is_gzipped=True):
+        """
+        Count the reads of each barcode of a FASTQ file that pass the quality policy. The barcodes of each chunk of
+        reads are packed straight from their bytes and counted as integers; only the barcodes that cannot be packed
+        (e.g. containing 'N') are counted as strings. The counts of the chunks are folded together whenever the
+        pending chunks hold twice as many rows as the folded counts (and at least 2 * flush_threshold).
+
+        :param fastq_file: str, path to the FASTQ file to be processed
+        :param is_gzipped: bool, set to True if the file is compressed with gzip
+        :return: tuple (np.ndarray of uint64, np.ndarray of uint64, dict), sorted unique packed barcodes, their read
+                 counts, and the read counts of the barcodes that cannot be packed
+        """
+        with open_fastq(fastq_file, is_gzipped, self.decompression) as f:
+            return self.extract_packed_barcode_counts_from_stream(f)
+
+    def extract_packed_chunk(self, chunk):
+        """
+        Count the reads of each barcode of one chunk of a FASTQ file, packed (see extract_packed_barcode_counts).
+
+        :param chunk: fastq_reader.FastqChunk, the chunk to process
+        :return: tuple (np.ndarray of uint64, np.ndarray of uint64, dict), sorted unique packed barcodes, their read
+                 counts, and the read counts of the barcodes that cannot be packed
+        """
+        stream, skip_first_line = open_fastq_chunk(chunk, self.decompression)
+        with stream, metrics.timer('extraction.chunks'):
+            return self.extract_packed_barcode_counts_from_stream(stream, skip_first_line)
+
+    def extract_packed_barcode_counts_from_stream(self, stream, skip_first_line=False):
+        """
+        Count the reads of each barcode of a FASTQ stream, packed (see extract_packed_barcode_counts).
+
+        :param stream: binary file object of a FASTQ file
+        :param skip_first_line: bool, set to True for streams starting in the middle of a file (see fastq_reader.iter_fastq_batches)
+        :return: tuple (np.ndarray of uint64, np.ndarray of uint64, dict), sorted unique packed barcodes, their read
+                 counts, and the read counts of the barcodes that cannot be packed
+        """
+        packed_blocks, count_blocks = [np.zeros(0, dtype=np.uint64)], [np.zeros(0, dtype=np.uint64)]
+        pending_rows = 0
+        other_barcodes = Counter()
+        for barcodes in self.iter_filtered_barcodes(stream, skip_first_line):
+            packed, valid = pack_ascii_matrix(np.frombuffer(b''.join(barcodes), dtype=np.uint8).reshape(-1, BARCODE_LENGTH))
+            unique_packed, counts = np.unique(packed[valid], return_counts=True)
+            packed_blocks.append(unique_packed)
+            count_blocks.append(counts.astype(np.uint64))
+            pending_rows += len(unique_packed)
+            if not valid.all():
+                other_barcodes.update(barcodes[i].decode('ascii') for i in np.flatnonzero(~valid))
+            if pending_rows >= 2 * max(len(packed_blocks[0]), self.flush_threshold):
+                packed_blocks, count_blocks = self._fold_packed_counts(packed_blocks, count_blocks)
+                pending_rows = 0
+        packed_blocks, count_blocks = self._fold_packed_counts(packed_blocks, count_blocks)
+        return packed_blocks[0], count_blocks[0], dict(other_barcodes)
+
+    @staticmethod
+    def _fold_packed_counts(packed_blocks, count_blocks):
+        packed = np.concatenate(packed_blocks)
+        order = np.argsort(packed, kind='stable')
+        packed, counts = sum_sorted_counts(packed[order], np.concatenate(count_blocks)[order])
+        return [packed], [counts]
+
+    def iter_filtered_barcodes(self, stream, skip_first_line=False):
+        """
+        Extract the barcodes of every read of a FASTQ stream that pass the quality policy, one chunk of reads at a time.
+        Each read is filtered on the qualities of its own barcode window, for all reads of the chunk at once.
+
+        :param stream: binary file object of a FASTQ file
+        :param skip_first_line: bool, set to True for streams starting in the middle of a file (see fastq_reader.iter_fastq_batches)
+        :return: generator of list of bytes, barcodes of the reads of each chunk that pass the quality policy
+        """
+        anchor = self.anchor_sequence.encode('ascii')
+        find_approximate = self.anchor_locator.find_approximate if self.anchor_locator.max_mismatches else None
+        for sequences, qualities in iter_fastq_batches(stream, skip_first_line=skip_first_line):
+            barcodes, barcode_qualities = [], []
+            for sequence, quality in zip(sequences, qualities):
+                barcode_start = sequence.find(anchor)
+                if barcode_start < 0 and find_approximate:
+                    barcode_start = find_approximate(sequence)
+                if barcode_start >= BARCODE_LENGTH:
+                    barcodes.append(sequence[barcode_start-BARCODE_LENGTH:barcode_start])
+                    barcode_qualities.append(quality[barcode_start-BARCODE_LENGTH:barcode_start])
+            metrics.count('extraction.reads', len(sequences))
+            metrics.count('extraction.anchor_hits', len(barcodes))
+            if not barcodes:
+                continue
+
+            # Decode the Phred+33 qualities of the barcode windows only, all at once
+            quality_scores = np.frombuffer(b''.join(barcode_qualities), dtype=np.uint8).reshape(-1, BARCODE_LENGTH).astype(np.int16) - 33
+            passes = self.passes_quality(quality_scores)
+            passing_barcodes = [barcode for barcode, barcode_passes in zip(barcodes, passes) if barcode_passes]
+            metrics.count('extraction.quality_rejects', len(barcodes) - len(passing_barcodes))
+            yield passing_barcodes
+
+    def count_barcodes(self, fastq_file, output_file, is_gzipped=True):
+        """
+        Count the barcodes of a FASTQ file with bounded memory and write them to a sorted count table.
+
+        :param fastq_file: str, path to the FASTQ file to be processed
+        :param output_file: str, path to the sorted barcode count table to write
+        :param is_gzipped: bool, set to True if the file is compressed with gzip
+        :return: int, number of unique barcodes written
+        """
+        with open_fastq(fastq_file, is_gzipped, self.decompression) as f:
+            return self.count_barcodes_from_stream(f, output_file)
+
+    def count_barcodes_chunk(self, chunk, output_file):
+        """
+        Count the barcodes of the reads starting within one chunk of a FASTQ file.
+
+        :param chunk: fastq_reader.FastqChunk, the chunk to process
+        :param output_file: str, path to the sorted barcode count table to write
+        :return: int, number of unique barcodes written
+        """
+        stream, skip_first_line = open_fastq_chunk(chunk, self.decompression)
+        with stream, metrics.timer('extraction.chunks'):
+            return self.count_barcodes_from_stream(stream, output_file, skip_first_line)
+
+    def count_barcodes_from_stream(self, stream, output_file, skip_first_line=False):
+        """
+        Count the barcodes of a FASTQ stream with bounded memory. Counts are aggregated in memory and flushed to sorted
+        spill files whenever more than flush_threshold unique barcodes are held; the spill files are merged at the end.
+
+        :param stream: binary file object of a FASTQ file
+        :param output_file: str, path to the sorted barcode count table to write
+        :param skip_first_line: bool, set to True for streams starting in the middle of a file (see fastq_reader.iter_fastq_batches)
+        :return: int, number of unique barcodes written
+        """
+        barcode_counts = Counter()
+        spill_files = []
+        spill_directory = None
+
+        try:
+            for barcodes in self.iter_filtered_barcodes(stream, skip_first_line):
+                barcode_counts.update(barcodes)
+                if len(barcode_counts) >= self.flush_threshold:
+                    if spill_directory is None:
+                        spill_directory = tempfile.mkdtemp(prefix="barcode_counts_", dir=os.path.dirname(output_file) or ".")
+                    spill_file = os.path.join(spill_directory, f"spill{len(spill_files)}.tsv")
+                    write_barcode_counts(spill_file, barcode_counts)
+                    spill_files.append(spill_file)
+                    barcode_counts = Counter()
+
+            if not spill_files:
+                return write_barcode_counts(output_file, barcode_counts)
+
+            spill_file = os.path.join(spill_directory, f"spill{len(spill_files)}.tsv")
+            write_barcode_counts(spill_file, barcode_counts)
+            spill_files.append(spill_file)
+            return merge_barcode_count_files(spill_files, output_file)
+        finally:
+            if spill_directory is not None:
+                shutil.rmtree(spill_directory, ignore_errors=True)
+
+    def count_fastq_files(self, fastq_files):
+        """
+        Count the barcodes of several FASTQ files, splitting large files into chunks that are processed in parallel.
+        Each chunk writes its own count table; the tables of each file are merged into <sample>_barcode_counts.tsv.
+
+        :param fastq_files: list of str, names of the FASTQ files in the input directory
+        :return: barcode_io.PackedBarcodeCounts, total read count of each barcode over all files
+        """
+        chunk_directory = tempfile.mkdtemp(prefix="barcode_chunks_", dir=self.output_directory)
+        try:
+            tasks, chunk_files, cached_counts = self.plan_chunk_tasks(fastq_files, chunk_directory, ".tsv")
+            if tasks:
+                # The extractor is sent to each worker process once, not pickled with every chunk task
+                with Pool(min(self.num_processes, len(tasks)), initializer=init_extraction_worker, initargs=(self,)) as pool:
+                    merge_task_results(pool.starmap(collect_metrics, [(count_chunk_task, *task) for task in tasks]))
+
+            # Merge the per-chunk count tables; memory is bounded by the number of unique barcodes
+            def file_counts():
+                for file_name in fastq_files:
+                    if file_name in cached_counts:
+                        barcode_counts = cached_counts.pop(file_name)
+                        self.write_packed_sample_counts(file_name, barcode_counts)
+                    else:
+                        barcode_counts = self.write_sample_counts(file_name, chunk_files[file_name], chunk_directory)
+                        if self.cache:
+                            self.cache.store(os.path.join(self.input_directory, file_name), self.cache_parameters('reads'), barcode_counts)
+                    metrics.count('extraction.files')
+                    metrics.count('extraction.unique_barcodes', barcode_counts.num_barcodes)
+                    self.sample_files.append(self.sample_count_file(file_name))
+                    yield barcode_counts
+            return merge_packed_barcode_counts(file_counts(), BARCODE_LENGTH)
+        finally:
+            shutil.rmtree(chunk_directory, ignore_errors=True)
+
+    def plan_chunk_tasks(self, fastq_files, chunk_directory, suffix):
         """
-        barcodes = []
+        Split the FASTQ files that are not in the cache into chunks of at least min_chunk_size bytes, up to one chunk
+        per worker process and file, each with its own result file.
 
-        with (gzip.open(fastq_file, 'rt') if is_gzipped else open(fastq_file, 'rt')) as f:
-            for record in SeqIO.parse(f, 'fastq'):
-                sequence = str(record.seq)
-                barcode_start = sequence.find(self.anchor_sequence)
+        :param fastq_files: list of str, names of the FASTQ files in the input directory
+        :param chunk_directory: str, directory of the result files of the chunks
+        :param suffix: str, extension of the result files, e.g. '.tsv'
+        :return: tuple (list of (fastq_reader.FastqChunk, str), dict, dict), chunks with the paths of their result files,
+                 result files of each file name, and read counts (barcode_io.PackedBarcodeCounts) of the cached files
+        """
+        tasks = []
+        chunk_files = {}
+        cached_counts = {}
+        for file_name in fastq_files:
+            input_file = os.path.join(self.input_directory, file_name)
+            barcode_counts = self.cache.load(input_file, self.cache_parameters('reads')) if self.cache else None
+            if barcode_counts is not None:
+                metrics.count('extraction.cache_hits')
+                cached_counts[file_name] = barcode_counts
+                continue
+            num_chunks = max(1, min(self.num_processes, -(-os.path.getsize(input_file) // self.min_chunk_size)))
+            chunk_files[file_name] = []
+            for chunk in plan_fastq_chunks(input_file, num_chunks):
+                chunk_file = os.path.join(chunk_directory, f"{len(tasks)}{suffix}")
+                tasks.append((chunk, chunk_file))
+                chunk_files[file_name].append(chunk_file)
+        return tasks, chunk_files, cached_counts
+
+    def write_sample_counts(self, file_name, count_files, work_directory):
+        """
+        Merge the count tables of one FASTQ file into its output, <sample>_barcode_counts.tsv or in binary output
+        format <sample>_barcodes.npy.
+
+        :param file_name: str, name of the FASTQ file the counts were extracted from
+        :param count_files: list of str, paths to sorted count tables of the file
+        :param work_directory: str, directory for the merged table in binary output format
+        :return: barcode_io.PackedBarcodeCounts, read counts of the file
+        """
+        if self.output_format == 'binary':
+            merged_file = os.path.join(work_directory, file_name.split(".")[0] + "_barcode_counts.tsv")
+            merge_barcode_count_files(count_files, merged_file)
+            barcode_counts = read_packed_barcode_counts(merged_file, BARCODE_LENGTH)
+            self.write_packed_binary_output(file_name, barcode_counts.packed, barcode_counts.counts, barcode_counts.other_barcodes)
+        else:
+            output_file = self.sample_count_file(file_name)
+            merge_barcode_count_files(count_files, output_file)
+            barcode_counts = read_packed_barcode_counts(output_file, BARCODE_LENGTH)
+        return barcode_counts
+
+    def write_packed_sample_counts(self, file_name, barcode_counts):
+        """
+        Write the read counts of one FASTQ file to its output, <sample>_barcode_counts.tsv or in binary output format
+        <sample>_barcodes.npy straight from the packed barcodes.
+
+        :param file_name: str, name of the FASTQ file the counts were extracted from
+        :param barcode_counts: barcode_io.PackedBarcodeCounts, read counts of the file
+        :return: str, path to the output file
+        """
+        if self.output_format == 'binary':
+            return self.write_packed_binary_output(file_name, barcode_counts.packed, barcode_counts.counts,
+                                                   barcode_counts.other_barcodes)
+        output_file = self.sample_count_file(file_name)
+        write_barcode_counts(output_file, barcode_counts.to_counter())
+        return output_file
+
+    def sample_count_file(self, file_name):
+        """
+        Return the path of the per-sample read count output of a FASTQ file: <sample>_barcode_counts.tsv, or in binary
+        output format <sample>_barcodes.npy. Every extraction mode writes it.
+
+        :param file_name: str, name of the FASTQ file
+        :return: str, path to the output file
+        """
+        suffix = "_barcodes.npy" if self.output_format == 'binary' else "_barcode_counts.tsv"
+        return os.path.join(self.output_directory, file_name.split(".")[0] + suffix)
+
+    def write_packed_binary_output(self, file_name, packed, counts, other_barcodes):
+        """
+        Write the packed barcodes of a FASTQ file and their read counts as a binary barcode table, <sample>_barcodes.npy
+        with a .json metadata file. The barcodes that cannot be packed are only counted in the metadata.
+
+        :param file_name: str, name of the FASTQ file the barcodes were extracted from
+        :param packed: np.ndarray of uint64, unique packed barcodes
+        :param counts: np.ndarray of uint64, read count of each barcode
+        :param other_barcodes: dict, read counts of the barcodes that cannot be packed
+        :return: str, path to the .npy file
+        """
+        output_file = os.path.join(self.output_directory, file_name.split(".")[0] + "_barcodes.npy")
+        write_packed_barcode_table(output_file, packed, counts, BARCODE_LENGTH, self.binary_output_metadata(file_name, True),
+                                   num_skipped_barcodes=len(other_barcodes), skipped_count=sum(other_barcodes.values()))
+        return output_file
 
-                if barcode_start >= 30:
-                    barcode = sequence[barcode_start-30:barcode_start]
-                    barcode_qualities = record.letter_annotations['phred_quality'][barcode_start-30:barcode_start]
-                    barcodes.append((barcode, barcode_qualities))
+    def binary_output_metadata(self, file_name, read_counts=True):
+        """
+        Describe the binary barcode table of a FASTQ file.
 
-        filtered_barcodes = self.filter_barcodes({barcode: qualities for barcode, qualities in barcodes})
-        return filtered_barcodes
+        :param file_name: str, name of the FASTQ file the barcodes were extracted from
+        :param read_counts: bool, whether the table holds read counts rather than a count of 1 per barcode
+        :return: dict, metadata of the table
+        """
+        return {
+            'sample': file_name.split(".")[0],
+            'source_file': file_name,
+            'anchor_sequence': self.anchor_sequence,
+            'quality_threshold': self.quality_threshold,
+            'quality_policy': self.quality_policy,
+            'counts': 'reads' if read_counts else 'unique',
+        }
 
     def process_fastq_files_helper(self, file_name):
         """
-        Helper function to process a single FASTQ file.
+        Helper function to process a single FASTQ file. Writes the read counts of its barcodes (see sample_count_file)
+        and, in text output format, the list of its unique barcodes to <sample>_barcodes.txt.
+
+        :return: barcode_io.PackedBarcodeCounts, read counts of the file, with the packed barcodes sorted
         """
         input_file = os.path.join(self.input_directory, file_name)
-        output_file = os.path.join(self.output_directory, file_name.split(".")[0] + "_barcodes.txt")
+        with metrics.timer(f'extraction.file.{file_name}'):
+            barcode_counts = self.cache.load(input_file, self.cache_parameters('reads')) if self.cache else None
+            if barcode_counts is not None:
+                metrics.count('extraction.cache_hits')
+            else:
+                # Read compressed or uncompressed files as appropriate
+                barcode_counts = PackedBarcodeCounts(*self.extract_packed_barcode_counts(input_file, file_name.endswith(".gz")),
+                                                     BARCODE_LENGTH)
+                if self.cache:
+                    self.cache.store(input_file, self.cache_parameters('reads'), barcode_counts)
+        self.write_extracted_sample(file_name, barcode_counts)
+        return barcode_counts
 
-        # Read compressed or uncompressed files as appropriate
-        if file_name.endswith(".gz"):
-            barcodes = self.extract_barcodes(input_file, True)
-        else:
-            barcodes = self.extract_barcodes(input_file, False)
-        with open(output_file, "w") as f:
-            for barcode in barcodes:
-                f.write(barcode + "\n")
-                
-        return barcodes
+    def write_extracted_sample(self, file_name, barcode_counts):
+        """
+        Write the outputs of one FASTQ file extracted in memory: its read counts (see sample_count_file) and, in text
+        output format, the list of its unique barcodes to <sample>_barcodes.txt.
+
+        :param file_name: str, name of the FASTQ file the counts were extracted from
+        :param barcode_counts: barcode_io.PackedBarcodeCounts, read counts of the file
+        """
+        metrics.count('extraction.files')
+        metrics.count('extraction.unique_barcodes', barcode_counts.num_barcodes)
+        self.write_packed_sample_counts(file_name, barcode_counts)
+        if self.output_format != 'binary':
+            with open(os.path.join(self.output_directory, file_name.split(".")[0] + "_barcodes.txt"), "w") as f:
+                for barcode in barcode_counts.barcodes():
+                    f.write(barcode + "\n")
 
     def process_fastq_files(self):
         """
         Process all FASTQ files in the input directory, extracting barcodes and saving them to the output directory.
+        The per-sample read count files written are listed in sample_files.
+
+        :return: barcode_io.PackedBarcodeCounts, total read count of each barcode over all files
         """
         if not os.path.exists(self.output_directory):
             os.makedirs(self.output_directory)
 
-        all_barcodes = []  # Initializing empty list for all_barcodes
+        fastq_files = sorted(file_name for file_name in os.listdir(self.input_directory) if file_name.endswith(".fastq") or file_name.endswith(".fastq.gz"))
+        self.sample_files = []
 
-        fastq_files = [file_name for file_name in os.listdir(self.input_directory) if file_name.endswith(".fastq") or file_name.endswith(".fastq.gz")]
-        
-        num_processes= 10 #This number can be changed based on available computational resources. 
-        
-        with Pool(num_processes) as pool:
-            all_barcodes_list = pool.map(self.process_fastq_files_helper, fastq_files)
+        if self.streaming:
+            return self.count_fastq_files(fastq_files)
 
-       # Flatten the list of lists into a single list
-        all_barcodes = [barcode for sublist in all_barcodes_list for barcode in sublist]
-        
-        ''' To profile the code: uncomment the following'''
-# Uncomment the following lines to profile the code
-# import cProfile, pstats
-# profile = cProfile.Profile()
-# profile.enable()
-# main()
-# profile.disable()
-# with open("profile_stats.txt", "w") as f:
-#     ps = pstats.Stats(profile, stream=f).sort_stats("cumulative")
-#     ps.print_stats()
-
-        return all_barcodes
-                
-       
+        # Large files are split into chunks as in streaming mode. Workers write the packed barcodes of each chunk to
+        # memory-mappable files and return only the paths; the chunks of each file are then merged in memory.
+        result_directory = tempfile.mkdtemp(prefix="barcode_results_", dir=self.output_directory)
+        try:
+            tasks, chunk_files, cached_counts = self.plan_chunk_tasks(fastq_files, result_directory, ".npy")
+            results = {}
+            if tasks:
+                with Pool(min(self.num_processes, len(tasks)), initializer=init_extraction_worker, initargs=(self,)) as pool:
+                    task_results = merge_task_results(pool.starmap(collect_metrics, [(extract_chunk_task, *task) for task in tasks]))
+                results = {result.packed_file: result for result in task_results}
+
+            def file_counts():
+                for file_name in fastq_files:
+                    if file_name in cached_counts:
+                        barcode_counts = cached_counts.pop(file_name)
+                    else:
+                        barcode_counts = merge_extraction_results([results[chunk_file] for chunk_file in chunk_files[file_name]])
+                        if self.cache:
+                            self.cache.store(os.path.join(self.input_directory, file_name), self.cache_parameters('reads'), barcode_counts)
+                    self.write_extracted_sample(file_name, barcode_counts)
+                    self.sample_files.append(self.sample_count_file(file_name))
+                    yield barcode_counts
+            return merge_packed_barcode_counts(file_counts(), BARCODE_LENGTH)
+        finally:
+            shutil.rmtree(result_directory, ignore_errors=True)
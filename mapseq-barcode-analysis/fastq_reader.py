@@ -0,0 +1,487 @@
+"""
+THIS SCRIPT READS FASTQ RECORDS AS RAW BYTES, WITHOUT BUILDING A BIOPYTHON SeqRecord PER READ.
+
+The file is read in large binary chunks that are split into lines in one call, and each record is returned as its
+sequence and quality lines. Records must use the standard four-line layout (no wrapped sequence lines), as written
+by Illumina instruments and fastq-dump.
+
+Gzipped files are decompressed ahead of the parser: a background thread fills a bounded queue of large byte buffers
+(zlib releases the GIL, so inflating overlaps with parsing), optionally reading the output of an external parallel
+decompressor such as pigz. Everything stays in bytes; nothing is decoded to text.
+"""
+
+import gzip
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import zlib
+from bisect import bisect_left
+from collections import namedtuple
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # 8 MB
+
+# A byte range of a FASTQ file processed by one worker; compression is None, 'bgzf' or 'gzip'
+FastqChunk = namedtuple('FastqChunk', ['fastq_file', 'start', 'end', 'compression'])
+
+# How gzipped input is decompressed: 'auto' (pigz when it is on PATH, otherwise 'thread'), 'thread' (zlib in a
+# read-ahead thread), 'pigz' (an external pigz -dc process, read ahead) or 'inline' (zlib in the parsing thread)
+DECOMPRESSION_METHODS = ('auto', 'thread', 'pigz', 'inline')
+
+READ_AHEAD_BUFFERS = 2  # Decompressed buffers queued ahead of the parser, in addition to the one being filled
+
+
+def decompression_method(decompression):
+    """
+    Resolve a decompression method to the one that will be used.
+
+    :param decompression: str, one of DECOMPRESSION_METHODS
+    :return: str, 'thread', 'pigz' or 'inline'
+    """
+    if decompression not in DECOMPRESSION_METHODS:
+        raise ValueError(f"Unknown decompression method: {decompression}")
+    if decompression == 'auto':
+        return 'pigz' if shutil.which('pigz') else 'thread'
+    if decompression == 'pigz' and not shutil.which('pigz'):
+        raise ValueError("pigz was not found on PATH; use decompression='auto' to fall back to 'thread'.")
+    return decompression
+
+
+def open_fastq(fastq_file, is_gzipped=None, decompression='auto'):
+    """
+    Open a FASTQ file for binary reading.
+
+    :param fastq_file: str, path to the FASTQ file
+    :param is_gzipped: bool, set to True if the file is compressed with gzip (default: None, decide from the file extension)
+    :param decompression: str, how a gzipped file is decompressed, one of DECOMPRESSION_METHODS (default: 'auto')
+    :return: binary file object
+    """
+    if is_gzipped is None:
+        is_gzipped = fastq_file.endswith(".gz")
+    if not is_gzipped:
+        return open(fastq_file, 'rb')
+    method = decompression_method(decompression)
+    if method == 'pigz':
+        return ReadAheadReader(DecompressorProcess(['pigz', '-dc', fastq_file]))
+    if method == 'thread':
+        return ReadAheadReader(gzip.open(fastq_file, 'rb'))
+    return gzip.open(fastq_file, 'rb')
+
+
+class ReadAheadReader:
+    """
+    This class reads a binary stream in a background thread into a bounded queue of large buffers, so that reading
+    and decompressing the next buffers overlaps with parsing the current one.
+
+    Other attributes, e.g. primary_length of a GzipMemberReader, are those of the wrapped stream.
+    """
+
+    def __init__(self, stream, buffer_size=DEFAULT_CHUNK_SIZE, max_buffers=READ_AHEAD_BUFFERS):
+        """
+        :param stream: binary file object to read from; it is closed with this reader
+        :param buffer_size: int, number of bytes read from the stream at a time (default: 8 MB)
+        :param max_buffers: int, maximum number of buffers waiting to be read (default: READ_AHEAD_BUFFERS)
+        """
+        self.stream = stream
+        self.buffers = queue.Queue(max_buffers)
+        self.stopped = threading.Event()
+        self.current = b''
+        self.position = 0  # Offset of the unread part of current
+        self.finished = False
+        self.thread = threading.Thread(target=self._read_ahead, args=(buffer_size,), daemon=True)
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def _read_ahead(self, buffer_size):
+        try:
+            while not self.stopped.is_set():
+                data = self.stream.read(buffer_size)
+                self._put(data)
+                if not data:
+                    return
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        # Wait for room in the queue, but give up once the reader is closed
+        while not self.stopped.is_set():
+            try:
+                self.buffers.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _next_buffer(self):
+        if self.finished:
+            return False
+        item = self.buffers.get()
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+        if not item:
+            self.finished = True
+            return False
+        self.current, self.position = item, 0
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.position == len(self.current) and not self._next_buffer():
+                break
+            available = len(self.current) - self.position
+            take = available if size < 0 else min(size, available)
+            # Whole buffers are passed on without copying
+            parts.append(self.current if take == len(self.current) else self.current[self.position:self.position + take])
+            self.position += take
+            if size > 0:
+                size -= take
+        return b''.join(parts)
+
+    def close(self):
+        self.stopped.set()
+        # Unblock a pending put, then wait for the read in progress
+        while self.thread.is_alive():
+            try:
+                self.buffers.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DecompressorProcess:
+    """
+    This class runs an external decompressor that writes to standard output, e.g. pigz -dc, and reads its output as a
+    binary stream.
+    """
+
+    def __init__(self, command):
+        """
+        :param command: list of str, decompressor command line
+        """
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if not data and size != 0:
+            self._check_exit()
+        return data
+
+    def _check_exit(self):
+        return_code = self.process.wait()
+        if return_code != 0:
+            message = self.process.stderr.read().decode(errors='replace').strip()
+            raise OSError(f"{' '.join(self.command)} failed with exit code {return_code}: {message}")
+
+    def close(self):
+        if self.process.poll() is None:
+            # Stopped before the end of the output
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_fastq_batches(stream, chunk_size=DEFAULT_CHUNK_SIZE, skip_first_line=False):
+    """
+    Read a FASTQ stream in large chunks and yield the complete records of each chunk.
+
+    A stream that starts in the middle of a file (see open_fastq_chunk) is read with skip_first_line=True: its first,
+    possibly partial, line is skipped and reading starts at the next record header. A stream that continues past the
+    part of the file it is responsible for exposes a primary_length attribute once that length is known; only records
+    starting at or before primary_length are yielded.
+
+    :param stream: binary file object
+    :param chunk_size: int, number of bytes to read at a time (default: 8 MB)
+    :param skip_first_line: bool, set to True to skip to the first record header after the first line (default: False)
+    :return: generator of (list of bytes, list of bytes), sequence and quality lines of the records of each chunk
+    """
+    leftover = b''
+    offset = 0  # Stream offset of the start of leftover
+    searching = skip_first_line
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (leftover + chunk).split(b'\n')
+        if searching:
+            record_start = _find_record_start(lines)
+            if record_start is None:
+                leftover += chunk
+                continue
+            offset += sum(len(line) + 1 for line in lines[:record_start])
+            lines = lines[record_start:]
+            searching = False
+
+        # The last element is an incomplete line (or empty after a final newline); keep it with any incomplete record
+        num_complete_lines = (len(lines) - 1) // 4 * 4
+        num_complete_lines, done = _limit_records(lines, num_complete_lines, offset, getattr(stream, 'primary_length', None))
+        leftover = b'\n'.join(lines[num_complete_lines:])
+        offset += sum(len(line) + 1 for line in lines[:num_complete_lines])
+        if num_complete_lines:
+            yield _split_records(lines, num_complete_lines)
+        if done:
+            return
+
+    # Handle a last record that is not followed by a newline
+    primary_length = getattr(stream, 'primary_length', None)
+    if searching or (primary_length is not None and offset > primary_length):
+        return
+    lines = leftover.split(b'\n')
+    while lines and not lines[-1]:
+        lines.pop()
+    if lines:
+        if len(lines) % 4:
+            raise ValueError("Truncated FASTQ record at the end of the file.")
+        yield _split_records(lines, len(lines))
+
+
+def _find_record_start(lines):
+    """
+    Find the first complete line after the first line that starts a FASTQ record. A header line starts with '@' and
+    is followed two lines later by the '+' separator; a quality line starting with '@' is followed two lines later by
+    a sequence line, so the two cannot be confused.
+    """
+    for i in range(1, len(lines) - 3):
+        if lines[i][:1] == b'@' and lines[i + 2][:1] == b'+':
+            return i
+    return None
+
+
+def _limit_records(lines, num_complete_lines, offset, primary_length):
+    """
+    Drop the complete records that start after primary_length, and report whether reading can stop.
+    """
+    if primary_length is None or offset + sum(len(line) + 1 for line in lines) <= primary_length:
+        return num_complete_lines, False
+    record_offset = offset
+    for record in range(0, len(lines) - 1, 4):
+        if record_offset > primary_length:
+            return min(record, num_complete_lines), True
+        record_offset += sum(len(line) + 1 for line in lines[record:record + 4])
+    return num_complete_lines, False
+
+
+def _split_records(lines, num_lines):
+    headers = lines[0:num_lines:4]
+    if any(header[:1] != b'@' for header in headers):
+        raise ValueError("Malformed FASTQ record: header line does not start with '@'.")
+    sequences = lines[1:num_lines:4]
+    qualities = lines[3:num_lines:4]
+    if sequences and sequences[0].endswith(b'\r'):
+        sequences = [sequence.rstrip(b'\r') for sequence in sequences]
+        qualities = [quality.rstrip(b'\r') for quality in qualities]
+    return sequences, qualities
+
+
+def iter_fastq_records(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the sequence and quality lines of every record of a FASTQ stream.
+
+    :param stream: binary file object
+    :param chunk_size: int, number of bytes to read at a time (default: 8 MB)
+    :return: generator of (bytes, bytes), sequence and quality line of each record
+    """
+    for sequences, qualities in iter_fastq_batches(stream, chunk_size):
+        yield from zip(sequences, qualities)
+
+
+class FileRange:
+    """
+    This class reads the bytes start:end of an uncompressed file as a binary stream.
+    """
+
+    def __init__(self, file_path, start, end):
+        self.file = open(file_path, 'rb')
+        self.file.seek(start)
+        self.remaining = end - start
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class GzipMemberReader:
+    """
+    This class decompresses the gzip members of a file starting at a member boundary as one binary stream.
+
+    Reading continues past the end offset so that the record crossing it can be completed; once the members that
+    start before the end offset have been decompressed, primary_length holds the number of bytes they produced.
+    """
+
+    def __init__(self, file_path, start, end, read_size=1024 * 1024):
+        self.file = open(file_path, 'rb')
+        self.file.seek(start)
+        self.end = end
+        self.read_size = read_size
+        self.member_start = start  # Compressed offset of the current member
+        self.fed = 0  # Compressed bytes fed to the current member's decompressor
+        self.decompressor = zlib.decompressobj(31)
+        self.pending = b''
+        self.buffer = bytearray()
+        self.produced = 0
+        self.primary_length = 0 if start >= end else None
+
+    def _fill(self):
+        data = self.pending or self.file.read(self.read_size)
+        self.pending = b''
+        if not data:
+            if self.primary_length is None:
+                self.primary_length = self.produced
+            return False
+
+        output = self.decompressor.decompress(data)
+        self.fed += len(data)
+        self.buffer += output
+        self.produced += len(output)
+
+        if self.decompressor.eof:
+            unused_data = self.decompressor.unused_data
+            self.member_start += self.fed - len(unused_data)
+            self.fed = 0
+            self.pending = unused_data
+            self.decompressor = zlib.decompressobj(31)
+            if self.primary_length is None and self.member_start >= self.end:
+                self.primary_length = self.produced
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self._fill():
+            pass
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def bgzf_block_offsets(fastq_file):
+    """
+    List the block offsets of a BGZF file (blocked gzip, as written by bgzip) from the block sizes stored in each
+    block header, without decompressing anything.
+
+    :param fastq_file: str, path to a gzip-compressed file
+    :return: list of int, compressed offset of every block, or None if the file is not BGZF
+    """
+    offsets = []
+    file_size = os.path.getsize(fastq_file)
+    with open(fastq_file, 'rb') as f:
+        offset = 0
+        while offset < file_size:
+            f.seek(offset)
+            header = f.read(18)
+            # gzip magic, deflate, FEXTRA flag, XLEN = 6, subfield 'BC' of length 2 holding the block size - 1
+            if (len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04'
+                    or header[12:14] != b'BC' or struct.unpack('<H', header[14:16])[0] != 2):
+                return None
+            offsets.append(offset)
+            offset += struct.unpack('<H', header[16:18])[0] + 1
+    return offsets
+
+
+def record_aligned_offsets(fastq_file, num_chunks, window_size=1024 * 1024):
+    """
+    Split an uncompressed FASTQ file into byte ranges that start and end at record boundaries.
+
+    :param fastq_file: str, path to an uncompressed FASTQ file
+    :param num_chunks: int, number of ranges to aim for
+    :param window_size: int, number of bytes read around each split point to find a record header (default: 1 MB)
+    :return: list of int, sorted offsets starting with 0 and ending with the file size
+    """
+    file_size = os.path.getsize(fastq_file)
+    offsets = [0]
+    with open(fastq_file, 'rb') as f:
+        for chunk in range(1, num_chunks):
+            target = file_size * chunk // num_chunks
+            if target <= offsets[-1]:
+                continue
+            f.seek(target - 1)
+            lines = f.read(window_size).split(b'\n')
+            record_start = _find_record_start(lines)
+            if record_start is None:
+                continue
+            offset = target - 1 + sum(len(line) + 1 for line in lines[:record_start])
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if file_size > offsets[-1] or file_size == 0:
+        offsets.append(file_size)
+    return offsets
+
+
+def plan_fastq_chunks(fastq_file, num_chunks):
+    """
+    Split a FASTQ file into chunks that can be processed independently. Uncompressed files are split at record
+    boundaries and BGZF files at block boundaries; other gzip files cannot be split and form a single chunk.
+
+    :param fastq_file: str, path to the FASTQ file
+    :param num_chunks: int, number of chunks to aim for
+    :return: list of FastqChunk
+    """
+    file_size = os.path.getsize(fastq_file)
+    if not fastq_file.endswith(".gz"):
+        offsets = record_aligned_offsets(fastq_file, num_chunks)
+        return [FastqChunk(fastq_file, start, end, None) for start, end in zip(offsets[:-1], offsets[1:])]
+
+    blocks = bgzf_block_offsets(fastq_file) if num_chunks > 1 else None
+    if not blocks:
+        return [FastqChunk(fastq_file, 0, file_size, 'gzip')]
+    # Start each chunk at the first block at or after its share of the compressed file
+    split_blocks = (bisect_left(blocks, file_size * chunk // num_chunks) for chunk in range(num_chunks))
+    offsets = sorted({blocks[block] for block in split_blocks if block < len(blocks)} | {0})
+    offsets.append(file_size)
+    return [FastqChunk(fastq_file, start, end, 'bgzf') for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def open_fastq_chunk(chunk, decompression='auto'):
+    """
+    Open a chunk of a FASTQ file for binary reading.
+
+    :param chunk: FastqChunk, chunk to open
+    :param decompression: str, how a gzipped chunk is decompressed, one of DECOMPRESSION_METHODS; BGZF chunks are
+                          decompressed with zlib, in a read-ahead thread unless decompression is 'inline' (default: 'auto')
+    :return: tuple (binary file object, bool), stream and whether its first line must be skipped (see iter_fastq_batches)
+    """
+    if chunk.compression == 'bgzf':
+        stream = GzipMemberReader(chunk.fastq_file, chunk.start, chunk.end)
+        return (stream if decompression == 'inline' else ReadAheadReader(stream)), chunk.start > 0
+    if chunk.compression == 'gzip':
+        return open_fastq(chunk.fastq_file, True, decompression), False
+    return FileRange(chunk.fastq_file, chunk.start, chunk.end), False
@@ -0,0 +1,261 @@
+"""
+THIS SCRIPT RECORDS LIGHTWEIGHT PIPELINE METRICS AND, ON REQUEST, SAMPLES THE CALL STACKS OF THE RUNNING PIPELINE.
+
+The metrics object of this module collects named counters (e.g. reads parsed, bytes downloaded), maxima (e.g. the
+largest barcode group) and stage timings. Updates are cheap and thread-safe; worker processes run their tasks
+through collect_metrics, which returns the metrics recorded by the task so that the parent can merge them. The
+collected metrics are written as a JSON file.
+
+SamplingProfiler replaces whole-run cProfile: a background thread records the call stack of every thread at a fixed
+interval, which costs almost nothing between samples, and writes the stacks in the collapsed format read by
+flame graph tools ("frame;frame;frame count" per line). While it runs, tasks run through collect_metrics in worker
+processes sample their own call stacks at the same interval and return them with their metrics, so the profile also
+covers the work done in worker processes rather than only the parent waiting for them.
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Set to the sampling interval while a SamplingProfiler runs; worker processes inherit the environment
+PROFILE_INTERVAL_VARIABLE = "MAPSEQ_PROFILE_INTERVAL"
+
+
+class Metrics:
+    """
+    This class accumulates counters, maxima and timings of the pipeline stages.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Discard all recorded metrics.
+        """
+        with self.lock:
+            self.counters = Counter()
+            self.maxima = {}
+            self.timings = {}  # stage name -> {'seconds': float, 'calls': int}
+
+    def count(self, name, value=1):
+        """
+        Add a value to a counter.
+
+        :param name: str, counter name, e.g. 'extraction.reads'
+        :param value: int, amount to add (default: 1)
+        """
+        with self.lock:
+            self.counters[name] += value
+
+    def maximum(self, name, value):
+        """
+        Record a value, keeping the largest value recorded under the name.
+        """
+        with self.lock:
+            if name not in self.maxima or value > self.maxima[name]:
+                self.maxima[name] = value
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Add elapsed time to a stage.
+        """
+        with self.lock:
+            timing = self.timings.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            timing['seconds'] += seconds
+            timing['calls'] += calls
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Time the enclosed block as (part of) a stage.
+
+        :param name: str, stage name, e.g. 'download'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Return a copy of the recorded metrics as plain data.
+
+        :return: dict, counters, maxima and timings
+        """
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'maxima': dict(self.maxima),
+                'timings': {name: dict(timing) for name, timing in self.timings.items()},
+            }
+
+    def merge(self, snapshot):
+        """
+        Add the metrics of a snapshot, e.g. one returned by collect_metrics in a worker process.
+
+        :param snapshot: dict, metrics as returned by snapshot
+        """
+        for name, value in snapshot['counters'].items():
+            self.count(name, value)
+        for name, value in snapshot['maxima'].items():
+            self.maximum(name, value)
+        for name, timing in snapshot['timings'].items():
+            self.add_time(name, timing['seconds'], timing['calls'])
+        if snapshot.get('stacks') and active_profiler is not None:
+            active_profiler.add_stacks(snapshot['stacks'])
+
+    def write_json(self, file_path, **extra):
+        """
+        Write the recorded metrics to a JSON file.
+
+        :param file_path: str, path to the JSON file
+        :param extra: additional top-level entries, e.g. the run parameters
+        """
+        report = dict(extra)
+        report.update(self.snapshot())
+        with open(file_path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+# Metrics of the current process
+metrics = Metrics()
+
+# Profiler of the main process while it runs, which receives the call stacks sampled in worker processes
+active_profiler = None
+
+
+def collect_metrics(function, *args):
+    """
+    Run a task and return its result together with the metrics it recorded. Used as the function of pool tasks, so
+    that worker processes report their metrics to the parent, which merges them with metrics.merge. While the parent
+    is profiled, the call stacks of the task are sampled and returned with the metrics.
+
+    :param function: callable, task to run
+    :param args: arguments of the task
+    :return: tuple (object, dict), result of the task and snapshot of its metrics
+    """
+    interval = os.environ.get(PROFILE_INTERVAL_VARIABLE)
+    profiler = None
+    if interval and multiprocessing.parent_process() is not None:
+        profiler = SamplingProfiler(float(interval))
+        profiler.start()
+    before = metrics.snapshot()
+    try:
+        result = function(*args)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    after = metrics.snapshot()
+    # Report only what this task added; a worker process may run several tasks
+    task_metrics = {
+        'counters': {name: value - before['counters'].get(name, 0) for name, value in after['counters'].items()
+                     if name not in before['counters'] or value != before['counters'][name]},
+        'maxima': after['maxima'],
+        'timings': {name: {'seconds': timing['seconds'] - before['timings'].get(name, {}).get('seconds', 0.0),
+                           'calls': timing['calls'] - before['timings'].get(name, {}).get('calls', 0)}
+                    for name, timing in after['timings'].items()
+                    if timing['calls'] != before['timings'].get(name, {}).get('calls', 0)},
+    }
+    if profiler is not None:
+        task_metrics['stacks'] = dict(profiler.stacks)
+    return result, task_metrics
+
+
+def merge_task_results(task_results):
+    """
+    Merge the metrics of tasks run through collect_metrics into the metrics of this process.
+
+    :param task_results: iterable of (object, dict), results of collect_metrics
+    :return: list, results of the tasks
+    """
+    results = []
+    for result, task_metrics in task_results:
+        metrics.merge(task_metrics)
+        results.append(result)
+    return results
+
+
+class SamplingProfiler:
+    """
+    This class samples the call stacks of all threads of the process at a fixed interval. While it runs, worker
+    processes started by this process sample the tasks they run through collect_metrics, and the merged metrics add
+    those stacks to it.
+    """
+
+    def __init__(self, interval=0.01):
+        """
+        :param interval: float, seconds between samples (default: 0.01)
+        """
+        self.interval = interval
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _sample(self):
+        own_thread = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                with self.lock:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        global active_profiler
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        if multiprocessing.parent_process() is None:
+            active_profiler = self
+            os.environ[PROFILE_INTERVAL_VARIABLE] = str(self.interval)
+
+    def stop(self):
+        global active_profiler
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        if active_profiler is self:
+            active_profiler = None
+            os.environ.pop(PROFILE_INTERVAL_VARIABLE, None)
+
+    def add_stacks(self, stacks):
+        """
+        Add call stacks sampled elsewhere, e.g. in a worker process.
+
+        :param stacks: dict, collapsed stack -> number of samples
+        """
+        with self.lock:
+            self.stacks.update(stacks)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def write_collapsed(self, file_path):
+        """
+        Write the sampled stacks in collapsed format, most frequent first.
+
+        :param file_path: str, path to the output file
+        :return: int, number of samples written
+        """
+        with open(file_path, 'w') as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+        return sum(self.stacks.values())
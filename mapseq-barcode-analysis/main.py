@@ -1,14 +1,110 @@
 import os
-import sys
-import cProfile
+import shutil
+import tempfile
+import time
 import argparse
-import pstats
+from multiprocessing import Pool
 from tqdm import tqdm
 from DataRetrieval import MAPseqDataDownloader
-from fastq_data_parsing import BarcodeExtractor
+from barcode_io import merge_packed_barcode_counts, read_sample_barcode_counts, sample_name
+from cluster_index import ClusterIndex
+from fastq_data_parsing import BARCODE_LENGTH, BarcodeExtractor, extract_file_task, init_extraction_worker, merge_extraction_results
+from instrumentation import SamplingProfiler, collect_metrics, metrics
 from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+from pipeline_scheduler import PipelineStage, run_pipelined_stages
+from projection_matrix import ProjectionMatrixBuilder
 
-def run_pipeline(email, download_limit, input_directory, output_directory, hamming_distance_threshold=1, user_provided_data=None):
+DEFAULT_STAGE_CONCURRENCY = {"download": 4, "convert": 2, "extract": None}
+
+def run_overlapped_retrieval(fastq_downloader, barcode_extractor, input_directory, stage_concurrency=None, queue_size=2,
+                             stream_conversion=False):
+    """
+    This function downloads, converts and extracts the barcodes of each SRA file as soon as the previous stage has
+    finished with it, instead of waiting for every file to finish a stage before starting the next one.
+
+    Args:
+        fastq_downloader (MAPseqDataDownloader): Downloader whose search results are processed.
+        barcode_extractor (BarcodeExtractor): Extractor reading fastq files from input_directory.
+        input_directory (str): Directory where SRA and fastq files are written.
+        stage_concurrency (dict, optional): Number of concurrent "download", "convert" and "extract" workers. Missing
+            entries use DEFAULT_STAGE_CONCURRENCY; the default number of extract workers is the extractor's number of
+            processes, or 1 in streaming mode where each file is already split across the processes.
+        queue_size (int, optional): Maximum number of files waiting in front of each stage. Defaults to 2.
+        stream_conversion (bool, optional): Count the barcodes of each SRA file straight from the converter's output
+            instead of writing and reading a fastq file. Conversion and extraction then form a single stage with
+            "convert" workers, and per-sample count tables are written as in streaming mode. Defaults to False.
+
+    Returns:
+        PackedBarcodeCounts: Total read count of each barcode.
+    """
+    concurrency = dict(DEFAULT_STAGE_CONCURRENCY, **(stage_concurrency or {}))
+    if concurrency["extract"] is None:
+        concurrency["extract"] = 1 if barcode_extractor.streaming else barcode_extractor.num_processes
+    if not os.path.exists(input_directory):
+        os.makedirs(input_directory)
+    if not os.path.exists(barcode_extractor.output_directory):
+        os.makedirs(barcode_extractor.output_directory)
+    fastq_downloader.search_mapseq_data()
+
+    # Extraction is CPU-bound, so the extract threads hand their files to worker processes, except in streaming mode
+    # where count_fastq_files starts its own processes. The workers return their barcodes as packed files in
+    # result_directory.
+    result_directory = None
+    if stream_conversion:
+        extraction_pool = Pool(concurrency["convert"])
+    elif barcode_extractor.streaming:
+        extraction_pool = None
+    else:
+        result_directory = tempfile.mkdtemp(prefix="barcode_results_", dir=barcode_extractor.output_directory)
+        extraction_pool = Pool(concurrency["extract"], initializer=init_extraction_worker, initargs=(barcode_extractor,))
+    try:
+        def extract(fastq_path):
+            file_name = os.path.basename(fastq_path)
+            if barcode_extractor.streaming:
+                return barcode_extractor.count_fastq_files([file_name])
+            extraction_result, task_metrics = extraction_pool.apply(collect_metrics, (extract_file_task, file_name, result_directory))
+            metrics.merge(task_metrics)
+            barcode_extractor.sample_files.append(barcode_extractor.sample_count_file(file_name))
+            return extraction_result
+
+        def stream_conversion_stage(sra_path):
+            barcode_counts, task_metrics = extraction_pool.apply(collect_metrics, (fastq_downloader.stream_sra_file, sra_path, barcode_extractor))
+            metrics.merge(task_metrics)
+            barcode_extractor.sample_files.append(barcode_extractor.sample_count_file(os.path.basename(sra_path)))
+            return barcode_counts
+
+        session = fastq_downloader.create_session()
+        stages = [
+            PipelineStage("Download", lambda sra_id: fastq_downloader.download_sra_file(sra_id, input_directory, session),
+                          concurrency["download"]),
+        ]
+        if stream_conversion:
+            stages.append(PipelineStage("Conversion", stream_conversion_stage, concurrency["convert"]))
+        else:
+            stages += [
+                PipelineStage("Conversion", lambda sra_path: fastq_downloader.convert_sra_file(sra_path, input_directory),
+                              concurrency["convert"]),
+                PipelineStage("Extraction", extract, concurrency["extract"]),
+            ]
+        with session:
+            results, _ = run_pipelined_stages(fastq_downloader.accession_ids, stages, queue_size)
+
+        if result_directory is not None:
+            return merge_extraction_results(results)
+    finally:
+        if extraction_pool is not None:
+            extraction_pool.close()
+            extraction_pool.join()
+        if result_directory is not None:
+            shutil.rmtree(result_directory, ignore_errors=True)
+
+    return merge_packed_barcode_counts(results, BARCODE_LENGTH)
+
+def run_pipeline(email, download_limit, input_directory, output_directory, hamming_distance_threshold=1, user_provided_data=None, clustering_method="cluster",
+                 streaming_extraction=False, num_processes=None, max_anchor_mismatches=0,
+                 output_format="text", overlap_stages=False, stage_concurrency=None, stream_conversion=False,
+                 extraction_cache_directory=None, quality_policy="mean", metrics_file=None, projection_matrix_file=None,
+                 cluster_index_directory=None, decompression="auto"):
     """
     This function runs the entire pipeline to download, preprocess, and analyze barcode data.
     
@@ -19,6 +115,39 @@ def run_pipeline(email, download_limit, input_directory, output_directory, hammi
         output_directory (str): Path to the output directory where results will be stored.
         hamming_distance_threshold (int, optional): Maximum Hamming distance to group similar barcodes. Defaults to 1.
         user_provided_data (str, optional): Path to user-provided data (fastq files). Defaults to None.
+        clustering_method (str, optional): "cluster" to collapse connected components of similar barcodes, or "directional"
+            to collapse low-count barcodes into high-count neighbors only. Defaults to "cluster".
+        streaming_extraction (bool, optional): Count barcodes per file with bounded memory and write per-file count tables
+            instead of collecting every barcode in memory. Defaults to False.
+        num_processes (int, optional): Number of extraction worker processes. In streaming mode large files are split into
+            chunks across the workers. Clustering of a million or more unique barcodes uses as many processes to find
+            similar barcode pairs. Defaults to None (os.cpu_count()).
+        max_anchor_mismatches (int, optional): Maximum number of sequencing errors tolerated in the anchor sequence. Defaults to 0.
+        output_format (str, optional): "text" or "binary" per-sample barcode files. Binary files are memory-mappable
+            <sample>_barcodes.npy tables of packed barcodes and counts. Defaults to "text".
+        overlap_stages (bool, optional): When downloading, pass each file on to conversion and extraction as soon as it
+            is ready instead of running each step on all files in turn (see run_overlapped_retrieval). Defaults to False.
+        stage_concurrency (dict, optional): Number of concurrent "download", "convert" and "extract" workers used with
+            overlap_stages. Defaults to None (DEFAULT_STAGE_CONCURRENCY).
+        stream_conversion (bool, optional): Count the barcodes of each downloaded file straight from fastq-dump's output
+            without writing fastq files; implies overlap_stages. Defaults to False.
+        extraction_cache_directory (str, optional): Directory of a persistent cache of per-file extraction results, so that
+            re-running the pipeline with different analysis parameters does not parse unchanged fastq files again.
+            Defaults to None (no cache).
+        quality_policy (str, optional): How reads are filtered on the base qualities of their barcode: "mean" (average
+            quality), "min" (lowest base quality) or "expected_errors" (sum of base error probabilities). Defaults to "mean".
+        metrics_file (str, optional): Path to the JSON file of stage timings and counters (reads parsed, anchor hits,
+            quality rejects, unique barcodes, graph edges, group sizes, bytes downloaded, ...). Defaults to None
+            (pipeline_metrics.json in the output directory).
+        projection_matrix_file (str, optional): Path to the .npz file of the barcode x sample projection matrix, the count of
+            each true barcode in each sample (see projection_matrix.py), built from the read counts of the samples
+            extracted in this run. Defaults to None (projection_matrix.npz in the output directory).
+        cluster_index_directory (str, optional): Directory of a persistent cluster index (see cluster_index.py). The
+            counts of samples not yet in the index are added to it, only the groups they affect are re-evaluated, and
+            the true barcodes are those of every sample added so far. Defaults to None (cluster this run's barcodes).
+        decompression (str, optional): How gzipped fastq files are decompressed: "thread" (in a read-ahead thread that
+            overlaps with parsing), "pigz" (an external pigz -dc process), "inline" (in the parsing thread) or "auto" (pigz
+            when it is on PATH, otherwise "thread"). Defaults to "auto".
 
     Returns:
         None
@@ -28,55 +157,115 @@ def run_pipeline(email, download_limit, input_directory, output_directory, hammi
     pipeline_steps = [
         "Downloading fastq files",
         "Extracting and preprocessing barcodes",
-        "Analyzing barcodes"
+        "Analyzing barcodes",
+        "Building projection matrix"
     ]
 
+    metrics.reset()
+    run_start = time.perf_counter()
     for step in tqdm(pipeline_steps, desc="Running pipeline"):
         print("Retrieving files...")
+        step_start = time.perf_counter()
         if step == "Downloading fastq files":
+            extracted_barcodes = None
             if not user_provided_data:
                 if email is not None and download_limit is not None:
                     fastq_downloader = MAPseqDataDownloader(email, download_limit)
-                    fastq_downloader.run(input_directory)
+                    if overlap_stages or stream_conversion:
+                        # Extraction runs here, overlapped with the downloads
+                        barcode_extractor = BarcodeExtractor(input_directory, output_directory, streaming=streaming_extraction,
+                                                             num_processes=num_processes, max_anchor_mismatches=max_anchor_mismatches,
+                                                             output_format=output_format, cache_directory=extraction_cache_directory,
+                                                             quality_policy=quality_policy, decompression=decompression)
+                        extracted_barcodes = run_overlapped_retrieval(fastq_downloader, barcode_extractor, input_directory,
+                                                                      stage_concurrency, stream_conversion=stream_conversion)
+                    else:
+                        fastq_downloader.run(input_directory)
                 else:
                     raise ValueError("Email and download_limit are required for downloading fastq files.")
             else:
                 input_directory = user_provided_data
 
-        elif step == "Extracting and preprocessing barcodes":
+        elif step == "Extracting and preprocessing barcodes" and extracted_barcodes is None:
             print("Extracting barcodes...")
-            barcode_extractor = BarcodeExtractor(input_directory, output_directory)
+            barcode_extractor = BarcodeExtractor(input_directory, output_directory, streaming=streaming_extraction,
+                                                 num_processes=num_processes, max_anchor_mismatches=max_anchor_mismatches,
+                                                 output_format=output_format, cache_directory=extraction_cache_directory,
+                                                 quality_policy=quality_policy, decompression=decompression)
             extracted_barcodes = barcode_extractor.process_fastq_files()
 
         elif step == "Analyzing barcodes":
             print("Validating barcodes...")
-            mapseq_analyzer = MAPseqBarcodeAnalysis(extracted_barcodes, hamming_distance_threshold)
-            true_barcodes = mapseq_analyzer.get_true_underlying_barcodes(extracted_barcodes)
+            if cluster_index_directory:
+                # Only samples new to the index are clustered; the groups of earlier batches are reused
+                cluster_index = ClusterIndex(cluster_index_directory, max_hamming_distance=hamming_distance_threshold,
+                                             clustering_method=clustering_method)
+                for sample_file in sorted(barcode_extractor.sample_files):
+                    cluster_index.add_counts(read_sample_barcode_counts(sample_file), batch=sample_name(sample_file), save=False)
+                cluster_index.save()
+                unique_barcodes, labels, true_barcodes = cluster_index.assignments()
+            else:
+                mapseq_analyzer = MAPseqBarcodeAnalysis(input_directory, output_directory, num_processes=num_processes)
+                unique_barcodes, labels, true_barcodes = mapseq_analyzer.cluster_barcodes(extracted_barcodes, max_hamming_distance=hamming_distance_threshold,
+                                                                                         clustering_method=clustering_method)
 
             with open(os.path.join(output_directory, "true_barcodes.txt"), "w") as f:
                 for barcode in true_barcodes:
                     f.write(barcode + "\n")
+            metrics.count("pipeline.true_barcodes", len(true_barcodes))
+
+        elif step == "Building projection matrix":
+            print("Building projection matrix...")
+            # Map each sample's barcodes onto the true barcode of their group
+            with metrics.timer("projection"):
+                matrix_builder = ProjectionMatrixBuilder(unique_barcodes, labels, true_barcodes)
+                # Only the samples of this run, never other files that happen to be in the output directory
+                for sample_file in sorted(barcode_extractor.sample_files):
+                    sample = matrix_builder.add_sample_file(sample_file)
+                    metrics.count("projection.unassigned_count", matrix_builder.unassigned[sample])
+                projection_matrix = matrix_builder.build()
+                projection_matrix.save(projection_matrix_file or os.path.join(output_directory, "projection_matrix.npz"))
+            metrics.count("projection.samples", len(projection_matrix.samples))
+            metrics.count("projection.nonzero_entries", len(projection_matrix.data))
+        metrics.add_time(f"pipeline.{step}", time.perf_counter() - step_start)
+
+    metrics.add_time("pipeline", time.perf_counter() - run_start)
+    parameters = {"hamming_distance_threshold": hamming_distance_threshold, "clustering_method": clustering_method,
+                  "streaming_extraction": streaming_extraction, "max_anchor_mismatches": max_anchor_mismatches,
+                  "quality_policy": quality_policy, "overlap_stages": overlap_stages, "stream_conversion": stream_conversion}
+    metrics.write_json(metrics_file or os.path.join(output_directory, "pipeline_metrics.json"), parameters=parameters)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, preprocess and analyze MAPseq barcode data.")
+    parser.add_argument("user_provided_data", nargs="?", default=None,
+                        help="directory containing your own fastq files; omit it to download fastq files")
+    parser.add_argument("--profile", action="store_true",
+                        help="sample the call stacks of the run and write them to profile_samples.txt")
+    parser.add_argument("--profile-interval", type=float, default=0.01, help="seconds between profiling samples")
+    args = parser.parse_args()
+
     email = None
     download_limit = None
-    input_directory = sys.argv[1]
+    user_provided_data = args.user_provided_data
+    input_directory = user_provided_data or "mapseq_data"
     output_directory = "output"
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
     
     # The default hamming_distance_threshold is set to 1. Change this value if needed.
     hamming_distance_threshold = 1
-    
-    user_provided_data = None
-    if len(sys.argv) > 1:
-        user_provided_data = sys.argv[1]
-
-    profile = cProfile.Profile()
-    profile.enable()
-    run_pipeline(email, download_limit, input_directory, output_directory, hamming_distance_threshold, user_provided_data)
-    profile.disable()
-
-    with open("profile_output.txt", "w") as f:
-        ps = pstats.Stats(profile, stream=f).sort_stats("cumulative")
-        ps.print_stats()
+
+    # Extraction results are reused across runs as long as the fastq files and extraction parameters are unchanged
+    extraction_cache_directory = os.path.join(output_directory, "extraction_cache")
+
+    # Stage timings and counters are always written to output/pipeline_metrics.json; call stacks are sampled on request
+    profiler = SamplingProfiler(args.profile_interval) if args.profile else None
+    if profiler:
+        profiler.start()
+    try:
+        run_pipeline(email, download_limit, input_directory, output_directory, hamming_distance_threshold, user_provided_data,
+                     extraction_cache_directory=extraction_cache_directory)
+    finally:
+        if profiler:
+            profiler.stop()
+            profiler.write_collapsed("profile_samples.txt")
@@ -7,31 +7,113 @@ This program has the following objectives:
 4. Consolidate the most likely real barcodes from each group to create a final list of true underlying barcodes. 
 '''
 
-import os
-import gzip
-from concurrent.futures import ThreadPoolExecutor
-from collections import defaultdict, Counter
-from Bio import SeqIO
+from collections import Counter, deque
+from collections.abc import Mapping
 import numpy as np
-from collections import deque
+from barcode_encoding import hamming_distance as packed_hamming_distance, pack_barcodes
+from barcode_io import PackedBarcodeCounts
+from instrumentation import metrics
+from neighbor_search import BarcodeNeighborIndex
+from union_find import DisjointSet
+
+def group_order(labels, counts=None, keys=None):
+    """
+    Order barcodes by group label and, when counts are given, from the most to the least abundant barcode of each
+    group, ties broken by the smallest key. The first barcode of each group is then its most likely real barcode.
+
+    :param labels: np.ndarray of int64, group label of each barcode
+    :param counts: np.ndarray of int64, read count of each barcode (default: None, keep the barcodes in index order)
+    :param keys: np.ndarray, sort key of each barcode, e.g. its alphabetical rank (default: None, the barcode index)
+    :return: tuple (np.ndarray of int64, np.ndarray of int64), barcode indices in group order and the position of the
+             first barcode of each group in that order
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if counts is None:
+        order = np.argsort(labels, kind='stable')
+    else:
+        keys = np.arange(len(labels)) if keys is None else keys
+        order = np.lexsort((keys, -np.asarray(counts, dtype=np.int64), labels))
+    sorted_labels = labels[order]
+    starts = np.flatnonzero(np.concatenate(([True], sorted_labels[1:] != sorted_labels[:-1]))) if len(order) else order
+    return order, starts
+
+
+def alphabetical_rank(barcodes):
+    """
+    Rank barcodes alphabetically.
+
+    :param barcodes: list of str, unique barcode sequences
+    :return: np.ndarray of int64, position of each barcode in alphabetical order
+    """
+    rank = np.empty(len(barcodes), dtype=np.int64)
+    rank[np.argsort(np.array(barcodes, dtype=str), kind='stable')] = np.arange(len(barcodes))
+    return rank
+
 
 class MAPseqBarcodeAnalysis:
 
-    def __init__(self, input_directory, output_directory, anchor_sequence='GTACTGCGGCCGCTACCTA'):
+    def __init__(self, input_directory, output_directory, anchor_sequence='GTACTGCGGCCGCTACCTA', num_processes=1,
+                 min_parallel_barcodes=1000000):
+        """
+        :param input_directory: str, path to the input directory
+        :param output_directory: str, path to the output directory
+        :param anchor_sequence: str, the anchor sequence (default: 'GTACTGCGGCCGCTACCTA')
+        :param num_processes: int, number of worker processes that find similar barcode pairs, sharded by pigeonhole
+                              segment keys, or None for os.cpu_count() (default: 1)
+        :param min_parallel_barcodes: int, minimum number of unique barcodes for which worker processes are started (default: 1000000)
+        """
         self.input_directory = input_directory
         self.output_directory = output_directory
         self.anchor_sequence = anchor_sequence
+        self.num_processes = num_processes
+        self.min_parallel_barcodes = min_parallel_barcodes
+
+    def find_neighbor_pairs(self, barcodes, max_hamming_distance=1):
+        """
+        Finds all pairs of barcodes within the maximum Hamming distance, in parallel for large sets of barcodes.
+
+        :param barcodes: list of str, unique barcode sequences, or barcode_io.PackedBarcodeCounts
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :return: np.ndarray of int64 with shape (n, 2), indices (i < j) of similar barcodes
+        """
+        if isinstance(barcodes, PackedBarcodeCounts):
+            neighbor_index = BarcodeNeighborIndex(barcodes.packed, max_hamming_distance, barcodes.barcode_length,
+                                                  list(barcodes.other_barcodes))
+        else:
+            neighbor_index = BarcodeNeighborIndex(barcodes, max_hamming_distance)
+        num_processes = self.num_processes if len(neighbor_index) >= self.min_parallel_barcodes else 1
+        neighbor_pairs = neighbor_index.neighbor_pairs(num_processes)
+        metrics.count('clustering.graph_edges', len(neighbor_pairs))
+        return neighbor_pairs
 
     def hamming_distance(self, barcode1, barcode2):
         '''
-        Computes the Hamming distance between two barcodes.
+        Computes the Hamming distance between two barcodes. Barcodes of the same length made of A, C, G and T are
+        compared packed (see barcode_encoding.py); others base by base.
 
         :param barcode1: str, first barcode sequence
         :param barcode2: str, second barcode sequence
         :return: int, Hamming distance between the two barcodes
         '''
+        if len(barcode1) == len(barcode2):
+            packed, packable = pack_barcodes([barcode1, barcode2], len(barcode1))
+            if packable.all():
+                return int(packed_hamming_distance(packed[0], packed[1]))
         return sum(base1 != base2 for base1, base2 in zip(barcode1, barcode2))
 
+    def label_similar_barcodes(self, barcodes, max_hamming_distance=1):
+        """
+        Labels each unique barcode with the connected component of the barcode similarity graph it belongs to.
+
+        :param barcodes: list of str, unique barcode sequences, or barcode_io.PackedBarcodeCounts
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :return: np.ndarray of int64, component label of each barcode, numbered in order of first appearance
+        """
+        components = DisjointSet(barcodes.num_barcodes if isinstance(barcodes, PackedBarcodeCounts) else len(barcodes))
+        neighbor_pairs = self.find_neighbor_pairs(barcodes, max_hamming_distance)
+        components.union_arrays(neighbor_pairs[:, 0], neighbor_pairs[:, 1])
+        return components.labels()
+
     def group_similar_barcodes(self, barcodes, max_hamming_distance=1):
         """
         Groups similar barcodes based on their Hamming distance.
@@ -40,69 +122,180 @@ class MAPseqBarcodeAnalysis:
         :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
         :return: list of lists, grouped barcodes
         """
-        def find_neighbors(barcode, barcodes):
-            """
-            Finds neighbors of a given barcode within the maximum Hamming distance.
-
-            :param barcode: str, barcode sequence
-            :param barcodes: list of str, barcode sequences
-            :return: list of str, neighboring barcodes
-            """
-            neighbors = []
-            for other_barcode in barcodes:
-                if self.hamming_distance(barcode, other_barcode) <= max_hamming_distance:
-                    neighbors.append(other_barcode)
-            return neighbors
-        
-        def dfs(visited, graph, node):
-            """
-            Depth-first search to traverse the barcode similarity graph.
-
-            :param visited: set, visited barcodes
-            :param graph: dict, adjacency list of the barcode similarity graph
-            :param node: str, current barcode node
-            """
-            if node not in visited:
-                visited.add(node)
-                for neighbor in graph[node]:
-                    dfs(visited, graph, neighbor)
-
-        graph = {barcode: find_neighbors(barcode, barcodes) for barcode in barcodes}
-        visited = set()
-        barcode_groups = []
-
-        for barcode in barcodes:
-            if barcode not in visited:
-                connected_component = set()
-                dfs(connected_component, graph, barcode)
-                barcode_groups.append(list(connected_component))
-
-        return barcode_groups
-    
-    def find_most_likely_barcodes(self, barcode_groups):
+        unique_barcodes = list(dict.fromkeys(barcodes))
+        labels = self.label_similar_barcodes(unique_barcodes, max_hamming_distance)
+
+        order, starts = group_order(labels)
+        return [[unique_barcodes[i] for i in group] for group in np.split(order, starts[1:])]
+
+    def label_barcodes_directional(self, barcodes, counts, max_hamming_distance=1, count_ratio=2, keys=None):
+        """
+        Labels similar barcodes with the directional (UMI-tools style) method. A barcode a absorbs a neighboring
+        barcode b only if count_a >= count_ratio * count_b - 1, so low-abundance errors are collapsed into the
+        abundant barcode they came from without chaining unrelated abundant barcodes through intermediates.
+
+        :param barcodes: list of str, unique barcode sequences, or barcode_io.PackedBarcodeCounts
+        :param counts: array-like of int, read count of each barcode
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :param count_ratio: float, minimum count ratio for an edge from a high-count to a low-count barcode (default: 2)
+        :param keys: np.ndarray, sort key breaking count ties between barcodes, e.g. packed barcodes
+                     (default: None, the alphabetical rank of the barcodes)
+        :return: tuple (np.ndarray of int64, np.ndarray of int64), group label of each barcode and the index of the
+                 barcode that started each group, its most abundant barcode
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        num_barcodes = len(counts)
+        neighbor_pairs = self.find_neighbor_pairs(barcodes, max_hamming_distance)
+        first, second = neighbor_pairs[:, 0], neighbor_pairs[:, 1]
+        forward = counts[first] >= count_ratio * counts[second] - 1
+        backward = counts[second] >= count_ratio * counts[first] - 1
+        sources = np.concatenate((first[forward], second[backward]))
+        targets = np.concatenate((second[forward], first[backward]))
+        # Directed edges in compressed sparse row form: the targets of barcode i are targets[offsets[i]:offsets[i + 1]]
+        targets = targets[np.argsort(sources, kind='stable')].tolist()
+        offsets = np.zeros(num_barcodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=num_barcodes), out=offsets[1:])
+        offsets = offsets.tolist()
+
+        # Process barcodes from the most to the least abundant; absorbed barcodes never start or extend another group
+        if keys is None:
+            keys = barcodes.sort_rank() if isinstance(barcodes, PackedBarcodeCounts) else alphabetical_rank(barcodes)
+        labels = np.full(num_barcodes, -1, dtype=np.int64)
+        roots = []
+        for root in np.lexsort((keys, -counts)).tolist():
+            if labels[root] >= 0:
+                continue
+            label = len(roots)
+            roots.append(root)
+            labels[root] = label
+            queue = deque([root])
+            while queue:
+                node = queue.popleft()
+                for neighbor in targets[offsets[node]:offsets[node + 1]]:
+                    if labels[neighbor] < 0:
+                        labels[neighbor] = label
+                        queue.append(neighbor)
+
+        return labels, np.array(roots, dtype=np.int64)
+
+    def group_barcodes_directional(self, barcodes, counts, max_hamming_distance=1, count_ratio=2):
+        """
+        Groups similar barcodes with the directional method (see label_barcodes_directional).
+
+        :param barcodes: list of str, unique barcode sequences
+        :param counts: array-like of int, read count of each barcode
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :param count_ratio: float, minimum count ratio for an edge from a high-count to a low-count barcode (default: 2)
+        :return: list of lists, grouped barcodes, each group starting with its most abundant barcode
+        """
+        rank = alphabetical_rank(barcodes)
+        labels, _ = self.label_barcodes_directional(barcodes, counts, max_hamming_distance, count_ratio, rank)
+        order, starts = group_order(labels, counts, rank)
+        return [[barcodes[i] for i in group] for group in np.split(order, starts[1:]) if len(group)]
+
+    def collapse_barcode_counts(self, barcodes, counts=None):
+        """
+        Collapses barcode reads into a table of unique barcodes and their read counts.
+
+        :param barcodes: list of str (one entry per read), or dict mapping barcodes to their read counts,
+                         or list of unique barcodes when counts is given
+        :param counts: array-like of int, read count of each unique barcode (default: None, count the reads)
+        :return: tuple (list of str, np.ndarray of int64), unique barcodes and their read counts
+        """
+        if counts is not None:
+            counts = np.asarray(counts, dtype=np.int64)
+            if len(counts) != len(barcodes):
+                raise ValueError("barcodes and counts must have the same length.")
+            unique_barcodes = list(barcodes)
+            if len(set(unique_barcodes)) != len(unique_barcodes):
+                # Sum the counts of repeated barcodes
+                barcode_counts = Counter()
+                for barcode, count in zip(unique_barcodes, counts.tolist()):
+                    barcode_counts[barcode] += count
+                return self.collapse_barcode_counts(barcode_counts)
+            return unique_barcodes, counts
+
+        barcode_counts = barcodes if isinstance(barcodes, Mapping) else Counter(barcodes)
+        unique_barcodes = list(barcode_counts.keys())
+        counts = np.fromiter(barcode_counts.values(), dtype=np.int64, count=len(unique_barcodes))
+        return unique_barcodes, counts
+
+    def find_most_likely_barcodes(self, barcode_groups, barcode_counts=None):
         """
         Finds the most likely real barcode in each group based on the frequency of each barcode.
+        Ties are broken by choosing the lexicographically smallest barcode, so the result does not depend on group order.
 
         :param barcode_groups: list of lists, grouped barcodes
+        :param barcode_counts: dict, mapping of each barcode to its read count (default: None, count occurrences within each group)
         :return: list of str, most likely real barcodes
         """
         most_likely_barcodes = []
         for group in barcode_groups:
-            counter = Counter(group)
-            most_common_barcode, _ = counter.most_common(1)[0]
+            counter = barcode_counts if barcode_counts is not None else Counter(group)
+            most_common_barcode = min(group, key=lambda barcode: (-counter[barcode], barcode))
             most_likely_barcodes.append(most_common_barcode)
         return most_likely_barcodes
 
-    def get_true_underlying_barcodes(self, barcodes):
+    def cluster_barcodes(self, barcodes, counts=None, max_hamming_distance=1, clustering_method='cluster', count_ratio=2):
+        """
+        Collapses the reads into unique barcodes, groups similar barcodes and assigns every unique barcode to the true
+        barcode of its group. The assignment maps each sample's barcodes onto the true barcodes (see projection_matrix.py).
+
+        :param barcodes: list of str (one entry per read), or dict mapping barcodes to their read counts,
+                         or list of unique barcodes when counts is given, or barcode_io.PackedBarcodeCounts
+        :param counts: array-like of int, read count of each unique barcode (default: None)
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :param clustering_method: str, 'cluster' for connected components or 'directional' for abundance-ratio
+                                  network collapsing (default: 'cluster')
+        :param count_ratio: float, count ratio used by the 'directional' method (default: 2)
+        :return: tuple (list of str, np.ndarray of int64, list of str), unique barcodes, index of the true barcode
+                 assigned to each unique barcode, and true underlying barcodes; for PackedBarcodeCounts the unique
+                 barcodes are the PackedBarcodeCounts itself, and only the true barcodes are turned into strings
+        """
+        if clustering_method not in ('cluster', 'directional'):
+            raise ValueError(f"Unknown clustering method: {clustering_method}")
+
+        with metrics.timer('clustering'):
+            if isinstance(barcodes, PackedBarcodeCounts):
+                unique_barcodes, counts, rank = barcodes, barcodes.all_counts(), barcodes.sort_rank()
+            else:
+                unique_barcodes, counts = self.collapse_barcode_counts(barcodes, counts)
+                rank = alphabetical_rank(unique_barcodes)
+            metrics.count('clustering.unique_barcodes', len(counts))
+
+            if clustering_method == 'directional':
+                labels, representatives = self.label_barcodes_directional(unique_barcodes, counts, max_hamming_distance,
+                                                                          count_ratio, rank)
+            else:
+                labels = self.label_similar_barcodes(unique_barcodes, max_hamming_distance)
+                # The most abundant barcode of each group, ties broken by the alphabetically smallest barcode
+                order, starts = group_order(labels, counts, rank)
+                representatives = order[starts]
+            if isinstance(unique_barcodes, PackedBarcodeCounts):
+                true_barcodes = unique_barcodes.barcodes(representatives)
+            else:
+                true_barcodes = [unique_barcodes[i] for i in representatives.tolist()]
+
+        group_sizes = np.bincount(labels, minlength=len(true_barcodes))
+        metrics.count('clustering.groups', len(group_sizes))
+        metrics.count('clustering.singleton_groups', int(np.count_nonzero(group_sizes == 1)))
+        metrics.maximum('clustering.largest_group', int(group_sizes.max(initial=0)))
+        return unique_barcodes, labels, true_barcodes
+
+    def get_true_underlying_barcodes(self, barcodes, counts=None, max_hamming_distance=1, clustering_method='cluster', count_ratio=2):
         """
         Consolidates the most likely real barcodes from each group to create a final list of true underlying barcodes.
+        The reads are first collapsed into unique barcodes and counts, so clustering runs once per unique sequence
+        and the representative of each group is its most abundant barcode.
 
-        :param barcodes: list of str, barcode sequences
+        :param barcodes: list of str (one entry per read), or dict mapping barcodes to their read counts,
+                         or list of unique barcodes when counts is given
+        :param counts: array-like of int, read count of each unique barcode (default: None)
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as similar (default: 1)
+        :param clustering_method: str, 'cluster' for connected components or 'directional' for abundance-ratio
+                                  network collapsing (default: 'cluster')
+        :param count_ratio: float, count ratio used by the 'directional' method (default: 2)
         :return: list of str, true underlying barcodes
         """
-        barcode_groups = self.group_similar_barcodes(barcodes)
-        true_barcodes = self.find_most_likely_barcodes(barcode_groups)
-
+        _, _, true_barcodes = self.cluster_barcodes(barcodes, counts, max_hamming_distance, clustering_method, count_ratio)
         return true_barcodes
-
-    
@@ -0,0 +1,387 @@
+"""
+THIS SCRIPT FINDS ALL PAIRS OF BARCODES WITHIN A MAXIMUM HAMMING DISTANCE WITHOUT COMPARING EVERY BARCODE TO EVERY OTHER BARCODE.
+
+Two barcodes of the same length that differ in at most d positions must agree exactly on at least one of d + 1
+non-overlapping segments (pigeonhole principle). Indexing every barcode under each of its segments therefore
+restricts the Hamming distance checks to barcodes that share a bucket, which scales close to linearly in the
+number of unique barcodes for the small distances (1-3) used in MAPseq.
+
+Barcodes that can be packed 2 bits per base (see barcode_encoding.py) are bucketed by sorting their packed segment
+keys and checked with vectorized XOR + popcount; only the other barcodes (e.g. containing 'N') fall back to string buckets.
+"""
+
+import os
+from collections import Counter, defaultdict
+from itertools import combinations
+from multiprocessing import Pool
+import numpy as np
+from barcode_encoding import decode_barcodes, hamming_distance, pack_barcodes, pairwise_hamming_distances, segment_keys
+from instrumentation import collect_metrics, merge_task_results
+
+
+def segment_bounds(barcode_length, num_segments):
+    """
+    Split a barcode of the given length into near-equal, non-overlapping segments.
+
+    :param barcode_length: int, length of the barcodes
+    :param num_segments: int, number of segments to split the barcode into
+    :return: list of (int, int), start and end positions of each segment
+    """
+    bounds = []
+    start = 0
+    for i in range(num_segments):
+        end = start + (barcode_length - start) // (num_segments - i)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def equal_key_pairs(keys):
+    """
+    Find all pairs of positions holding equal keys, by sorting the keys and pairing elements of each run of equal keys.
+
+    :param keys: np.ndarray, keys to compare
+    :return: tuple (np.ndarray of int64, np.ndarray of int64), positions of the first and second element of each pair
+    """
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    first, second = [], []
+    offset = 1
+    while offset < len(keys):
+        same = np.flatnonzero(sorted_keys[:-offset] == sorted_keys[offset:])
+        if len(same) == 0:
+            break  # Runs of equal keys are contiguous, so no run is longer than offset
+        first.append(order[same])
+        second.append(order[same + offset])
+        offset += 1
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(first).astype(np.int64), np.concatenate(second).astype(np.int64)
+
+
+def segment_neighbor_pairs(packed, barcode_length, max_hamming_distance, segment_number, keys=None):
+    """
+    Find the pairs of packed barcodes within the maximum Hamming distance whose first shared segment is the given
+    segment. Used by the single-process search for every segment and by each shard of the sharded search.
+
+    :param packed: np.ndarray of uint64, unique packed barcodes
+    :param barcode_length: int, length of the barcodes
+    :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as neighbors
+    :param segment_number: int, number of the segment the barcodes of each pair share
+    :param keys: list of np.ndarray, segment keys of the segments up to segment_number (default: None, compute them)
+    :return: np.ndarray of int64 with shape (n, 2), positions (i < j) in packed of neighboring barcodes
+    """
+    if keys is None:
+        bounds = segment_bounds(barcode_length, max_hamming_distance + 1)
+        keys = [segment_keys(packed, barcode_length, start, end) for start, end in bounds[:segment_number + 1]]
+    first, second = equal_key_pairs(keys[segment_number])
+    # Report each pair only for the first segment the two barcodes share
+    keep = np.ones(len(first), dtype=bool)
+    for earlier_segment in keys[:segment_number]:
+        keep &= earlier_segment[first] != earlier_segment[second]
+    first, second = first[keep], second[keep]
+
+    within = hamming_distance(packed[first], packed[second]) <= max_hamming_distance
+    first, second = first[within], second[within]
+    return np.stack([np.minimum(first, second), np.maximum(first, second)], axis=1).astype(np.int64)
+
+
+def packed_neighbor_pairs(packed, barcode_length, max_hamming_distance=1):
+    """
+    Find all pairs of packed barcodes within the maximum Hamming distance.
+
+    :param packed: np.ndarray of uint64, unique packed barcodes
+    :param barcode_length: int, length of the barcodes
+    :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as neighbors (default: 1)
+    :return: np.ndarray of int64 with shape (n, 2), indices (i < j) of neighboring barcodes
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    num_segments = max_hamming_distance + 1
+
+    if barcode_length < num_segments:
+        # Every pair of barcodes is within the distance; the segments cannot be formed
+        distances = pairwise_hamming_distances(packed, packed)
+        first, second = np.nonzero(np.triu(distances <= max_hamming_distance, k=1))
+        return np.stack([first, second], axis=1).astype(np.int64)
+
+    keys = [segment_keys(packed, barcode_length, start, end) for start, end in segment_bounds(barcode_length, num_segments)]
+    pairs = [segment_neighbor_pairs(packed, barcode_length, max_hamming_distance, segment_number, keys)
+             for segment_number in range(num_segments)]
+    return np.concatenate(pairs)
+
+
+def _shard_neighbor_pairs(ids, packed, barcode_length, max_hamming_distance, segment_number):
+    """
+    Find the neighbor pairs of one shard: barcodes that share their key of one segment and whose keys fall into the
+    same shard. Runs in a worker process.
+
+    :return: np.ndarray of int64 with shape (n, 2), global indices (i < j) of neighboring barcodes
+    """
+    # ids is increasing (stable sort by shard), so the pairs stay ordered (i < j)
+    return ids[segment_neighbor_pairs(packed, barcode_length, max_hamming_distance, segment_number)]
+
+
+def sharded_neighbor_pairs(packed, barcode_length, max_hamming_distance=1, num_processes=None, shards_per_process=4):
+    """
+    Find all pairs of packed barcodes within the maximum Hamming distance with a pool of worker processes.
+
+    For every pigeonhole segment, the barcodes are split into shards by a hash of their segment key. Barcodes that
+    share a segment key are in the same shard, so each (segment, shard) task finds its candidate pairs independently.
+    The result is the same as that of packed_neighbor_pairs.
+
+    :param packed: np.ndarray of uint64, unique packed barcodes
+    :param barcode_length: int, length of the barcodes
+    :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as neighbors (default: 1)
+    :param num_processes: int, number of worker processes (default: None, use os.cpu_count())
+    :param shards_per_process: int, number of shards per segment and worker process, to balance the load (default: 4)
+    :return: np.ndarray of int64 with shape (n, 2), indices (i < j) of neighboring barcodes, sorted
+    """
+    packed = np.asarray(packed, dtype=np.uint64)
+    num_segments = max_hamming_distance + 1
+    if barcode_length < num_segments or num_processes == 1:
+        return packed_neighbor_pairs(packed, barcode_length, max_hamming_distance)
+
+    num_processes = num_processes or os.cpu_count() or 1
+    num_shards = num_processes * shards_per_process
+    with Pool(num_processes) as pool:
+        tasks = []
+        for segment_number, (start, end) in enumerate(segment_bounds(barcode_length, num_segments)):
+            keys = segment_keys(packed, barcode_length, start, end)
+            with np.errstate(over='ignore'):
+                shards = ((keys * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)) % np.uint64(num_shards)
+            order = np.argsort(shards, kind='stable')
+            boundaries = np.searchsorted(shards[order], np.arange(1, num_shards, dtype=np.uint64))
+            for ids in np.split(order, boundaries):
+                if len(ids) > 1:
+                    tasks.append((ids, packed[ids], barcode_length, max_hamming_distance, segment_number))
+        pairs = merge_task_results(pool.starmap(collect_metrics, [(_shard_neighbor_pairs, *task) for task in tasks]))
+    pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+    return np.unique(pairs.astype(np.int64), axis=0).reshape(-1, 2)
+
+
+class BarcodeNeighborIndex:
+    """
+    This class indexes unique barcodes by pigeonhole segments to find all barcodes within a maximum Hamming distance.
+    Barcodes of different lengths are never considered neighbors.
+
+    The barcodes of the most common length that are made of A, C, G and T are packed; the others (e.g. containing 'N')
+    are indexed as strings, and are compared with the packed barcodes through the segments they share with them.
+    """
+
+    def __init__(self, barcodes, max_hamming_distance=1, barcode_length=None, other_barcodes=()):
+        """
+        Initialize the index over unique barcodes.
+
+        :param barcodes: list of str, unique barcode sequences, or np.ndarray of uint64, unique packed barcodes
+        :param max_hamming_distance: int, maximum Hamming distance to consider barcodes as neighbors (default: 1)
+        :param barcode_length: int, length of the barcodes, required for packed barcodes (default: None)
+        :param other_barcodes: list of str, with packed barcodes, the unique barcodes that cannot be packed; they are
+                               numbered after the packed barcodes (default: no other barcodes)
+        """
+        self.max_hamming_distance = max_hamming_distance
+        self.packed = None
+        self.packed_ids = None  # Index of each packed barcode, or None if the packed barcodes come first
+        self.other_ids = []  # Indices of the barcodes indexed as strings
+        self.other_barcodes = {}  # Index -> sequence of the barcodes indexed as strings
+        self.barcode_length = barcode_length
+        self.buckets = defaultdict(list)  # (length, segment number, segment sequence) -> barcode indices
+        self.brute_force_lengths = defaultdict(list)  # length -> barcode indices, for barcodes too short to split
+
+        if isinstance(barcodes, np.ndarray) and barcodes.dtype == np.uint64:
+            if barcode_length is None:
+                raise ValueError("barcode_length is required for packed barcodes.")
+            self.packed = barcodes
+            self.other_ids = list(range(len(barcodes), len(barcodes) + len(other_barcodes)))
+            self.other_barcodes = dict(zip(self.other_ids, other_barcodes))
+        else:
+            barcodes = list(barcodes)
+            if barcodes:
+                self.barcode_length = Counter(len(barcode) for barcode in barcodes).most_common(1)[0][0]
+                packed, packable = pack_barcodes(barcodes, self.barcode_length)
+                if packable.all():
+                    self.packed = packed
+                elif packable.any():
+                    self.packed_ids = np.flatnonzero(packable)
+                    self.packed = packed[packable]
+                self.other_ids = np.flatnonzero(~packable).tolist()
+                self.other_barcodes = {index: barcodes[index] for index in self.other_ids}
+        for index in self.other_ids:
+            self._add(index, self.other_barcodes[index])
+
+        # The sorted segment keys are only needed by queries, so they are built on the first query rather than here:
+        # neighbor_pairs (and the sharded search in particular) sorts the segments on its own.
+        self.sorted_segment_keys = None
+
+    def __len__(self):
+        return (0 if self.packed is None else len(self.packed)) + len(self.other_ids)
+
+    def _build_packed(self):
+        """
+        Sort the packed segment keys of every segment, so queries can find their bucket by binary search.
+        """
+        if self.sorted_segment_keys is not None:
+            return
+        num_segments = self.max_hamming_distance + 1
+        self.bounds = segment_bounds(self.barcode_length, num_segments) if self.barcode_length >= num_segments else []
+        self.segment_order = []
+        self.sorted_segment_keys = []
+        for start, end in self.bounds:
+            keys = segment_keys(self.packed, self.barcode_length, start, end)
+            order = np.argsort(keys, kind='stable')
+            self.segment_order.append(order)
+            self.sorted_segment_keys.append(keys[order])
+
+    def _segments(self, barcode):
+        """
+        Yield the bucket keys of a barcode, or nothing if the barcode is too short to be split into enough segments.
+        """
+        num_segments = self.max_hamming_distance + 1
+        if len(barcode) < num_segments:
+            return
+        for segment_number, (start, end) in enumerate(segment_bounds(len(barcode), num_segments)):
+            yield (len(barcode), segment_number, barcode[start:end])
+
+    def _add(self, index, barcode):
+        keys = list(self._segments(barcode))
+        if not keys:
+            self.brute_force_lengths[len(barcode)].append(index)
+        for key in keys:
+            self.buckets[key].append(index)
+
+    def _within_distance(self, barcode1, barcode2):
+        """
+        Check whether two equal-length barcodes are within the maximum Hamming distance, stopping at the first excess mismatch.
+        """
+        mismatches = 0
+        for base1, base2 in zip(barcode1, barcode2):
+            if base1 != base2:
+                mismatches += 1
+                if mismatches > self.max_hamming_distance:
+                    return False
+        return True
+
+    def _first_shared_segment(self, barcode1, barcode2):
+        """
+        Return the number of the first segment on which two barcodes agree, so each pair is reported only once.
+        """
+        for segment_number, (start, end) in enumerate(segment_bounds(len(barcode1), self.max_hamming_distance + 1)):
+            if barcode1[start:end] == barcode2[start:end]:
+                return segment_number
+        return None
+
+    def _query_packed(self, barcode):
+        """
+        Find the packed barcodes within the maximum Hamming distance of a packed barcode.
+
+        :param barcode: np.uint64, packed barcode of barcode_length bases
+        :return: np.ndarray of int64, positions in packed of the neighboring barcodes, sorted
+        """
+        self._build_packed()
+        if not self.bounds:
+            candidates = np.arange(len(self.packed))
+        else:
+            candidates = []
+            for (start, end), order, sorted_keys in zip(self.bounds, self.segment_order, self.sorted_segment_keys):
+                key = segment_keys(barcode, self.barcode_length, start, end)
+                low = np.searchsorted(sorted_keys, key, side='left')
+                high = np.searchsorted(sorted_keys, key, side='right')
+                candidates.append(order[low:high])
+            candidates = np.unique(np.concatenate(candidates))
+        within = hamming_distance(barcode, self.packed[candidates]) <= self.max_hamming_distance
+        return candidates[within]
+
+    def _query_packed_string(self, barcode):
+        """
+        Find the packed barcodes within the maximum Hamming distance of a barcode of barcode_length bases that cannot
+        be packed. Only its segments made of A, C, G and T can be shared with packed barcodes.
+
+        :param barcode: str, barcode sequence
+        :return: list of int, positions in packed of the neighboring barcodes, sorted
+        """
+        self._build_packed()
+        if not self.bounds:
+            candidates = np.arange(len(self.packed))
+        else:
+            candidates = []
+            for (start, end), order, sorted_keys in zip(self.bounds, self.segment_order, self.sorted_segment_keys):
+                segment_key, packable = pack_barcodes([barcode[start:end]], end - start)
+                if packable[0]:
+                    low = np.searchsorted(sorted_keys, segment_key[0], side='left')
+                    high = np.searchsorted(sorted_keys, segment_key[0], side='right')
+                    candidates.append(order[low:high])
+            candidates = np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+        candidate_barcodes = decode_barcodes(self.packed[candidates], self.barcode_length)
+        return [int(position) for position, candidate in zip(candidates, candidate_barcodes)
+                if self._within_distance(barcode, candidate)]
+
+    def _barcode_ids(self, positions):
+        """
+        Map positions in packed to barcode indices.
+        """
+        return positions if self.packed_ids is None else self.packed_ids[positions]
+
+    def neighbor_pairs(self, num_processes=1):
+        """
+        Find all pairs of indexed barcodes within the maximum Hamming distance.
+
+        :param num_processes: int, number of worker processes for packed barcodes, or None for os.cpu_count() (default: 1)
+        :return: np.ndarray of int64 with shape (n, 2), indices (i < j) of neighboring barcodes
+        """
+        pairs = []
+        if self.packed is not None:
+            if num_processes != 1:
+                packed_pairs = sharded_neighbor_pairs(self.packed, self.barcode_length, self.max_hamming_distance, num_processes)
+            else:
+                packed_pairs = packed_neighbor_pairs(self.packed, self.barcode_length, self.max_hamming_distance)
+            # packed_ids is increasing, so the pairs stay ordered (i < j)
+            pairs.append(self._barcode_ids(packed_pairs))
+
+        string_pairs = []
+        for (_, segment_number, _), members in self.buckets.items():
+            for i, j in combinations(members, 2):
+                barcode1, barcode2 = self.other_barcodes[i], self.other_barcodes[j]
+                if (self._first_shared_segment(barcode1, barcode2) == segment_number
+                        and self._within_distance(barcode1, barcode2)):
+                    string_pairs.append((i, j) if i < j else (j, i))
+
+        for members in self.brute_force_lengths.values():
+            for i, j in combinations(members, 2):
+                if self._within_distance(self.other_barcodes[i], self.other_barcodes[j]):
+                    string_pairs.append((i, j) if i < j else (j, i))
+
+        # Pairs of a string-indexed barcode and a packed barcode of the same length
+        if self.packed is not None:
+            for i in self.other_ids:
+                if len(self.other_barcodes[i]) == self.barcode_length:
+                    for j in self._barcode_ids(np.array(self._query_packed_string(self.other_barcodes[i]), dtype=np.int64)).tolist():
+                        string_pairs.append((i, j) if i < j else (j, i))
+        pairs.append(np.array(string_pairs, dtype=np.int64).reshape(-1, 2))
+        return np.concatenate(pairs).astype(np.int64)
+
+    def query(self, barcode):
+        """
+        Find all indexed barcodes within the maximum Hamming distance of a given barcode.
+
+        :param barcode: str, barcode sequence, or int, packed barcode
+        :return: list of int, indices of the neighboring barcodes (including an identical barcode, if indexed)
+        """
+        if not isinstance(barcode, str):
+            return self._barcode_ids(self._query_packed(np.uint64(barcode))).tolist() if self.packed is not None else []
+
+        neighbors = []
+        if self.packed is not None and len(barcode) == self.barcode_length:
+            packed, packable = pack_barcodes([barcode], self.barcode_length)
+            if packable[0]:
+                neighbors.extend(self._barcode_ids(self._query_packed(packed[0])).tolist())
+            else:
+                neighbors.extend(self._barcode_ids(np.array(self._query_packed_string(barcode), dtype=np.int64)).tolist())
+
+        keys = list(self._segments(barcode))
+        if not keys:
+            candidates = self.brute_force_lengths.get(len(barcode), [])
+        else:
+            candidates = set()
+            for key in keys:
+                candidates.update(self.buckets.get(key, ()))
+        neighbors.extend(index for index in candidates if self._within_distance(barcode, self.other_barcodes[index]))
+        return sorted(neighbors)
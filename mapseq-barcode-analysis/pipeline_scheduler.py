@@ -0,0 +1,81 @@
+"""
+THIS SCRIPT RUNS ITEMS THROUGH A CHAIN OF PROCESSING STAGES CONCURRENTLY, AS A PRODUCER/CONSUMER PIPELINE.
+
+Each stage has its own worker threads and a bounded input queue. An item moves on to the next stage as soon as the
+previous stage has finished with it, so different stages work on different items at the same time (e.g. one SRA file
+downloads while the previous one is converted and the one before is extracted). The total run time then approaches
+the time of the slowest stage instead of the sum of all stages. The bounded queues stop a fast stage from running far
+ahead of a slow one, which limits the disk space used by intermediate files.
+"""
+
+import threading
+from collections import namedtuple
+from queue import Queue
+
+# A processing stage: function maps the output of the previous stage to the input of the next one
+PipelineStage = namedtuple('PipelineStage', ['name', 'function', 'num_workers'])
+
+_END = object()  # Marks the end of a stage's input
+
+
+def run_pipelined_stages(items, stages, queue_size=2):
+    """
+    Pass every item through the stages in order, with the stages working concurrently.
+
+    An item whose stage function raises an exception is dropped from the pipeline and reported in the failures;
+    the other items carry on.
+
+    :param items: iterable, inputs of the first stage
+    :param stages: list of PipelineStage, stages in processing order
+    :param queue_size: int, maximum number of items waiting in front of each stage (default: 2)
+    :return: tuple (list, list of (object, str, Exception)), outputs of the last stage in completion order, and the
+             input item, stage name and error of every failed item
+    """
+    if not stages:
+        raise ValueError("At least one pipeline stage is required.")
+    queues = [Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    failures = []
+    lock = threading.Lock()
+    workers_left = [max(1, stage.num_workers) for stage in stages]
+
+    def work(stage_index):
+        stage = stages[stage_index]
+        input_queue = queues[stage_index]
+        while True:
+            task = input_queue.get()
+            if task is _END:
+                input_queue.put(_END)  # Let the other workers of this stage stop too
+                break
+            item, value = task
+            try:
+                output = stage.function(value)
+            except Exception as error:
+                print(f"{stage.name} failed for {item}: {error}")
+                with lock:
+                    failures.append((item, stage.name, error))
+                continue
+            if stage_index + 1 < len(stages):
+                queues[stage_index + 1].put((item, output))
+            else:
+                with lock:
+                    results.append(output)
+
+        with lock:
+            workers_left[stage_index] -= 1
+            last_worker = workers_left[stage_index] == 0
+        if last_worker and stage_index + 1 < len(stages):
+            queues[stage_index + 1].put(_END)
+
+    threads = [threading.Thread(target=work, args=(stage_index,), daemon=True)
+               for stage_index in range(len(stages)) for _ in range(workers_left[stage_index])]
+    for thread in threads:
+        thread.start()
+
+    for item in items:
+        queues[0].put((item, item))
+    queues[0].put(_END)
+
+    for thread in threads:
+        thread.join()
+    return results, failures
@@ -0,0 +1,264 @@
+"""
+THIS SCRIPT BUILDS THE BARCODE x SAMPLE PROJECTION MATRIX: THE COUNT OF EVERY TRUE BARCODE IN EVERY SAMPLE (TARGET AREA).
+
+Each sample's barcodes are mapped onto the true barcodes found by clustering (see
+MAPseqBarcodeAnalysis.cluster_barcodes) through a BarcodeLookup, which finds 2-bit packed barcodes by binary search
+in a sorted key array and other barcodes in a dictionary. The counts of the barcodes of a group are summed into the
+row of its true barcode.
+
+The matrix is built one sample (column) at a time and keeps only the non-zero counts. It is stored in compressed
+sparse row (CSR) form: data and indices hold the counts and sample indices of the non-zero entries row after row, and
+indptr[i]:indptr[i + 1] delimits row i. Saved matrices are uncompressed .npz files of plain arrays, with the true
+barcodes 2-bit packed when possible, so they load without parsing text. SciPy is only needed for to_scipy.
+"""
+
+from collections import Counter
+import numpy as np
+from barcode_encoding import decode_barcodes, pack_barcodes
+from barcode_io import PackedBarcodeCounts, iter_barcode_counts, load_barcode_table, sample_name
+
+PROJECTION_MATRIX_VERSION = 1
+
+
+class BarcodeLookup:
+    """
+    This class maps barcodes to integer values, e.g. the row of their true barcode in the projection matrix.
+    """
+
+    def __init__(self, barcodes, values, barcode_length=30):
+        """
+        :param barcodes: list of str, unique barcode sequences, or barcode_io.PackedBarcodeCounts
+        :param values: array-like of int, value of each barcode
+        :param barcode_length: int, length of the barcodes looked up by their packed keys; the length of the packed
+                               barcodes of a PackedBarcodeCounts (default: 30)
+        """
+        values = np.asarray(values, dtype=np.int64)
+        if isinstance(barcodes, PackedBarcodeCounts):
+            self.barcode_length = barcodes.barcode_length
+            num_packed = len(barcodes.packed)
+            order = np.argsort(barcodes.packed, kind='stable')
+            self.keys = np.asarray(barcodes.packed, dtype=np.uint64)[order]
+            self.values = values[:num_packed][order]
+            self.other_values = dict(zip(barcodes.other_barcodes, values[num_packed:].tolist()))
+            return
+        self.barcode_length = barcode_length
+        packed, packable = pack_barcodes(barcodes, barcode_length)
+        order = np.argsort(packed[packable], kind='stable')
+        self.keys = packed[packable][order]
+        self.values = values[packable][order]
+        # Barcodes that cannot be packed, e.g. containing 'N'
+        self.other_values = {barcodes[i]: int(values[i]) for i in np.flatnonzero(~packable)}
+
+    def __len__(self):
+        return len(self.keys) + len(self.other_values)
+
+    def lookup_packed(self, packed):
+        """
+        Look up packed barcodes of barcode_length bases.
+
+        :param packed: np.ndarray of uint64, packed barcodes
+        :return: np.ndarray of int64, value of each barcode, or -1 for barcodes not in the lookup
+        """
+        packed = np.asarray(packed, dtype=np.uint64)
+        if not len(self.keys):
+            return np.full(len(packed), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.keys, packed), len(self.keys) - 1)
+        return np.where(self.keys[positions] == packed, self.values[positions], -1)
+
+    def lookup(self, barcodes):
+        """
+        Look up barcode strings.
+
+        :param barcodes: list of str, barcode sequences
+        :return: np.ndarray of int64, value of each barcode, or -1 for barcodes not in the lookup
+        """
+        packed, packable = pack_barcodes(barcodes, self.barcode_length)
+        values = np.full(len(barcodes), -1, dtype=np.int64)
+        values[packable] = self.lookup_packed(packed[packable])
+        for i in np.flatnonzero(~packable):
+            values[i] = self.other_values.get(barcodes[i], -1)
+        return values
+
+
+class ProjectionMatrix:
+    """
+    This class holds a barcode x sample count matrix in compressed sparse row form.
+    """
+
+    def __init__(self, barcodes, samples, data, indices, indptr):
+        """
+        :param barcodes: list of str, true barcode of each row
+        :param samples: list of str, sample name of each column
+        :param data: np.ndarray of int64, non-zero counts, row after row
+        :param indices: np.ndarray of int32, column (sample index) of each count
+        :param indptr: np.ndarray of int64, offsets of the rows in data and indices (length: number of rows + 1)
+        """
+        self.barcodes = list(barcodes)
+        self.samples = list(samples)
+        self.data = data
+        self.indices = indices
+        self.indptr = indptr
+        self.barcode_rows = None  # Barcode -> row, built on the first call of row
+
+    @property
+    def shape(self):
+        return len(self.barcodes), len(self.samples)
+
+    def row(self, barcode):
+        """
+        Return the counts of one true barcode in every sample.
+
+        :param barcode: str, true barcode
+        :return: np.ndarray of int64, count in each sample
+        """
+        if self.barcode_rows is None:
+            self.barcode_rows = {true_barcode: i for i, true_barcode in enumerate(self.barcodes)}
+        i = self.barcode_rows[barcode]
+        counts = np.zeros(len(self.samples), dtype=np.int64)
+        counts[self.indices[self.indptr[i]:self.indptr[i + 1]]] = self.data[self.indptr[i]:self.indptr[i + 1]]
+        return counts
+
+    def to_dense(self):
+        """
+        Return the matrix as a dense array.
+
+        :return: np.ndarray of int64 with shape (number of barcodes, number of samples)
+        """
+        dense = np.zeros(self.shape, dtype=np.int64)
+        rows = np.repeat(np.arange(len(self.barcodes)), np.diff(self.indptr))
+        dense[rows, self.indices] = self.data
+        return dense
+
+    def to_scipy(self):
+        """
+        Return the matrix as a scipy.sparse.csr_matrix, sharing its arrays. Requires SciPy.
+        """
+        from scipy.sparse import csr_matrix
+        return csr_matrix((self.data, self.indices, self.indptr), shape=self.shape)
+
+    def save(self, file_path):
+        """
+        Save the matrix as an uncompressed .npz file. Barcodes of equal length made of A, C, G and T are stored 2-bit packed
+        and counts below 2**32 as 32-bit integers.
+
+        :param file_path: str, path to the .npz file
+        """
+        barcode_length = len(self.barcodes[0]) if self.barcodes else 0
+        packed, packable = pack_barcodes(self.barcodes, barcode_length)
+        if packable.all():
+            barcode_arrays = {'packed_barcodes': packed, 'barcode_length': np.int64(barcode_length)}
+        else:
+            barcode_arrays = {'barcodes': np.array(self.barcodes, dtype=str)}
+        # Counts almost always fit in 32 bits, which halves the size of the data array
+        data = self.data.astype(np.uint32) if self.data.max(initial=0) < 2 ** 32 else self.data
+        np.savez(file_path, format_version=np.int64(PROJECTION_MATRIX_VERSION), samples=np.array(self.samples, dtype=str),
+                 data=data, indices=self.indices, indptr=self.indptr, **barcode_arrays)
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Load a matrix saved with save.
+
+        :param file_path: str, path to the .npz file
+        :return: ProjectionMatrix
+        """
+        with np.load(file_path) as arrays:
+            if int(arrays['format_version']) != PROJECTION_MATRIX_VERSION:
+                raise ValueError(f"Unsupported projection matrix format version: {int(arrays['format_version'])}")
+            if 'packed_barcodes' in arrays:
+                barcodes = decode_barcodes(arrays['packed_barcodes'], int(arrays['barcode_length']))
+            else:
+                barcodes = arrays['barcodes'].tolist()
+            return cls(barcodes, arrays['samples'].tolist(), arrays['data'].astype(np.int64), arrays['indices'], arrays['indptr'])
+
+
+class ProjectionMatrixBuilder:
+    """
+    This class builds a projection matrix one sample at a time, mapping each sample's barcodes to the true barcodes.
+    """
+
+    def __init__(self, barcodes, labels, true_barcodes):
+        """
+        :param barcodes: list of str, unique barcodes that were clustered, or barcode_io.PackedBarcodeCounts
+        :param labels: array-like of int, index in true_barcodes of the true barcode of each barcode
+        :param true_barcodes: list of str, true barcodes, one per row of the matrix
+        """
+        self.true_barcodes = list(true_barcodes)
+        barcode_length = len(self.true_barcodes[0]) if self.true_barcodes else 30
+        self.lookup = BarcodeLookup(barcodes, labels, barcode_length)
+        self.samples = []
+        self.sample_rows = []  # Rows of the non-zero counts of each sample
+        self.sample_counts = []
+        self.unassigned = Counter()  # Sample name -> count of the barcodes that are not in the lookup
+
+    def _add_sample(self, sample, rows, counts):
+        assigned = rows >= 0
+        self.unassigned[sample] += int(counts[~assigned].sum())
+        row_counts = np.bincount(rows[assigned], weights=counts[assigned], minlength=len(self.true_barcodes)).astype(np.int64)
+        nonzero = np.flatnonzero(row_counts)
+        self.samples.append(sample)
+        self.sample_rows.append(nonzero)
+        self.sample_counts.append(row_counts[nonzero])
+
+    def add_sample(self, sample, barcodes, counts=None):
+        """
+        Add the barcodes of one sample as a new column.
+
+        :param sample: str, sample name
+        :param barcodes: list of str, barcodes of the sample
+        :param counts: array-like of int, count of each barcode (default: None, a count of 1 per barcode)
+        """
+        counts = np.ones(len(barcodes), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        self._add_sample(sample, self.lookup.lookup(barcodes), counts)
+
+    def add_packed_sample(self, sample, packed, counts, barcode_length):
+        """
+        Add the packed barcodes of one sample, e.g. from a binary barcode table, as a new column.
+
+        :param sample: str, sample name
+        :param packed: np.ndarray of uint64, packed barcodes of the sample
+        :param counts: array-like of int, count of each barcode
+        :param barcode_length: int, length of the packed barcodes
+        """
+        counts = np.asarray(counts, dtype=np.int64)
+        if barcode_length == self.lookup.barcode_length:
+            rows = self.lookup.lookup_packed(packed)
+        else:
+            rows = self.lookup.lookup(decode_barcodes(packed, barcode_length))
+        self._add_sample(sample, rows, counts)
+
+    def add_sample_file(self, file_path):
+        """
+        Add a per-sample read count file of fastq_data_parsing.py: <sample>_barcode_counts.tsv or <sample>_barcodes.npy.
+        Barcode lists (<sample>_barcodes.txt, or binary tables of unique barcodes) hold no read counts and are refused.
+
+        :param file_path: str, path to the sample file
+        :return: str, sample name
+        """
+        sample = sample_name(file_path)
+        if file_path.endswith('.npy'):
+            packed, counts, metadata = load_barcode_table(file_path)
+            if metadata.get('counts') == 'unique':
+                raise ValueError(f"{file_path} lists unique barcodes without read counts.")
+            self.add_packed_sample(sample, packed, counts, metadata['barcode_length'])
+        elif file_path.endswith('.tsv'):
+            barcode_counts = list(iter_barcode_counts(file_path))
+            self.add_sample(sample, [barcode for barcode, _ in barcode_counts], [count for _, count in barcode_counts])
+        else:
+            raise ValueError(f"{file_path} is not a read count file (<sample>_barcode_counts.tsv or <sample>_barcodes.npy).")
+        return sample
+
+    def build(self):
+        """
+        Assemble the columns added so far into a CSR matrix.
+
+        :return: ProjectionMatrix
+        """
+        rows = np.concatenate(self.sample_rows) if self.sample_rows else np.zeros(0, dtype=np.int64)
+        data = np.concatenate(self.sample_counts) if self.sample_counts else np.zeros(0, dtype=np.int64)
+        columns = np.repeat(np.arange(len(self.samples), dtype=np.int32), [len(sample_rows) for sample_rows in self.sample_rows])
+        # Columns were added in order, so a stable sort by row keeps the columns of each row sorted
+        order = np.argsort(rows, kind='stable')
+        indptr = np.zeros(len(self.true_barcodes) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(self.true_barcodes)), out=indptr[1:])
+        return ProjectionMatrix(self.true_barcodes, self.samples, data[order], columns[order], indptr)
@@ -1,7 +1,16 @@
-'''This Script generates synthetic MAPseq data for testing.''' 
+'''This Script generates synthetic MAPseq data for testing.
+
+generate_fastq_file writes small files one base at a time. generate_synthetic_fastq builds millions of reads with
+vectorized NumPy operations, from a known set of true barcodes with skewed abundances, sequencing errors in the barcode
+and anchor, and realistic quality profiles, so that benchmarks can score the pipeline against the ground truth.
+''' 
 
 import random
 import os
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+QUALITY_PROFILES = ('constant', 'declining', 'noisy')
 
 def generate_random_sequence(length):
     nucleotides = ['A', 'T', 'C', 'G']
@@ -25,6 +34,127 @@ def generate_fastq_file(filename, num_sequences, barcode_length, anchor_sequence
             file.write(f"+\n")
             file.write(f"{'I' * read_length}\n")  # Use constant quality score 'I'
 
+def generate_true_barcodes(num_barcodes, barcode_length, rng):
+    """
+    Draw distinct random barcodes.
+
+    :param num_barcodes: int, number of barcodes
+    :param barcode_length: int, length of each barcode
+    :param rng: np.random.Generator, random number generator
+    :return: np.ndarray of uint8, one row of base codes (0-3 for A, C, G, T) per barcode
+    """
+    barcodes = np.zeros((0, barcode_length), dtype=np.uint8)
+    while len(barcodes) < num_barcodes:
+        new_barcodes = rng.integers(0, 4, size=(num_barcodes - len(barcodes), barcode_length), dtype=np.uint8)
+        barcodes = np.unique(np.concatenate([barcodes, new_barcodes]), axis=0)
+    return rng.permutation(barcodes)
+
+def substitute_bases(codes, mask, rng):
+    """
+    Replace the masked base codes by one of the three other bases, in place.
+    """
+    codes[mask] = (codes[mask] + rng.integers(1, 4, size=int(mask.sum()), dtype=np.uint8)) % 4
+
+def generate_qualities(num_reads, read_length, quality_profile, rng):
+    """
+    Generate Phred scores for every base of every read.
+
+    :param quality_profile: str, 'constant' (Phred 40 everywhere), 'declining' (from about 38 at the start of the read
+                            to about 25 at the end, with noise) or 'noisy' (around 32 with a wide spread and occasional
+                            very low-quality bases)
+    :return: np.ndarray of uint8, Phred scores, one row per read
+    """
+    if quality_profile == 'constant':
+        return np.full((num_reads, read_length), 40, dtype=np.uint8)
+    if quality_profile == 'declining':
+        mean = np.linspace(38, 25, read_length)
+        scores = rng.normal(mean, 3, size=(num_reads, read_length))
+    elif quality_profile == 'noisy':
+        scores = rng.normal(32, 7, size=(num_reads, read_length))
+        scores[rng.random((num_reads, read_length)) < 0.02] = 2
+    else:
+        raise ValueError(f"Unknown quality profile: {quality_profile}")
+    return np.clip(np.rint(scores), 2, 41).astype(np.uint8)
+
+def fastq_records(first_read, sequences, qualities):
+    """
+    Format reads as FASTQ records with fixed-width "@seq<number>" headers, for all reads at once.
+
+    :param first_read: int, number of the first read
+    :param sequences: np.ndarray of uint8, ASCII bases, one row per read
+    :param qualities: np.ndarray of uint8, Phred scores, one row per read
+    :return: bytes, the FASTQ records
+    """
+    num_reads, read_length = sequences.shape
+    digits = 12
+    read_numbers = np.arange(first_read, first_read + num_reads, dtype=np.int64)[:, None]
+    powers = 10 ** np.arange(digits - 1, -1, -1, dtype=np.int64)
+    header = np.concatenate([np.full((num_reads, 1), ord('@'), dtype=np.uint8),
+                             np.frombuffer(b'seq', dtype=np.uint8)[None, :].repeat(num_reads, axis=0),
+                             (read_numbers // powers % 10 + ord('0')).astype(np.uint8)], axis=1)
+    newline = np.full((num_reads, 1), ord('\n'), dtype=np.uint8)
+    separator = np.frombuffer(b'\n+\n', dtype=np.uint8)[None, :].repeat(num_reads, axis=0)
+    records = np.concatenate([header, newline, sequences, separator, qualities + 33, newline], axis=1)
+    return records.tobytes()
+
+def generate_synthetic_fastq(filename, num_reads, num_true_barcodes=1000, abundance_skew=1.0, substitution_rate=0.005,
+                             anchor_error_rate=0.01, quality_profile='declining', barcode_length=30,
+                             anchor_sequence="GTACTGCGGCCGCTACCTA", read_length=60, seed=0, batch_size=1000000):
+    """
+    Write a synthetic MAPseq FASTQ file with a known set of true barcodes, using vectorized NumPy operations.
+
+    Each read is barcode + anchor + random bases. Read counts of the true barcodes follow a Zipf-like distribution,
+    and every barcode base is substituted with probability substitution_rate. A fraction anchor_error_rate of the
+    reads carry a substitution in the anchor. Reads are written in batches of batch_size reads to bound memory.
+
+    :param filename: str, path to the FASTQ file to write
+    :param num_reads: int, number of reads
+    :param num_true_barcodes: int, number of distinct true barcodes (default: 1000)
+    :param abundance_skew: float, exponent s of the abundance of the true barcode of rank r, proportional to 1 / r^s;
+                           0 gives equal abundances (default: 1.0)
+    :param substitution_rate: float, probability of a substitution at each barcode base (default: 0.005)
+    :param anchor_error_rate: float, fraction of reads with one substitution in the anchor (default: 0.01)
+    :param quality_profile: str, one of QUALITY_PROFILES (default: 'declining')
+    :param barcode_length: int, length of the barcodes (default: 30)
+    :param anchor_sequence: str, anchor sequence following the barcode (default: 'GTACTGCGGCCGCTACCTA')
+    :param read_length: int, length of each read (default: 60)
+    :param seed: int, seed of the random number generator, so that runs are reproducible (default: 0)
+    :param batch_size: int, number of reads generated at a time (default: 1000000)
+    :return: tuple (list of str, np.ndarray of int64), the true barcodes and the number of reads drawn from each
+    """
+    anchor = np.frombuffer(anchor_sequence.encode('ascii'), dtype=np.uint8)
+    tail_length = read_length - barcode_length - len(anchor)
+    if tail_length < 0:
+        raise ValueError("read_length is shorter than the barcode and anchor.")
+    anchor_codes = np.searchsorted(BASES, anchor).astype(np.uint8)
+
+    rng = np.random.default_rng(seed)
+    true_barcodes = generate_true_barcodes(num_true_barcodes, barcode_length, rng)
+    abundances = 1.0 / np.arange(1, num_true_barcodes + 1) ** abundance_skew
+    abundances /= abundances.sum()
+    read_counts = np.zeros(num_true_barcodes, dtype=np.int64)
+
+    with open(filename, 'wb') as file:
+        for first_read in range(0, num_reads, batch_size):
+            batch_reads = min(batch_size, num_reads - first_read)
+            origins = rng.choice(num_true_barcodes, size=batch_reads, p=abundances)
+            read_counts += np.bincount(origins, minlength=num_true_barcodes)
+
+            barcodes = true_barcodes[origins]
+            substitute_bases(barcodes, rng.random(barcodes.shape) < substitution_rate, rng)
+            anchors = np.repeat(anchor_codes[None, :], batch_reads, axis=0)
+            anchor_errors = np.zeros(anchors.shape, dtype=bool)
+            reads_with_errors = np.flatnonzero(rng.random(batch_reads) < anchor_error_rate)
+            anchor_errors[reads_with_errors, rng.integers(0, len(anchor), size=len(reads_with_errors))] = True
+            substitute_bases(anchors, anchor_errors, rng)
+            tails = rng.integers(0, 4, size=(batch_reads, tail_length), dtype=np.uint8)
+
+            sequences = BASES[np.concatenate([barcodes, anchors, tails], axis=1)]
+            qualities = generate_qualities(batch_reads, read_length, quality_profile, rng)
+            file.write(fastq_records(first_read, sequences, qualities))
+
+    return [barcode.tobytes().decode('ascii') for barcode in BASES[true_barcodes]], read_counts
+
 if __name__ == "__main__":
     output_file = "synthetic_data.fastq"
     num_sequences = 100000
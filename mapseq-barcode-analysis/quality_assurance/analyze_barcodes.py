@@ -1,8 +1,12 @@
 """
 This script performs the following tasks:
-1. Reads the extracted barcodes from the output files generated by the fastqDataParsing.py script.
-2. Calculates basic statistics, such as the number of unique barcodes and the frequency distribution of the barcodes.
-3. Checks the length and format of the barcodes to ensure they are 30 nucleotides long and only contain valid nucleotide characters (A, T, G, and C).
+1. Reads the extracted barcodes from the output files generated by the fastqDataParsing.py script
+   (<sample>_barcodes.txt, <sample>_barcode_counts.tsv or <sample>_barcodes.npy).
+2. Calculates basic statistics, such as the number of unique barcodes, the most frequent barcodes and the abundance distribution of the barcodes.
+3. Checks the length and format of the barcodes to ensure they are 30 nucleotides long and only contain valid nucleotide characters (A, T, G, and C),
+   and reports the length histogram, the invalid characters and the base composition at each position.
+
+Each file is read in one streaming pass with bounded memory (see barcode_statistics.py), and the files are analysed in parallel.
 
 You can run this script after the preprocessing and quality assurance steps to analyze the results and verify the quality of the extracted barcodes.
 
@@ -12,42 +16,21 @@ Usage:
 """
 
 import os
-from collections import Counter
-
-def read_barcodes(file_path):
-    with open(file_path, 'r') as f:
-        barcodes = [line.strip() for line in f.readlines()]
-    return barcodes
-
-def basic_statistics(barcodes, top_n=10):
-    unique_barcodes = set(barcodes)
-    num_unique_barcodes = len(unique_barcodes)
-    print(f"Number of unique barcodes: {num_unique_barcodes}")
-
-    barcode_counts = Counter(barcodes)
-    print(f"Top {top_n} most frequent barcodes:")
-    for barcode, count in barcode_counts.most_common(top_n):
-        print(f"{barcode}: {count}")
-
-def check_length_and_format(barcodes):
-    incorrect_barcodes = [barcode for barcode in barcodes if len(barcode) != 30 or not set(barcode).issubset(set("ATGC"))]
-    if not incorrect_barcodes:
-        print("All barcodes have the correct length and format.")
-    else:
-        print(f"{len(incorrect_barcodes)} barcodes have incorrect length or format.")
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing barcode_statistics.py.
+from barcode_statistics import analyze_barcode_files, print_report
+
+BARCODE_FILE_SUFFIXES = ("_barcodes.txt", "_barcode_counts.tsv", "_barcodes.npy")
 
 def main():
     input_directory = "path/to/output_directory"  # This should be the same output directory used in fastq_data_parsing.py
+    top_n = 10
 
-    for file_name in os.listdir(input_directory):
-        if file_name.endswith("_barcodes.txt"):
-            file_path = os.path.join(input_directory, file_name)
-            print(f"Analyzing {os.path.splitext(file_name)[0]}:")
-            
-            barcodes = read_barcodes(file_path)
-            basic_statistics(barcodes)
-            check_length_and_format(barcodes)
-            print("\n")
+    file_paths = [os.path.join(input_directory, file_name) for file_name in sorted(os.listdir(input_directory))
+                  if file_name.endswith(BARCODE_FILE_SUFFIXES)]
+    for report in analyze_barcode_files(file_paths, top_k=top_n):
+        print_report(report)
+        print("\n")
 
 if __name__ == "__main__":
     main()
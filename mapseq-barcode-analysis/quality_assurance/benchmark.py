@@ -0,0 +1,169 @@
+"""
+This script benchmarks the pipeline on synthetic data with a known set of true barcodes (see DataGenerator.py).
+
+For each scale (number of reads) it generates a FASTQ file and measures:
+1. Extraction: streaming barcode counting with BarcodeExtractor.
+2. Clustering: MAPseqBarcodeAnalysis.get_true_underlying_barcodes on the extracted counts.
+3. The full run_pipeline on the generated directory.
+
+Each measurement runs in a fresh process, so that its peak resident set size (including its worker processes) is
+not hidden by earlier measurements. Reads per second, peak RSS and the precision and recall of the recovered
+barcodes against the true barcodes are printed and can be saved as JSON, so that regressions show up as numbers.
+
+Usage:
+python3 benchmark.py --scales 100000 1000000 --output benchmark_results.json
+"""
+
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing main.py.
+from DataGenerator import QUALITY_PROFILES, generate_synthetic_fastq
+from fastq_data_parsing import BarcodeExtractor
+from main import run_pipeline
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and of its finished child processes, in MB.
+    """
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS and KB on Linux
+    own_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    # ru_maxrss survives exec, so a fresh process would report the peak of the process it was forked from;
+    # on Linux VmHWM starts again with the new program
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    own_peak = int(line.split()[1]) * 1024
+    children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own_peak, children_peak) / (1024 * 1024)
+
+def run_measured(function, *args):
+    """
+    Run a function in this process and return its result, wall time in seconds and peak RSS in MB.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start, peak_rss_mb()
+
+def measure(function, *args):
+    """
+    Run a module-level function in a fresh process and return its result, wall time in seconds and peak RSS in MB.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(run_measured, function, *args).result()
+
+def extract_counts(input_directory, output_directory, num_processes):
+    barcode_extractor = BarcodeExtractor(input_directory, output_directory, streaming=True, num_processes=num_processes)
+    return dict(barcode_extractor.process_fastq_files().to_counter())
+
+def cluster_counts(barcode_counts, max_hamming_distance, clustering_method, num_processes):
+    mapseq_analyzer = MAPseqBarcodeAnalysis(None, None, num_processes=num_processes)
+    return mapseq_analyzer.get_true_underlying_barcodes(barcode_counts, max_hamming_distance=max_hamming_distance,
+                                                        clustering_method=clustering_method)
+
+def run_full_pipeline(input_directory, output_directory, max_hamming_distance, clustering_method, num_processes):
+    run_pipeline(None, None, input_directory, output_directory, max_hamming_distance, user_provided_data=input_directory,
+                 clustering_method=clustering_method, streaming_extraction=True, num_processes=num_processes)
+    with open(os.path.join(output_directory, "true_barcodes.txt")) as f:
+        return [line.strip() for line in f]
+
+def clustering_accuracy(predicted_barcodes, true_barcodes):
+    """
+    Score recovered barcodes against the true barcodes.
+
+    :param predicted_barcodes: list of str, barcodes reported by the pipeline
+    :param true_barcodes: list of str, barcodes the reads were generated from (only those with at least one read)
+    :return: dict, precision, recall and number of recovered barcodes
+    """
+    predicted, truth = set(predicted_barcodes), set(true_barcodes)
+    true_positives = len(predicted & truth)
+    return {
+        'predicted_barcodes': len(predicted),
+        'true_barcodes': len(truth),
+        'precision': true_positives / len(predicted) if predicted else 0.0,
+        'recall': true_positives / len(truth) if truth else 0.0,
+    }
+
+def benchmark_scale(num_reads, arguments, work_directory):
+    input_directory = os.path.join(work_directory, f"reads_{num_reads}")
+    os.makedirs(input_directory)
+    fastq_file = os.path.join(input_directory, "synthetic.fastq")
+    start = time.perf_counter()
+    true_barcodes, read_counts = generate_synthetic_fastq(
+        fastq_file, num_reads, num_true_barcodes=arguments.num_true_barcodes, abundance_skew=arguments.abundance_skew,
+        substitution_rate=arguments.substitution_rate, anchor_error_rate=arguments.anchor_error_rate,
+        quality_profile=arguments.quality_profile, seed=arguments.seed)
+    generation_time = time.perf_counter() - start
+    true_barcodes = [barcode for barcode, count in zip(true_barcodes, read_counts) if count]
+
+    results = {'reads': num_reads, 'file_size_mb': os.path.getsize(fastq_file) / (1024 * 1024),
+               'generation_seconds': generation_time}
+    barcode_counts, seconds, rss = measure(extract_counts, input_directory, os.path.join(work_directory, f"extract_{num_reads}"),
+                                           arguments.num_processes)
+    results['extraction'] = {'seconds': seconds, 'reads_per_second': num_reads / seconds, 'peak_rss_mb': rss,
+                             'unique_barcodes': len(barcode_counts), 'barcode_reads': sum(barcode_counts.values())}
+
+    predicted_barcodes, seconds, rss = measure(cluster_counts, barcode_counts, arguments.hamming_distance, arguments.clustering_method,
+                                               arguments.num_processes)
+    results['clustering'] = {'seconds': seconds, 'unique_barcodes_per_second': len(barcode_counts) / seconds, 'peak_rss_mb': rss,
+                             **clustering_accuracy(predicted_barcodes, true_barcodes)}
+
+    if not arguments.skip_pipeline:
+        predicted_barcodes, seconds, rss = measure(run_full_pipeline, input_directory, os.path.join(work_directory, f"pipeline_{num_reads}"),
+                                                   arguments.hamming_distance, arguments.clustering_method, arguments.num_processes)
+        results['pipeline'] = {'seconds': seconds, 'reads_per_second': num_reads / seconds, 'peak_rss_mb': rss,
+                               **clustering_accuracy(predicted_barcodes, true_barcodes)}
+    os.remove(fastq_file)
+    return results
+
+def print_results(results):
+    print(f"\n{results['reads']:,} reads ({results['file_size_mb']:.0f} MB, generated in {results['generation_seconds']:.1f} s)")
+    for stage in ("extraction", "clustering", "pipeline"):
+        if stage not in results:
+            continue
+        stage_results = results[stage]
+        line = f"  {stage:<11} {stage_results['seconds']:8.2f} s  peak RSS {stage_results['peak_rss_mb']:8.0f} MB"
+        if 'reads_per_second' in stage_results:
+            line += f"  {stage_results['reads_per_second']:12,.0f} reads/s"
+        if 'precision' in stage_results:
+            line += (f"  precision {stage_results['precision']:.4f}  recall {stage_results['recall']:.4f}"
+                     f"  ({stage_results['predicted_barcodes']:,} barcodes for {stage_results['true_barcodes']:,} true)")
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MAPseq barcode pipeline on synthetic data.")
+    parser.add_argument("--scales", type=int, nargs="+", default=[100000, 1000000], help="numbers of reads to benchmark")
+    parser.add_argument("--num-true-barcodes", type=int, default=10000)
+    parser.add_argument("--abundance-skew", type=float, default=1.0, help="Zipf exponent of the barcode abundances")
+    parser.add_argument("--substitution-rate", type=float, default=0.002, help="per-base substitution rate in the barcode")
+    parser.add_argument("--anchor-error-rate", type=float, default=0.01, help="fraction of reads with an anchor error")
+    parser.add_argument("--quality-profile", choices=QUALITY_PROFILES, default="declining")
+    parser.add_argument("--hamming-distance", type=int, default=1)
+    parser.add_argument("--clustering-method", choices=("cluster", "directional"), default="directional")
+    parser.add_argument("--num-processes", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-pipeline", action="store_true", help="do not time the full run_pipeline")
+    parser.add_argument("--output", help="path to a JSON file for the results")
+    arguments = parser.parse_args()
+
+    all_results = []
+    with tempfile.TemporaryDirectory(prefix="mapseq_benchmark_") as work_directory:
+        for num_reads in arguments.scales:
+            results = benchmark_scale(num_reads, arguments, work_directory)
+            print_results(results)
+            all_results.append(results)
+
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            json.dump({'parameters': vars(arguments), 'results': all_results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ import io
 import os
 import unittest
 from fastq_data_parsing import BarcodeExtractor
+from barcode_encoding import encode_barcodes, hamming_distance
 from unittest.runner import TextTestRunner, TextTestResult
 
 class CustomTextTestResult(TextTestResult):
@@ -34,12 +35,6 @@ class CustomTextTestResult(TextTestResult):
         super().addFailure(test, err)
         self.results.append(('fail', test, err))
 
-def hamming_distance(s1, s2):
-    """
-    Calculates the Hamming distance between two strings of equal length.
-    """
-    return sum(c1 != c2 for c1, c2 in zip(s1, s2))
-
 class CustomTextTestRunner(TextTestRunner):
     """
     CustomTextTestRunner extends the TextTestRunner class to use the CustomTextTestResult
@@ -80,11 +75,12 @@ class TestBarcodeExtractor(unittest.TestCase):
         This test checks if the vast majority (at least 95% in this example)
         of the barcodes have a Hamming distance of 1 to at least one other barcode.
         """
+        packed_barcodes, _ = encode_barcodes(self.barcodes)
         hamming_1_neighbors_count = 0
-        for i, barcode1 in enumerate(self.barcodes):
-            for barcode2 in self.barcodes[i + 1:]:
-                if hamming_distance(barcode1, barcode2) == 1:
-                    hamming_1_neighbors_count += 1
+        for i in range(len(packed_barcodes)):
+            # Compare each barcode against all later barcodes at once
+            distances = hamming_distance(packed_barcodes[i], packed_barcodes[i + 1:])
+            hamming_1_neighbors_count += int((distances == 1).sum())
 
         self.assertGreater(hamming_1_neighbors_count / len(self.barcodes), 0.95)
 
@@ -0,0 +1,99 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing barcode_statistics.py.
+
+'''
+This test suite checks the streaming barcode statistics against statistics computed directly in memory, for barcode
+lists, text count tables and binary barcode tables, and the sketches used for large barcode lists.
+'''
+import random
+import tempfile
+import unittest
+from collections import Counter
+import numpy as np
+from barcode_encoding import encode_barcodes
+from barcode_io import write_barcode_counts, write_barcode_table
+from barcode_statistics import BarcodeAbundance, HyperLogLog, abundance_bins, analyze_barcode_files, barcode_file_statistics
+
+def random_barcodes(num_barcodes, rng, length=30):
+    return ["".join(rng.choices("ACGT", k=length)) for _ in range(num_barcodes)]
+
+class TestBarcodeStatistics(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        unique_barcodes = random_barcodes(200, rng)
+        # Skewed abundances plus a few barcodes of the wrong length or with an N
+        self.barcodes = [barcode for i, barcode in enumerate(unique_barcodes) for _ in range(1 + 200 // (i + 1))]
+        self.barcodes += ["ACGT" * 5, unique_barcodes[0][:-1] + "N", unique_barcodes[1][:-1] + "N"]
+        rng.shuffle(self.barcodes)
+        self.expected = Counter(barcode for barcode in self.barcodes if len(barcode) == 30 and "N" not in barcode)
+
+    def check_report(self, report):
+        self.assertEqual(report['total_count'], len(self.barcodes))
+        self.assertEqual(report['unique_barcodes'], len(self.expected))
+        self.assertEqual(report['top_barcodes'], sorted(self.expected.items(), key=lambda item: (-item[1], item[0]))[:5])
+        self.assertEqual(report['length_histogram'], {20: 1, 30: len(self.barcodes) - 1})
+        self.assertEqual(report['invalid_barcodes'], 3)
+        self.assertEqual(report['invalid_characters'], {'N': 2})
+        self.assertEqual(report['abundance_histogram'], dict(sorted(Counter(self.expected.values()).items())))
+        composition = report['base_composition']
+        self.assertEqual(len(composition), 30)
+        self.assertEqual(composition[0]['A'], sum(1 for barcode in self.barcodes if len(barcode) == 30 and barcode[0] == "A"))
+        self.assertEqual(composition[29]['other'], 2)
+
+    def test_text_formats(self):
+        with tempfile.TemporaryDirectory() as directory:
+            list_file = os.path.join(directory, "sample_barcodes.txt")
+            with open(list_file, "w") as f:
+                f.write("\n".join(self.barcodes) + "\n")
+            counts_file = os.path.join(directory, "sample_barcode_counts.tsv")
+            write_barcode_counts(counts_file, Counter(self.barcodes))
+
+            # Small blocks split the files in the middle of lines
+            for report in analyze_barcode_files([list_file, counts_file], num_processes=2, top_k=5, block_size=1000):
+                self.assertFalse(report['estimated'])
+                self.check_report(report)
+                self.assertEqual(report['barcodes'], len(self.barcodes) if report['file'].endswith(".txt") else len(self.expected) + 3)
+
+    def test_binary_table(self):
+        with tempfile.TemporaryDirectory() as directory:
+            table_file = os.path.join(directory, "sample_barcodes.npy")
+            barcode_counts = Counter(self.barcodes)
+            write_barcode_table(table_file, list(barcode_counts), list(barcode_counts.values()))
+            report = barcode_file_statistics(table_file, top_k=5, block_size=50)
+            self.assertEqual(report['unique_barcodes'], len(self.expected))
+            self.assertEqual(report['total_count'], len(self.barcodes))
+            self.assertEqual(report['invalid_barcodes'], 3)
+            self.assertEqual(report['top_barcodes'], sorted(self.expected.items(), key=lambda item: (-item[1], item[0]))[:5])
+            self.assertEqual(report['abundance_histogram'], dict(sorted(Counter(self.expected.values()).items())))
+            self.assertEqual(report['base_composition'][0]['A'], sum(count for barcode, count in self.expected.items() if barcode[0] == "A"))
+
+    def test_sketches_beyond_exact_limit(self):
+        """
+        With more unique barcodes than max_exact_barcodes, the unique count is estimated and the heavy hitters are still found.
+        """
+        rng = random.Random(1)
+        unique_barcodes = random_barcodes(20000, rng)
+        packed, _ = encode_barcodes(unique_barcodes)
+        abundance = BarcodeAbundance(top_k=3, max_exact_barcodes=1000, sketch_width=1 << 14)
+        heavy = packed[:3]
+        for start in range(0, len(packed), 2000):
+            block = np.concatenate([packed[start:start + 2000], heavy])
+            abundance.add(block, np.concatenate([np.ones(len(block) - 3, dtype=np.int64), [100, 90, 80]]))
+        summary = abundance.summary(30)
+        self.assertTrue(abundance.is_estimate())
+        self.assertIsNone(summary['abundance_histogram'])
+        self.assertEqual([barcode for barcode, _ in summary['top_barcodes']], unique_barcodes[:3])
+        self.assertGreaterEqual(summary["top_barcodes"][0][1], 1001)  # Never below the true count
+        self.assertLess(abs(summary['unique_barcodes'] - 20000), 20000 * 0.05)
+
+    def test_hyperloglog_small_sets_and_bins(self):
+        distinct = HyperLogLog()
+        distinct.add(np.arange(500, dtype=np.uint64))
+        distinct.add(np.arange(500, dtype=np.uint64))
+        self.assertLess(abs(distinct.estimate() - 500), 15)
+        self.assertEqual(abundance_bins({1: 5, 2: 3, 3: 1, 8: 2}), [(1, 1, 5, 5), (2, 3, 4, 9), (8, 15, 2, 16)])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,157 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing cluster_index.py.
+
+'''
+This test suite checks that adding barcode batches to the persistent cluster index one at a time, with the index
+saved and reopened in between, gives the same groups as clustering all batches at once.
+'''
+import random
+import tempfile
+import unittest
+from unittest import mock
+from collections import Counter
+import numpy as np
+from barcode_io import read_sample_barcode_counts
+from cluster_index import ClusterIndex
+from main import run_pipeline
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+def mutate(barcode, rng):
+    position = rng.randrange(len(barcode))
+    return barcode[:position] + rng.choice([base for base in "ACGT" if base != barcode[position]]) + barcode[position + 1:]
+
+def synthetic_batches(num_batches, rng):
+    """
+    Generates batches of barcode counts: abundant true barcodes, some shared between batches, and low-count errors,
+    including errors that chain true barcodes of different batches.
+    """
+    true_barcodes = ["".join(rng.choices("ACGT", k=30)) for _ in range(40)]
+    batches = []
+    for _ in range(num_batches):
+        batch = Counter()
+        for barcode in rng.sample(true_barcodes, 15):
+            batch[barcode] += rng.randint(20, 200)
+            for _ in range(rng.randint(0, 3)):
+                batch[mutate(barcode, rng)] += rng.randint(1, 5)
+        # An error of an error links the groups of later batches to earlier ones
+        batch[mutate(mutate(true_barcodes[0], rng), rng)] += 1
+        batch["ACGTN" * 6] += 1  # Cannot be packed, so it is not indexed
+        batches.append(dict(batch))
+    return batches
+
+class TestClusterIndex(unittest.TestCase):
+
+    def check_matches_full_clustering(self, clustering_method):
+        rng = random.Random(0 if clustering_method == 'cluster' else 1)
+        batches = synthetic_batches(8, rng)
+        analysis = MAPseqBarcodeAnalysis(None, None)
+        with tempfile.TemporaryDirectory() as directory:
+            total_counts = Counter()
+            for number, batch in enumerate(batches):
+                # Reopen the index from disk for every other batch
+                cluster_index = ClusterIndex(directory, clustering_method=clustering_method) if number % 2 == 0 else cluster_index
+                summary = cluster_index.add_counts(batch, batch=f"batch{number}")
+                self.assertEqual(summary["skipped_barcodes"], 1)
+                total_counts.update({barcode: count for barcode, count in batch.items() if "N" not in barcode})
+
+                unique_barcodes, labels, true_barcodes = analysis.cluster_barcodes(total_counts, clustering_method=clustering_method)
+                expected = {barcode: true_barcodes[label] for barcode, label in zip(unique_barcodes, labels)}
+                indexed_barcodes, indexed_labels, indexed_true_barcodes = cluster_index.assignments()
+                self.assertEqual({barcode: indexed_true_barcodes[label] for barcode, label in zip(indexed_barcodes.barcodes(), indexed_labels)}, expected)
+                self.assertEqual(sorted(cluster_index.true_barcodes()), sorted(true_barcodes))
+                self.assertEqual(cluster_index.barcode_counts(), dict(total_counts))
+
+            reopened = ClusterIndex(directory, clustering_method=clustering_method)
+            self.assertEqual(reopened.assignments()[0].barcodes(), cluster_index.assignments()[0].barcodes())
+            np.testing.assert_array_equal(reopened.assignments()[1], cluster_index.assignments()[1])
+            self.assertLessEqual(len(reopened.runs), 4)
+            self.assertEqual(len([name for name in os.listdir(directory) if name.startswith("run")]), len(reopened.runs))
+            self.assertEqual(sorted(name for name, _ in reopened.journals),
+                             sorted(name for name in os.listdir(directory) if name.startswith("journal")))
+
+    def test_cluster(self):
+        self.check_matches_full_clustering('cluster')
+
+    def test_directional(self):
+        self.check_matches_full_clustering('directional')
+
+    def test_interrupted_save(self):
+        """
+        A save interrupted before index.json is replaced leaves the previously saved index intact, and the next save
+        recovers from the files it left behind.
+        """
+        rng = random.Random(3)
+        batches = synthetic_batches(6, rng)
+        with tempfile.TemporaryDirectory() as directory:
+            cluster_index = ClusterIndex(directory)
+            for number, batch in enumerate(batches[:3]):
+                cluster_index.add_counts(batch, batch=f"batch{number}")
+            saved_counts = cluster_index.barcode_counts()
+            saved_true_barcodes = cluster_index.true_barcodes()
+
+            for number, batch in enumerate(batches[3:], start=3):
+                cluster_index.add_counts(batch, batch=f"batch{number}", save=False)
+                with mock.patch("cluster_index.os.replace", side_effect=OSError("interrupted")):
+                    with self.assertRaises(OSError):
+                        cluster_index.save()
+                reopened = ClusterIndex(directory)
+                self.assertEqual(reopened.barcode_counts(), saved_counts)
+                self.assertEqual(reopened.true_barcodes(), saved_true_barcodes)
+
+            cluster_index = ClusterIndex(directory)
+            for number, batch in enumerate(batches[3:], start=3):
+                cluster_index.add_counts(batch, batch=f"batch{number}")
+            full_index = ClusterIndex(os.path.join(directory, "full"))
+            for number, batch in enumerate(batches):
+                full_index.add_counts(batch, batch=f"batch{number}")
+            self.assertEqual(ClusterIndex(directory).barcode_counts(), full_index.barcode_counts())
+            self.assertEqual(sorted(ClusterIndex(directory).true_barcodes()), sorted(full_index.true_barcodes()))
+
+    def test_batches_are_added_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cluster_index = ClusterIndex(directory)
+            barcode = "ACGT" * 7 + "AC"
+            self.assertEqual(cluster_index.add_counts({barcode: 5}, batch="sample1")["new_barcodes"], 1)
+            self.assertIsNone(ClusterIndex(directory).add_counts({barcode: 5}, batch="sample1"))
+            summary = ClusterIndex(directory).add_counts({barcode: 2, mutate(barcode, random.Random(0)): 1}, batch="sample2")
+            self.assertEqual((summary["new_barcodes"], summary["updated_barcodes"], summary["new_edges"]), (1, 1, 1))
+            self.assertEqual(ClusterIndex(directory).true_barcodes(), [barcode])
+            with self.assertRaises(ValueError):
+                ClusterIndex(directory, max_hamming_distance=2)
+
+    def test_run_pipeline_with_cluster_index(self):
+        """
+        Each run adds only the samples that are new to the index, and reports the true barcodes of all samples so far.
+        Read counts are indexed in every extraction mode, and other files in the output directory (true_barcodes.txt)
+        never become batches.
+        """
+        rng = random.Random(2)
+        sample_barcodes = {"sample1": ["".join(rng.choices("ACGT", k=30)) for _ in range(3)],
+                           "sample2": ["".join(rng.choices("ACGT", k=30)) for _ in range(2)]}
+        with tempfile.TemporaryDirectory() as directory:
+            input_directory = os.path.join(directory, "input")
+            output_directory = os.path.join(directory, "output")
+            index_directory = os.path.join(directory, "cluster_index")
+            os.makedirs(input_directory)
+            for sample, barcodes in sample_barcodes.items():
+                with open(os.path.join(input_directory, f"{sample}.fastq"), "w") as f:
+                    for i, barcode in enumerate(barcodes * 3 + [mutate(barcodes[0], rng)]):
+                        sequence = barcode + ANCHOR_SEQUENCE
+                        f.write(f"@read{i}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+                run_pipeline(None, None, input_directory, output_directory, user_provided_data=input_directory,
+                             streaming_extraction=sample == "sample2", num_processes=1, cluster_index_directory=index_directory)
+
+            with open(os.path.join(output_directory, "true_barcodes.txt")) as f:
+                self.assertEqual(sorted(line.strip() for line in f), sorted(sample_barcodes["sample1"] + sample_barcodes["sample2"]))
+            cluster_index = ClusterIndex(index_directory)
+            self.assertEqual(cluster_index.batches, ["sample1", "sample2"])
+            self.assertEqual(sum(cluster_index.barcode_counts().values()), (3 * 3 + 1) + (2 * 3 + 1))  # sample1 is counted once
+
+            with self.assertRaises(ValueError):
+                read_sample_barcode_counts(os.path.join(output_directory, "sample1_barcodes.txt"))
+
+if __name__ == "__main__":
+    unittest.main()
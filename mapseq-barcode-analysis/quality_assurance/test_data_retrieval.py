@@ -0,0 +1,210 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing DataRetrieval.py.
+
+'''
+This test suite checks the SRA downloader against a local HTTP server that stands in for the NCBI server.
+The server supports Range requests and can drop the connection part-way through a response.
+Conversion is checked with a stand-in converter script that writes the contents of an "SRA" file to stdout.
+'''
+import gzip
+import hashlib
+import random
+import subprocess
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from DataRetrieval import MAPseqDataDownloader
+from barcode_io import read_barcode_counts
+from fastq_data_parsing import BarcodeExtractor
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+# Usage: fake_converter.py <sra file> -Z [--gzip]; "SRA" files starting with FAIL make it exit with an error
+FAKE_CONVERTER = '''
+import gzip, sys
+with open(sys.argv[1], "rb") as f:
+    data = f.read()
+if data.startswith(b"FAIL"):
+    sys.stdout.buffer.write(data[4:])
+    sys.stderr.write("fake converter: corrupt SRA file")
+    sys.exit(3)
+sys.stdout.buffer.write(gzip.compress(data) if "--gzip" in sys.argv else data)
+'''
+
+class SRAStandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves server.files by accession, honours "Range: bytes=N-" and records the number of body bytes sent.
+    """
+    def log_message(self, *args):
+        pass
+
+    def file_data(self):
+        sra_id = self.path.rstrip("/").split("/")[-1].replace(".sra", "")
+        return self.server.files.get(sra_id)
+
+    def do_HEAD(self):
+        data = self.file_data()
+        if data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.file_data()
+        if data is None:
+            self.send_error(404)
+            return
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        with self.server.lock:
+            drop_after = self.server.drop_after.pop(0) if self.server.drop_after else None
+        if drop_after is not None:
+            body = body[:drop_after]  # Simulate a dropped connection
+            self.close_connection = True
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytes_sent += len(body)
+
+class TestMAPseqDataDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SRAStandInHandler)
+        self.server.files = {f"SRR{i:06d}": os.urandom(200000 + i) for i in range(4)}
+        self.server.drop_after = []
+        self.server.bytes_sent = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.output_dir = tempfile.TemporaryDirectory()
+        url_template = f"http://127.0.0.1:{self.server.server_port}/{{prefix}}/{{sra_id}}.sra"
+        self.downloader = MAPseqDataDownloader("test@example.com", 4, max_workers=3, chunk_size=65536,
+                                               max_retries=3, url_template=url_template)
+        self.downloader.accession_ids = sorted(self.server.files)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.output_dir.cleanup()
+
+    def read_output(self, sra_id):
+        with open(os.path.join(self.output_dir.name, f"{sra_id}.sra"), "rb") as f:
+            return f.read()
+
+    def test_concurrent_download(self):
+        downloaded_files = self.downloader.download_sra_files(self.output_dir.name)
+        self.assertEqual(len(downloaded_files), 4)
+        for sra_id, data in self.server.files.items():
+            self.assertEqual(self.read_output(sra_id), data)
+        self.assertEqual(sorted(os.listdir(self.output_dir.name)), [f"{sra_id}.sra" for sra_id in sorted(self.server.files)])
+
+    def test_resume_partial_and_skip_complete(self):
+        """
+        A partial .part file is resumed with a Range request and a complete file is not downloaded again,
+        so only the missing bytes cross the network.
+        """
+        sra_ids = sorted(self.server.files)
+        with open(os.path.join(self.output_dir.name, f"{sra_ids[0]}.sra.part"), "wb") as f:
+            f.write(self.server.files[sra_ids[0]][:150000])
+        with open(os.path.join(self.output_dir.name, f"{sra_ids[1]}.sra"), "wb") as f:
+            f.write(self.server.files[sra_ids[1]])
+
+        self.downloader.accession_ids = sra_ids[:2]
+        self.downloader.download_sra_files(self.output_dir.name)
+        self.assertEqual(self.read_output(sra_ids[0]), self.server.files[sra_ids[0]])
+        self.assertEqual(self.server.bytes_sent, len(self.server.files[sra_ids[0]]) - 150000)
+
+    def test_retry_after_dropped_connection(self):
+        """
+        After a dropped connection the retry resumes from the bytes already written, losing at most one chunk.
+        """
+        self.server.drop_after = [50000]
+        sra_id = sorted(self.server.files)[0]
+        self.downloader.accession_ids = [sra_id]
+        self.downloader.chunk_size = 8192
+        self.downloader.download_sra_files(self.output_dir.name)
+        self.assertEqual(self.read_output(sra_id), self.server.files[sra_id])
+        self.assertLess(self.server.bytes_sent, len(self.server.files[sra_id]) + 8192)
+
+    def test_checksum_and_missing_accession(self):
+        sra_ids = sorted(self.server.files)
+        self.downloader.checksums = {sra_ids[0]: hashlib.md5(self.server.files[sra_ids[0]]).hexdigest(),
+                                     sra_ids[1]: "0" * 32}
+        self.downloader.max_retries = 1
+        self.downloader.accession_ids = sra_ids[:2] + ["SRR999999"]
+        downloaded_files = self.downloader.download_sra_files(self.output_dir.name)
+        self.assertEqual(downloaded_files, [os.path.join(self.output_dir.name, f"{sra_ids[0]}.sra")])
+
+class TestSRAConversion(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sra_directory = os.path.join(self.directory.name, "sra")
+        self.output_directory = os.path.join(self.directory.name, "output")
+        os.makedirs(self.sra_directory)
+        os.makedirs(self.output_directory)
+        converter = os.path.join(self.directory.name, "fake_converter.py")
+        with open(converter, "w") as f:
+            f.write(FAKE_CONVERTER)
+
+        rng = random.Random(0)
+        self.barcodes = ["".join(rng.choices("ACGT", k=30)) for _ in range(5)]
+        self.reads = {f"SRR00000{i}": [rng.choice(self.barcodes) for _ in range(50)] for i in range(4)}
+        for sra_id, reads in self.reads.items():
+            fastq = "".join(f"@read{j}\n{barcode}{ANCHOR_SEQUENCE}\n+\n{'I' * 49}\n" for j, barcode in enumerate(reads))
+            with open(os.path.join(self.sra_directory, f"{sra_id}.sra"), "w") as f:
+                f.write(("FAIL" if sra_id == "SRR000003" else "") + fastq)
+        self.downloader = MAPseqDataDownloader("test@example.com", 4, converter_command=[sys.executable, converter], max_conversions=3)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_convert_sra_to_fastq(self):
+        """
+        Failed conversions are reported and leave no partial fastq file behind.
+        """
+        for compress_fastq in (False, True):
+            self.downloader.compress_fastq = compress_fastq
+            sra_files = sorted(os.listdir(self.sra_directory))
+            fastq_files = self.downloader.convert_sra_to_fastq([f for f in sra_files if f.endswith(".sra")], self.sra_directory)
+            extension = ".fastq.gz" if compress_fastq else ".fastq"
+            self.assertEqual(sorted(fastq_files), [os.path.join(self.sra_directory, f"SRR00000{i}{extension}") for i in range(3)])
+            with (gzip.open if compress_fastq else open)(fastq_files[0], "rb") as f:
+                self.assertTrue(f.read().startswith(b"@read0\n"))
+        self.assertFalse([f for f in os.listdir(self.sra_directory) if f.endswith(".part")])
+
+    def test_stream_sra_file(self):
+        """
+        Barcodes counted straight from the converter's stdout match the reads, and a failed conversion writes no counts.
+        """
+        barcode_extractor = BarcodeExtractor(self.sra_directory, self.output_directory, ANCHOR_SEQUENCE)
+        barcode_counts = self.downloader.stream_sra_file(os.path.join(self.sra_directory, "SRR000000.sra"), barcode_extractor)
+        self.assertEqual(barcode_counts.to_counter(), Counter(self.reads["SRR000000"]))
+        self.assertEqual(read_barcode_counts(os.path.join(self.output_directory, "SRR000000_barcode_counts.tsv")), barcode_counts.to_counter())
+
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.downloader.stream_sra_file(os.path.join(self.sra_directory, "SRR000003.sra"), barcode_extractor)
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(os.listdir(self.output_directory), ["SRR000000_barcode_counts.tsv"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,483 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing fastq_data_parsing.py.
+
+'''
+This test suite checks the FASTQ reader and the BarcodeExtractor on small synthetic FASTQ files written to a
+temporary directory.
+'''
+import gzip
+import io
+import random
+import tempfile
+import unittest
+import numpy as np
+from collections import Counter
+from fastq_data_parsing import BarcodeExtractor, merge_extraction_results
+from instrumentation import metrics
+from extraction_cache import ExtractionCache
+from anchor_matching import AnchorLocator
+from barcode_encoding import decode_barcodes
+from barcode_io import (PackedBarcodeCounts, load_barcode_table, read_barcode_counts, read_barcode_table_counts,
+                        read_packed_barcode_counts, write_barcode_counts)
+from fastq_reader import (DecompressorProcess, ReadAheadReader, iter_fastq_batches, iter_fastq_records, open_fastq,
+                          open_fastq_chunk, plan_fastq_chunks)
+from DataGenerator import generate_synthetic_fastq
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+def random_sequence(length, rng):
+    return "".join(rng.choices("ACGT", k=length))
+
+def write_fastq(path, records, line_ending="\n"):
+    """
+    Writes (sequence, quality) records to a plain or gzipped FASTQ file.
+    """
+    text = "".join(f"@read{i}{line_ending}{sequence}{line_ending}+{line_ending}{quality}{line_ending}"
+                   for i, (sequence, quality) in enumerate(records))
+    with (gzip.open(path, "wt") if path.endswith(".gz") else open(path, "w", newline="")) as f:
+        f.write(text)
+
+class TestFastqReader(unittest.TestCase):
+
+    def test_records_across_chunk_boundaries(self):
+        """
+        Records split across chunks, CRLF line endings and a missing final newline are all read correctly.
+        """
+        rng = random.Random(0)
+        records = [(random_sequence(50, rng), "".join(rng.choice("#5?I") for _ in range(50))) for _ in range(100)]
+        for line_ending in ("\n", "\r\n"):
+            text = "".join(f"@read{i}{line_ending}{s}{line_ending}+{line_ending}{q}{line_ending}" for i, (s, q) in enumerate(records))
+            for data in (text, text.rstrip()):
+                read = [(s.decode(), q.decode()) for s, q in iter_fastq_records(io.BytesIO(data.encode()), chunk_size=97)]
+                self.assertEqual(read, records)
+
+    def test_malformed_input(self):
+        with self.assertRaises(ValueError):
+            list(iter_fastq_records(io.BytesIO(b"read\nACGT\n+\nIIII\n")))
+        with self.assertRaises(ValueError):
+            list(iter_fastq_records(io.BytesIO(b"@read\nACGT\n+\n")))
+
+class TestDecompression(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = random.Random(5)
+        self.records = [(random_sequence(60, rng), "".join(rng.choices("#5?I", k=60))) for _ in range(5000)]
+        self.fastq_file = os.path.join(self.directory.name, "reads.fastq.gz")
+        write_fastq(self.fastq_file, self.records)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_ahead_reader(self):
+        """
+        Reads of any size return the bytes of the wrapped stream in order, and errors of the stream are raised by read.
+        """
+        data = bytes(range(256)) * 1000
+        for read_size in (1, 97, 4096, 100000, -1):
+            with ReadAheadReader(io.BytesIO(data), buffer_size=1000, max_buffers=2) as reader:
+                parts = []
+                while True:
+                    part = reader.read(read_size)
+                    if not part:
+                        break
+                    parts.append(part)
+                    if read_size < 0:
+                        break
+            self.assertEqual(b"".join(parts), data)
+
+        # Closing before the end stops the background thread
+        reader = ReadAheadReader(io.BytesIO(data), buffer_size=10, max_buffers=1)
+        self.assertEqual(reader.read(5), data[:5])
+        reader.close()
+        self.assertFalse(reader.thread.is_alive())
+
+        with ReadAheadReader(gzip.GzipFile(fileobj=io.BytesIO(b"not gzip data"))) as reader:
+            with self.assertRaises(OSError):
+                reader.read()
+
+    def test_decompression_methods(self):
+        for decompression in ("auto", "thread", "inline"):
+            with open_fastq(self.fastq_file, decompression=decompression) as f:
+                self.assertEqual([(s.decode(), q.decode()) for s, q in iter_fastq_records(f, chunk_size=4096)], self.records)
+        with self.assertRaises(ValueError):
+            open_fastq(self.fastq_file, decompression="zstd")
+
+    def test_decompressor_process(self):
+        """
+        The output of an external decompressor is read as a stream; gzip -dc stands in for pigz -dc.
+        """
+        with ReadAheadReader(DecompressorProcess(["gzip", "-dc", self.fastq_file]), buffer_size=4096) as f:
+            self.assertEqual([(s.decode(), q.decode()) for s, q in iter_fastq_records(f)], self.records)
+        # Closing before the end stops the process
+        process = DecompressorProcess(["gzip", "-dc", self.fastq_file])
+        process.read(10)
+        process.close()
+        self.assertIsNotNone(process.process.returncode)
+
+        with open(os.path.join(self.directory.name, "broken.gz"), "wb") as f:
+            f.write(b"not gzip data")
+        with DecompressorProcess(["gzip", "-dc", f.name]) as process:
+            with self.assertRaises(OSError):
+                process.read()
+
+class TestAnchorLocator(unittest.TestCase):
+
+    def test_find_with_mismatches(self):
+        rng = random.Random(4)
+        for max_mismatches in (0, 1, 2, 3):
+            locator = AnchorLocator(ANCHOR_SEQUENCE, max_mismatches)
+            for num_errors in range(5):
+                anchor = list(ANCHOR_SEQUENCE)
+                for position in rng.sample(range(len(anchor)), num_errors):
+                    anchor[position] = {"A": "C", "C": "G", "G": "T", "T": "A"}[anchor[position]]
+                sequence = ("A" * 35 + "".join(anchor) + "A" * 10).encode()
+                expected = 35 if num_errors <= max_mismatches else -1
+                self.assertEqual(locator.find(sequence), expected)
+
+    def test_prefers_fewest_mismatches(self):
+        locator = AnchorLocator(ANCHOR_SEQUENCE, 2)
+        two_errors = "CA" + ANCHOR_SEQUENCE[2:]
+        one_error = ANCHOR_SEQUENCE[:-1] + "C"
+        self.assertEqual(locator.find((two_errors + "C" * 5 + one_error).encode()), 24)
+        self.assertEqual(locator.find(ANCHOR_SEQUENCE[:10].encode()), -1)
+
+class TestFastqChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        rng = random.Random(3)
+        # Quality lines starting with '@' make record headers ambiguous for naive splitters
+        sequences = [random_sequence(rng.randint(40, 80), rng) for _ in range(20000)]
+        self.records = [(sequence, "@" + "".join(rng.choices("@5?I", k=len(sequence) - 1))) for sequence in sequences]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_chunks(self, fastq_file, num_chunks):
+        records = []
+        chunks = plan_fastq_chunks(fastq_file, num_chunks)
+        for chunk in chunks:
+            stream, skip_first_line = open_fastq_chunk(chunk)
+            with stream:
+                for sequences, qualities in iter_fastq_batches(stream, chunk_size=4096, skip_first_line=skip_first_line):
+                    records.extend((s.decode(), q.decode()) for s, q in zip(sequences, qualities))
+        return chunks, records
+
+    def test_uncompressed_chunks(self):
+        fastq_file = os.path.join(self.directory.name, "reads.fastq")
+        write_fastq(fastq_file, self.records)
+        chunks, records = self.read_chunks(fastq_file, 7)
+        self.assertEqual(len(chunks), 7)
+        self.assertEqual(records, self.records)
+
+    def test_bgzf_chunks(self):
+        """
+        BGZF files are split at block boundaries, and every record is read by exactly one chunk.
+        """
+        try:
+            from Bio import bgzf
+        except ImportError:
+            self.skipTest("Biopython is required to write BGZF files")
+        fastq_file = os.path.join(self.directory.name, "reads.fastq.gz")
+        with bgzf.BgzfWriter(fastq_file, "wb") as f:
+            for i, (sequence, quality) in enumerate(self.records):
+                f.write(f"@read{i}\n{sequence}\n+\n{quality}\n".encode())
+        for num_chunks in (1, 5, 13):
+            chunks, records = self.read_chunks(fastq_file, num_chunks)
+            self.assertEqual(len(chunks), num_chunks)
+            self.assertEqual(records, self.records)
+
+        write_fastq(fastq_file, self.records)  # Plain gzip cannot be split
+        chunks, records = self.read_chunks(fastq_file, 5)
+        self.assertEqual(len(chunks), 1)
+        self.assertEqual(records, self.records)
+
+class TestSyntheticData(unittest.TestCase):
+
+    def test_generate_synthetic_fastq(self):
+        """
+        Generated files are reproducible from the seed, and error-free reads are extracted as generated.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, name) for name in ("a.fastq", "b.fastq", "clean.fastq")]
+            for path in paths[:2]:
+                true_barcodes, read_counts = generate_synthetic_fastq(path, 5000, num_true_barcodes=50, seed=7, batch_size=1500)
+            with open(paths[0], "rb") as a, open(paths[1], "rb") as b:
+                self.assertEqual(a.read(), b.read())
+            self.assertEqual(read_counts.sum(), 5000)
+            self.assertGreater(read_counts[0], 10 * read_counts[-1])  # Zipf-like abundances
+
+            true_barcodes, read_counts = generate_synthetic_fastq(paths[2], 5000, num_true_barcodes=50, substitution_rate=0,
+                                                                  anchor_error_rate=0, quality_profile="constant", seed=7)
+            barcode_extractor = BarcodeExtractor(directory, directory, ANCHOR_SEQUENCE)
+            count_file = os.path.join(directory, "counts.tsv")
+            barcode_extractor.count_barcodes(paths[2], count_file, False)
+            self.assertEqual(read_barcode_counts(count_file),
+                             {barcode: count for barcode, count in zip(true_barcodes, read_counts.tolist()) if count})
+
+class TestBarcodeExtractor(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_directory = os.path.join(self.directory.name, "input")
+        self.output_directory = os.path.join(self.directory.name, "output")
+        os.makedirs(self.input_directory)
+
+        rng = random.Random(1)
+        self.good_barcodes = [random_sequence(30, rng) for _ in range(20)]
+        low_quality_barcode = random_sequence(30, rng)
+        records = []
+        for barcode in self.good_barcodes:
+            records.append((random_sequence(5, rng) + barcode + ANCHOR_SEQUENCE + random_sequence(10, rng), "I" * 64))
+        records.append((low_quality_barcode + ANCHOR_SEQUENCE + random_sequence(15, rng), "#" * 64))  # Phred 2
+        records.append((random_sequence(64, rng), "I" * 64))  # No anchor
+        records.append((random_sequence(10, rng) + ANCHOR_SEQUENCE + random_sequence(35, rng), "I" * 64))  # Anchor too early
+        self.records = records
+
+        write_fastq(os.path.join(self.input_directory, "sample1.fastq"), records)
+        write_fastq(os.path.join(self.input_directory, "sample2.fastq.gz"), records)
+        self.barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_extract_barcodes(self):
+        barcodes = self.barcode_extractor.extract_barcodes(os.path.join(self.input_directory, "sample1.fastq"), False)
+        self.assertEqual(sorted(barcodes), sorted(self.good_barcodes))
+
+        barcodes = self.barcode_extractor.extract_barcodes(os.path.join(self.input_directory, "sample2.fastq.gz"), True)
+        self.assertEqual(sorted(barcodes), sorted(self.good_barcodes))
+
+    def test_quality_policies(self):
+        """
+        Reads are filtered one by one before aggregation, so a barcode is kept if any of its reads passes, whatever
+        the order of its reads; each policy judges the qualities of the barcode differently.
+        """
+        rng = random.Random(6)
+        barcodes = [random_sequence(30, rng) for _ in range(4)]
+        qualities = {
+            "good": "?" * 30,  # Phred 30
+            "bad": "#" * 30,  # Phred 2
+            "one_bad_base": "I" * 29 + "#",  # Mean 39.2, minimum 2, 0.63 expected errors
+            "two_bad_bases": "I" * 28 + "##",  # Mean 38.4, minimum 2, 1.26 expected errors
+        }
+        reads = [(barcodes[0], "good"), (barcodes[0], "bad"), (barcodes[1], "bad"),
+                 (barcodes[2], "one_bad_base"), (barcodes[3], "two_bad_bases")]
+        fastq_file = os.path.join(self.input_directory, "sample3.fastq")
+        write_fastq(fastq_file, [(barcode + ANCHOR_SEQUENCE, qualities[quality] + "I" * 19) for barcode, quality in reads])
+
+        expected = {"mean": [barcodes[0], barcodes[2], barcodes[3]], "min": [barcodes[0]],
+                    "expected_errors": [barcodes[0], barcodes[2]]}
+        for quality_policy, expected_barcodes in expected.items():
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE,
+                                                 quality_policy=quality_policy)
+            self.assertEqual(barcode_extractor.extract_barcodes(fastq_file, False), expected_barcodes)
+            barcode_qualities = {barcode: [ord(c) - 33 for c in qualities[quality]] for barcode, quality in reads[2:]}
+            self.assertEqual(barcode_extractor.filter_barcodes(barcode_qualities), [b for b in expected_barcodes if b != barcodes[0]])
+        with self.assertRaises(ValueError):
+            BarcodeExtractor(self.input_directory, self.output_directory, quality_policy="median")
+
+    def test_anchor_mismatches(self):
+        """
+        Reads with a sequencing error in the anchor are recovered only when anchor mismatches are allowed.
+        """
+        rng = random.Random(5)
+        barcode = random_sequence(30, rng)
+        anchor = "A" + ANCHOR_SEQUENCE[1:]
+        fastq_file = os.path.join(self.input_directory, "sample3.fastq")
+        write_fastq(fastq_file, [(barcode + anchor + random_sequence(10, rng), "I" * 59)])
+
+        self.assertEqual(self.barcode_extractor.extract_barcodes(fastq_file, False), [])
+        barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE, max_anchor_mismatches=1)
+        self.assertEqual(barcode_extractor.extract_barcodes(fastq_file, False), [barcode])
+
+    def test_process_fastq_files(self):
+        """
+        The result counts the files each barcode was extracted from; the workers' packed result files are removed.
+        Every sample also gets a read count table, listed in sample_files.
+        """
+        all_barcodes = self.barcode_extractor.process_fastq_files()
+        self.assertEqual(all_barcodes.to_counter(), Counter(self.good_barcodes * 2))
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["sample1_barcode_counts.tsv", "sample1_barcodes.txt",
+                                                                      "sample2_barcode_counts.tsv", "sample2_barcodes.txt"])
+        self.assertEqual(self.barcode_extractor.sample_files,
+                         [os.path.join(self.output_directory, f"sample{i}_barcode_counts.tsv") for i in (1, 2)])
+        self.assertEqual(read_barcode_counts(self.barcode_extractor.sample_files[1]), Counter(self.good_barcodes))
+
+        with open(os.path.join(self.output_directory, "sample1_barcodes.txt")) as f:
+            self.assertEqual(sorted(line.strip() for line in f), sorted(self.good_barcodes))
+
+    def test_unpackable_barcodes(self):
+        """
+        Barcodes containing 'N' cannot be packed and are returned by the workers alongside the packed barcodes.
+        """
+        n_barcode = "N" + self.good_barcodes[0][1:]
+        records = [(random_sequence(5, random.Random(2)) + n_barcode + ANCHOR_SEQUENCE + "A" * 10, "I" * 64)] + self.records
+        write_fastq(os.path.join(self.input_directory, "sample1.fastq"), records)
+        all_barcodes = self.barcode_extractor.process_fastq_files()
+        self.assertEqual(all_barcodes.to_counter(), Counter(self.good_barcodes * 2 + [n_barcode]))
+        self.assertEqual(merge_extraction_results([]).to_counter(), Counter())
+
+    def test_packed_barcode_counts(self):
+        """
+        Packing the barcodes of each chunk from their bytes and folding the chunk counts gives the same read counts as
+        counting strings, with the barcodes that cannot be packed counted on the side.
+        """
+        rng = random.Random(3)
+        n_barcode = self.good_barcodes[1][:-1] + "N"
+        reads = [rng.choice(self.good_barcodes + [n_barcode]) for _ in range(200)]
+        fastq_file = os.path.join(self.input_directory, "sample3.fastq")
+        write_fastq(fastq_file, [(barcode + ANCHOR_SEQUENCE, "I" * 49) for barcode in reads])
+
+        for flush_threshold in (1, 1000000):
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE, flush_threshold=flush_threshold)
+            packed, counts, other_barcodes = barcode_extractor.extract_packed_barcode_counts(fastq_file, False)
+            self.assertTrue((packed[1:] > packed[:-1]).all())
+            barcode_counts = Counter(dict(zip(decode_barcodes(packed, 30), counts.tolist())))
+            barcode_counts.update(other_barcodes)
+            self.assertEqual(barcode_counts, Counter(reads))
+            self.assertEqual(other_barcodes, {n_barcode: reads.count(n_barcode)})
+
+    def test_read_packed_count_table(self):
+        """
+        A count table read back as packed barcodes, block by block, and stored in the cache keeps every read count,
+        including those of barcodes that cannot be packed.
+        """
+        barcode_counts = Counter({barcode: i + 1 for i, barcode in enumerate(self.good_barcodes)})
+        barcode_counts.update({self.good_barcodes[0][:-1] + "N": 3, "ACGT": 10 ** 12})
+        count_file = os.path.join(self.directory.name, "counts.tsv")
+        write_barcode_counts(count_file, barcode_counts)
+        cache = ExtractionCache(os.path.join(self.directory.name, "cache"))
+        for block_size in (20, 100, 1 << 20):
+            packed_counts = read_packed_barcode_counts(count_file, 30, block_size)
+            self.assertTrue((packed_counts.packed[1:] > packed_counts.packed[:-1]).all())
+            self.assertEqual(packed_counts.to_counter(), barcode_counts)
+            cache.store(count_file, {"block_size": block_size}, packed_counts)
+            self.assertEqual(cache.load(count_file, {"block_size": block_size}).to_counter(), barcode_counts)
+
+    def test_count_barcodes_with_spills(self):
+        """
+        Flushing counts to disk every few unique barcodes gives the same count table as counting in memory.
+        """
+        rng = random.Random(2)
+        reads = [rng.choice(self.good_barcodes) for _ in range(200)]
+        records = [(barcode + ANCHOR_SEQUENCE, "I" * 49) for barcode in reads]
+        fastq_file = os.path.join(self.input_directory, "sample3.fastq")
+        write_fastq(fastq_file, records)
+
+        for flush_threshold in (3, 1000000):
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE, flush_threshold=flush_threshold)
+            count_file = os.path.join(self.directory.name, f"counts_{flush_threshold}.tsv")
+            barcode_extractor.count_barcodes(fastq_file, count_file, False)
+            self.assertEqual(read_barcode_counts(count_file), Counter(reads))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ["counts_1000000.tsv", "counts_3.tsv", "input"])
+
+    def test_process_fastq_files_streaming(self):
+        """
+        Splitting files into many chunks across workers gives the same counts as one task per file.
+        """
+        for min_chunk_size in (1 << 30, 500):
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE, streaming=True,
+                                                 num_processes=3, min_chunk_size=min_chunk_size)
+            barcode_counts = barcode_extractor.process_fastq_files()
+            self.assertEqual(barcode_counts.to_counter(), Counter(self.good_barcodes * 2))
+            self.assertEqual(read_barcode_counts(os.path.join(self.output_directory, "sample1_barcode_counts.tsv")),
+                             Counter(self.good_barcodes))
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["sample1_barcode_counts.tsv", "sample2_barcode_counts.tsv"])
+
+    def test_process_fastq_files_in_chunks(self):
+        """
+        Without streaming, large files are also split into chunks across workers, with the same counts and outputs as
+        one task per file.
+        """
+        for min_chunk_size in (1 << 30, 500):
+            metrics.reset()
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE,
+                                                 num_processes=3, min_chunk_size=min_chunk_size)
+            barcode_counts = barcode_extractor.process_fastq_files()
+            self.assertEqual(barcode_counts.to_counter(), Counter(self.good_barcodes * 2))
+            self.assertEqual(read_barcode_counts(os.path.join(self.output_directory, "sample1_barcode_counts.tsv")),
+                             Counter(self.good_barcodes))
+            # sample1.fastq is split into three chunks; gzip files that are not BGZF are read in one piece
+            self.assertEqual(metrics.snapshot()["timings"]["extraction.chunks"]["calls"], 2 if min_chunk_size > 500 else 4)
+        self.assertEqual(sorted(os.listdir(self.output_directory)), ["sample1_barcode_counts.tsv", "sample1_barcodes.txt",
+                                                                      "sample2_barcode_counts.tsv", "sample2_barcodes.txt"])
+
+    def test_binary_output(self):
+        """
+        Binary output holds the same barcodes and counts as text output, and can be memory-mapped.
+        """
+        for streaming in (False, True):
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE,
+                                                 streaming=streaming, output_format="binary")
+            barcode_extractor.process_fastq_files()
+            output_file = os.path.join(self.output_directory, "sample2_barcodes.npy")
+            self.assertEqual(read_barcode_table_counts(output_file), Counter(self.good_barcodes))
+
+            packed, counts, metadata = load_barcode_table(output_file)
+            self.assertEqual(metadata["sample"], "sample2")
+            self.assertEqual(metadata["num_barcodes"], len(self.good_barcodes))
+            self.assertEqual(metadata["counts"], "reads")
+            self.assertFalse(packed.flags.writeable)
+            self.assertTrue((packed[:-1] < packed[1:]).all())
+
+    def test_extraction_cache(self):
+        """
+        A second run with the same parameters reads every file from the cache; changing a file or the quality
+        threshold parses again.
+        """
+        cache_directory = os.path.join(self.directory.name, "cache")
+        for streaming in (False, True):
+            expected = Counter(self.good_barcodes * 2)
+            barcode_extractor = BarcodeExtractor(self.input_directory, self.output_directory, ANCHOR_SEQUENCE, streaming=streaming,
+                                                 num_processes=2, cache_directory=cache_directory)
+            result = barcode_extractor.process_fastq_files()
+            self.assertEqual(result.to_counter(), expected)
+
+            # Break the files without changing their size or modification time: the results must come from the cache
+            for file_name in ("sample1.fastq", "sample2.fastq.gz"):
+                path = os.path.join(self.input_directory, file_name)
+                stat = os.stat(path)
+                with open(path, "r+b") as f:
+                    f.write(b"X")
+                os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            result = barcode_extractor.process_fastq_files()
+            self.assertEqual(result.to_counter(), expected)
+
+            # A changed modification time misses the cache and parses the (now broken) file
+            os.utime(os.path.join(self.input_directory, "sample1.fastq"))
+            with self.assertRaises(ValueError):
+                barcode_extractor.process_fastq_files()
+
+            # So does a changed quality threshold
+            write_fastq(os.path.join(self.input_directory, "sample1.fastq"), self.records)
+            write_fastq(os.path.join(self.input_directory, "sample2.fastq.gz"), self.records)
+            barcode_extractor.process_fastq_files()
+            num_entries = len([name for name in os.listdir(cache_directory) if name.endswith(".npy")])
+            barcode_extractor.quality_threshold = 0
+            result = barcode_extractor.process_fastq_files()
+            self.assertEqual(len([name for name in os.listdir(cache_directory) if name.endswith(".npy")]), num_entries + 2)
+            self.assertEqual(int(result.all_counts().sum()), len(self.good_barcodes * 2) + 2)  # Now including the low quality barcode
+
+    def test_cache_eviction(self):
+        """
+        Least recently used entries are evicted first once the cache exceeds its size limit.
+        """
+        fastq_files = [os.path.join(self.input_directory, name) for name in ("sample1.fastq", "sample2.fastq.gz")]
+        cache = ExtractionCache(os.path.join(self.directory.name, "cache"), size_limit=10000)
+        barcode_counts = PackedBarcodeCounts.from_dict({barcode: 1 for barcode in self.good_barcodes})  # About 620 bytes per entry
+        for threshold in range(10):
+            cache.store(fastq_files[0], {"quality_threshold": threshold}, barcode_counts)
+            os.utime(cache.entry_path(fastq_files[0], {"quality_threshold": threshold}), ns=(threshold, threshold))
+        self.assertEqual(cache.load(fastq_files[0], {"quality_threshold": 0}).to_counter(), barcode_counts.to_counter())  # Now most recently used
+
+        cache.size_limit = 3000
+        self.assertEqual(cache.prune(), 6)
+        kept = [threshold for threshold in range(10) if cache.load(fastq_files[0], {"quality_threshold": threshold}) is not None]
+        self.assertEqual(kept, [0, 7, 8, 9])
+        self.assertIsNone(cache.load(fastq_files[1], {"quality_threshold": 0}))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing instrumentation.py.
+
+'''
+This test suite checks that metrics recorded in worker processes reach the parent, that extraction and clustering
+record their counters, and that the sampling profiler records call stacks.
+'''
+import random
+import tempfile
+import time
+import unittest
+from multiprocessing import Pool
+from fastq_data_parsing import BarcodeExtractor
+from instrumentation import SamplingProfiler, collect_metrics, merge_task_results, metrics
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+def count_task(value):
+    with metrics.timer("task"):
+        metrics.count("task.values", value)
+        metrics.maximum("task.largest_value", value)
+    return value * 2
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_worker_metrics_are_merged(self):
+        """
+        Each task reports only its own metrics, even when a worker process runs several tasks.
+        """
+        with Pool(2) as pool:
+            results = merge_task_results(pool.starmap(collect_metrics, [(count_task, value) for value in range(1, 11)]))
+        self.assertEqual(results, [value * 2 for value in range(1, 11)])
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {"task.values": 55})
+        self.assertEqual(snapshot["maxima"], {"task.largest_value": 10})
+        self.assertEqual(snapshot["timings"]["task"]["calls"], 10)
+
+    def test_extraction_and_clustering_metrics(self):
+        rng = random.Random(0)
+        barcodes = ["".join(rng.choices("ACGT", k=30)) for _ in range(3)]
+        reads = [(barcodes[0], "I"), (barcodes[0], "I"), (barcodes[1], "I"), (barcodes[2], "#"), (barcodes[0][:-1] + ("C" if barcodes[0][-1] == "A" else "A"), "I")]
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "sample.fastq"), "w") as f:
+                for i, (barcode, quality) in enumerate(reads):
+                    f.write(f"@read{i}\n{barcode}{ANCHOR_SEQUENCE}\n+\n{quality * 49}\n")
+                f.write(f"@read{len(reads)}\n{'A' * 49}\n+\n{'I' * 49}\n")  # No anchor
+            for streaming in (False, True):
+                metrics.reset()
+                barcode_extractor = BarcodeExtractor(directory, os.path.join(directory, "output"), ANCHOR_SEQUENCE, streaming=streaming, num_processes=2)
+                extracted_barcodes = barcode_extractor.process_fastq_files()
+                counters = metrics.snapshot()["counters"]
+                self.assertEqual((counters["extraction.reads"], counters["extraction.anchor_hits"], counters["extraction.quality_rejects"]), (6, 5, 1))
+                self.assertEqual(counters["extraction.files"], 1)
+
+            MAPseqBarcodeAnalysis(None, None).get_true_underlying_barcodes(extracted_barcodes)
+            snapshot = metrics.snapshot()
+            self.assertEqual(snapshot["counters"]["clustering.unique_barcodes"], 3)  # The low quality read is rejected
+            self.assertEqual(snapshot["counters"]["clustering.graph_edges"], 1)
+            self.assertEqual(snapshot["counters"]["clustering.groups"], 2)
+            self.assertEqual(snapshot["maxima"]["clustering.largest_group"], 2)
+            self.assertEqual(snapshot["timings"]["clustering"]["calls"], 1)
+
+    def test_sampling_profiler(self):
+        with SamplingProfiler(interval=0.001) as profiler:
+            busy_wait(0.2)
+        self.assertTrue(any("busy_wait" in stack for stack in profiler.stacks))
+        with tempfile.TemporaryDirectory() as directory:
+            output_file = os.path.join(directory, "samples.txt")
+            self.assertEqual(profiler.write_collapsed(output_file), sum(profiler.stacks.values()))
+            with open(output_file) as f:
+                stack, samples = f.readline().rsplit(" ", 1)
+            self.assertGreater(int(samples), 0)
+
+    def test_profiler_samples_worker_processes(self):
+        """
+        Tasks run through collect_metrics in worker processes return their call stacks to the profiler of the parent.
+        """
+        with SamplingProfiler(interval=0.001) as profiler:
+            with Pool(2) as pool:
+                merge_task_results(pool.starmap(collect_metrics, [(busy_wait, 0.2)] * 2))
+        worker_stacks = [stack for stack in profiler.stacks if "busy_wait" in stack]
+        self.assertTrue(worker_stacks)
+        self.assertTrue(all("collect_metrics" in stack for stack in worker_stacks))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,273 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing mapseq_barcode_analysis.py.
+
+'''
+This test suite checks the clustering of barcodes into groups of similar barcodes against a brute-force reference
+built from all pairwise Hamming distances on small synthetic barcode sets.
+'''
+import random
+import unittest
+from itertools import combinations
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+import numpy as np
+from barcode_encoding import decode_barcodes, encode_barcodes, pairwise_hamming_distances
+from barcode_encoding import hamming_distance as packed_hamming_distance
+from barcode_io import PackedBarcodeCounts
+from neighbor_search import BarcodeNeighborIndex, sharded_neighbor_pairs
+from union_find import DisjointSet
+
+def hamming_distance(s1, s2):
+    """
+    Calculates the Hamming distance between two strings of equal length.
+    """
+    return sum(c1 != c2 for c1, c2 in zip(s1, s2))
+
+def mutate(barcode, num_mutations, rng):
+    """
+    Returns a copy of the barcode with the given number of random substitutions.
+    """
+    bases = list(barcode)
+    for position in rng.sample(range(len(bases)), num_mutations):
+        bases[position] = rng.choice([base for base in "ACGT" if base != bases[position]])
+    return "".join(bases)
+
+def synthetic_barcodes(num_true_barcodes, num_variants, max_mutations, seed=0):
+    """
+    Generates true barcodes plus randomly mutated variants of each of them.
+    """
+    rng = random.Random(seed)
+    barcodes = []
+    for _ in range(num_true_barcodes):
+        true_barcode = "".join(rng.choice("ACGT") for _ in range(30))
+        barcodes.append(true_barcode)
+        for _ in range(num_variants):
+            barcodes.append(mutate(true_barcode, rng.randint(1, max_mutations), rng))
+    rng.shuffle(barcodes)
+    return barcodes
+
+def brute_force_pairs(barcodes, max_hamming_distance):
+    return {(i, j) for i, j in combinations(range(len(barcodes)), 2)
+            if hamming_distance(barcodes[i], barcodes[j]) <= max_hamming_distance}
+
+class TestNeighborSearch(unittest.TestCase):
+
+    def test_neighbor_pairs_match_brute_force(self):
+        """
+        The pigeonhole index finds exactly the pairs within the maximum Hamming distance.
+        """
+        for max_hamming_distance in (0, 1, 2, 3):
+            barcodes = list(dict.fromkeys(synthetic_barcodes(20, 5, 4, seed=max_hamming_distance)))
+            index = BarcodeNeighborIndex(barcodes, max_hamming_distance)
+            pairs = [tuple(pair) for pair in index.neighbor_pairs().tolist()]
+            self.assertEqual(len(pairs), len(set(pairs)))
+            self.assertEqual(set(pairs), brute_force_pairs(barcodes, max_hamming_distance))
+
+    def test_string_fallback_matches_brute_force(self):
+        """
+        Barcodes that cannot be packed (here containing 'N' or of another length) are indexed as strings, the others
+        stay packed, and pairs across both are still found.
+        """
+        barcodes = list(dict.fromkeys(synthetic_barcodes(20, 5, 3, seed=7)))
+        barcodes[0] = "N" + barcodes[0][1:]
+        barcodes.append(barcodes[1][:-1] + "N")
+        barcodes.append(barcodes[2][:10] + "NN" + barcodes[2][12:])
+        barcodes.append(barcodes[3][:-1])
+        barcodes = list(dict.fromkeys(barcodes))
+        index = BarcodeNeighborIndex(barcodes, 2)
+        self.assertEqual(len(index.packed), len(barcodes) - 4)
+        pairs = {tuple(pair) for pair in index.neighbor_pairs().tolist()}
+        self.assertEqual(pairs, {(i, j) for i, j in brute_force_pairs(barcodes, 2) if len(barcodes[i]) == len(barcodes[j])})
+        for query in (barcodes[0], barcodes[1], barcodes[-2], barcodes[-1]):
+            expected = [i for i, barcode in enumerate(barcodes)
+                        if len(barcode) == len(query) and hamming_distance(query, barcode) <= 2]
+            self.assertEqual(index.query(query), expected)
+
+    def test_sharded_pairs_match_brute_force(self):
+        """
+        Sharding the barcodes by segment keys across worker processes finds the same pairs as a single process.
+        """
+        for max_hamming_distance in (1, 2):
+            barcodes = list(dict.fromkeys(synthetic_barcodes(30, 5, 3, seed=10 + max_hamming_distance)))
+            packed, barcode_length = encode_barcodes(barcodes)
+            pairs = sharded_neighbor_pairs(packed, barcode_length, max_hamming_distance, num_processes=2, shards_per_process=3)
+            self.assertEqual([tuple(pair) for pair in pairs.tolist()], sorted(brute_force_pairs(barcodes, max_hamming_distance)))
+
+    def test_sharded_index_with_unpackable_barcode(self):
+        """
+        A barcode that cannot be packed does not disable sharding, and finding pairs of packed barcodes does not sort
+        the query index.
+        """
+        barcodes = list(dict.fromkeys(synthetic_barcodes(20, 5, 3, seed=12)))
+        index = BarcodeNeighborIndex(barcodes, 2)
+        index.neighbor_pairs(num_processes=2)
+        self.assertIsNone(index.sorted_segment_keys)
+        barcodes.append(barcodes[0][:-1] + "N")
+        index = BarcodeNeighborIndex(barcodes, 2)
+        pairs = {tuple(pair) for pair in index.neighbor_pairs(num_processes=2).tolist()}
+        self.assertEqual(pairs, brute_force_pairs(barcodes, 2))
+        self.assertEqual(len(index.packed), len(barcodes) - 1)
+
+    def test_query(self):
+        barcodes = list(dict.fromkeys(synthetic_barcodes(10, 5, 2)))
+        index = BarcodeNeighborIndex(barcodes, 2)
+        query = mutate(barcodes[0], 1, random.Random(1))
+        expected = [i for i, barcode in enumerate(barcodes) if hamming_distance(query, barcode) <= 2]
+        self.assertEqual(index.query(query), expected)
+
+class TestBarcodeEncoding(unittest.TestCase):
+
+    def test_round_trip_and_distances(self):
+        """
+        Packing and unpacking is lossless, packed order is alphabetical, and packed distances match string distances.
+        """
+        barcodes = synthetic_barcodes(10, 5, 4, seed=8)
+        packed, barcode_length = encode_barcodes(barcodes)
+        self.assertEqual(packed.dtype, np.uint64)
+        self.assertEqual(decode_barcodes(packed, barcode_length), barcodes)
+        self.assertEqual(decode_barcodes(np.sort(packed), barcode_length), sorted(barcodes))
+
+        expected = np.array([[hamming_distance(b1, b2) for b2 in barcodes] for b1 in barcodes])
+        np.testing.assert_array_equal(pairwise_hamming_distances(packed, packed, block_size=7), expected)
+        np.testing.assert_array_equal(packed_hamming_distance(packed[0], packed), expected[0])
+
+    def test_invalid_barcodes(self):
+        with self.assertRaises(ValueError):
+            encode_barcodes(["ACGN"])
+        with self.assertRaises(ValueError):
+            encode_barcodes(["ACG", "ACGT"])
+
+class TestDisjointSet(unittest.TestCase):
+
+    def test_long_chain_without_recursion(self):
+        """
+        A single component far deeper than the recursion limit is labelled without errors.
+        """
+        size = 10 * sys.getrecursionlimit()
+        components = DisjointSet(size)
+        components.union_pairs(zip(range(size - 1), range(1, size)))
+        self.assertTrue((components.labels() == 0).all())
+
+    def test_union_arrays_matches_union_pairs(self):
+        rng = np.random.default_rng(0)
+        pairs = rng.integers(0, 2000, size=(1500, 2))
+        components, vectorized = DisjointSet(2000), DisjointSet(2000)
+        components.union_pairs(pairs)
+        vectorized.union_arrays(pairs[:, 0], pairs[:, 1])
+        np.testing.assert_array_equal(vectorized.labels(), components.labels())
+
+        chain = DisjointSet(5000)
+        order = rng.permutation(5000)
+        chain.union_arrays(order[:-1], order[1:])
+        self.assertTrue((chain.labels() == 0).all())
+
+    def test_labels_in_order_of_first_element(self):
+        components = DisjointSet(6)
+        components.union_pairs([(4, 5), (1, 3), (3, 5)])
+        self.assertEqual(components.labels().tolist(), [0, 1, 2, 1, 1, 1])
+
+class TestMAPseqBarcodeAnalysis(unittest.TestCase):
+
+    def setUp(self):
+        self.analysis = MAPseqBarcodeAnalysis("input", "output")
+
+    def test_hamming_distance(self):
+        barcodes = list(dict.fromkeys(synthetic_barcodes(3, 3, 3, seed=5)))
+        for barcode1 in barcodes:
+            for barcode2 in barcodes:
+                self.assertEqual(self.analysis.hamming_distance(barcode1, barcode2), hamming_distance(barcode1, barcode2))
+        self.assertEqual(self.analysis.hamming_distance("ACGN", "ACGT"), 1)
+        self.assertEqual(self.analysis.hamming_distance("ACGT", "ACG"), 0)
+
+    def test_groups_are_connected_components(self):
+        """
+        Every unique barcode ends up in exactly one group, and groups are the connected components of the similarity graph.
+        """
+        barcodes = synthetic_barcodes(15, 4, 2, seed=3)
+        groups = self.analysis.group_similar_barcodes(barcodes + barcodes[:10], max_hamming_distance=1)
+
+        grouped = [barcode for group in groups for barcode in group]
+        self.assertEqual(sorted(grouped), sorted(set(barcodes)))
+
+        group_of = {barcode: i for i, group in enumerate(groups) for barcode in group}
+        for barcode1, barcode2 in combinations(set(barcodes), 2):
+            if hamming_distance(barcode1, barcode2) <= 1:
+                self.assertEqual(group_of[barcode1], group_of[barcode2])
+
+    def test_most_abundant_barcode_is_chosen(self):
+        """
+        The representative of each group is its most abundant barcode, whether reads or a count table are given.
+        """
+        rng = random.Random(4)
+        true_barcode = "".join(rng.choice("ACGT") for _ in range(30))
+        errors = [mutate(true_barcode, 1, rng) for _ in range(5)]
+        reads = errors + [true_barcode] * 20 + errors[:2]
+
+        self.assertEqual(self.analysis.get_true_underlying_barcodes(reads), [true_barcode])
+
+        unique_barcodes, counts = self.analysis.collapse_barcode_counts(reads)
+        self.assertEqual(counts.sum(), len(reads))
+        self.assertEqual(self.analysis.get_true_underlying_barcodes(unique_barcodes, counts), [true_barcode])
+        self.assertEqual(self.analysis.get_true_underlying_barcodes({true_barcode: 3, errors[0]: 7}), [errors[0]])
+
+    def test_directional_does_not_chain_abundant_barcodes(self):
+        """
+        Two abundant barcodes linked through an intermediate form one group with 'cluster' but stay separate with
+        'directional', while their low-count errors are still absorbed.
+        """
+        rng = random.Random(5)
+        barcode_a = "".join(rng.choice("ACGT") for _ in range(30))
+        intermediate = mutate(barcode_a, 1, rng)
+        barcode_b = mutate(intermediate, 1, rng)
+        while barcode_b == barcode_a:
+            barcode_b = mutate(intermediate, 1, rng)
+        error_a = mutate(barcode_a, 1, rng)
+        while error_a in (intermediate, barcode_b):
+            error_a = mutate(barcode_a, 1, rng)
+        barcode_counts = {barcode_a: 100, intermediate: 60, barcode_b: 90, error_a: 2}
+
+        self.assertEqual(self.analysis.get_true_underlying_barcodes(barcode_counts), [barcode_a])
+
+        true_barcodes = self.analysis.get_true_underlying_barcodes(barcode_counts, clustering_method='directional')
+        self.assertEqual(true_barcodes, [barcode_a, barcode_b, intermediate])
+
+        groups = self.analysis.group_barcodes_directional(list(barcode_counts), list(barcode_counts.values()))
+        self.assertIn(error_a, groups[0])
+
+        with self.assertRaises(ValueError):
+            self.analysis.get_true_underlying_barcodes(barcode_counts, clustering_method='unknown')
+
+    def test_parallel_clustering(self):
+        """
+        Clustering with worker processes gives the same true barcodes as clustering in one process.
+        """
+        rng = random.Random(6)
+        barcodes = synthetic_barcodes(40, 4, 2, seed=6)
+        barcode_counts = {barcode: rng.randint(1, 100) for barcode in barcodes}
+        parallel_analysis = MAPseqBarcodeAnalysis("input", "output", num_processes=2, min_parallel_barcodes=0)
+        for clustering_method in ('cluster', 'directional'):
+            for max_hamming_distance in (1, 2):
+                self.assertEqual(
+                    parallel_analysis.get_true_underlying_barcodes(barcode_counts, max_hamming_distance=max_hamming_distance, clustering_method=clustering_method),
+                    self.analysis.get_true_underlying_barcodes(barcode_counts, max_hamming_distance=max_hamming_distance, clustering_method=clustering_method))
+    def test_packed_barcode_counts(self):
+        """
+        Clustering packed barcode counts, including barcodes that cannot be packed, assigns every barcode to the same
+        true barcode as clustering the barcode strings.
+        """
+        rng = random.Random(7)
+        barcodes = synthetic_barcodes(20, 3, 1, seed=7)
+        barcode_counts = {barcode: rng.randint(1, 10) for barcode in barcodes}
+        barcode_counts.update({barcodes[0][:-1] + "N": 3, barcodes[1][:-1] + "N": 1})
+        packed_counts = PackedBarcodeCounts.from_dict(barcode_counts)
+        self.assertEqual(len(packed_counts.other_barcodes), 2)
+        for clustering_method in ('cluster', 'directional'):
+            unique_barcodes, labels, true_barcodes = self.analysis.cluster_barcodes(barcode_counts, clustering_method=clustering_method)
+            packed_barcodes, packed_labels, packed_true_barcodes = self.analysis.cluster_barcodes(packed_counts, clustering_method=clustering_method)
+            self.assertIs(packed_barcodes, packed_counts)
+            self.assertEqual(sorted(packed_true_barcodes), sorted(true_barcodes))
+            self.assertEqual({barcode: packed_true_barcodes[label] for barcode, label in zip(packed_counts.barcodes(), packed_labels)},
+                             {barcode: true_barcodes[label] for barcode, label in zip(unique_barcodes, labels)})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing pipeline_scheduler.py.
+
+'''
+This test suite checks that pipeline stages overlap, that their queues stay bounded and that failed items do not stop
+the others, and runs the overlapped download -> convert -> extract retrieval with a stand-in downloader.
+'''
+import random
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from contextlib import nullcontext
+from fastq_data_parsing import BarcodeExtractor
+from main import run_overlapped_retrieval
+from pipeline_scheduler import PipelineStage, run_pipelined_stages
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+class TestRunPipelinedStages(unittest.TestCase):
+
+    def test_stages_overlap(self):
+        """
+        Three stages of 0.1 s per item take about (items + stages - 1) * 0.1 s instead of items * stages * 0.1 s.
+        """
+        def stage(value):
+            time.sleep(0.1)
+            return value + 1
+        stages = [PipelineStage(name, stage, 1) for name in ("first", "second", "third")]
+        start = time.perf_counter()
+        results, failures = run_pipelined_stages(range(6), stages)
+        elapsed = time.perf_counter() - start
+        self.assertEqual(sorted(results), [3, 4, 5, 6, 7, 8])
+        self.assertEqual(failures, [])
+        self.assertLess(elapsed, 1.4)  # 1.8 s when run phase by phase
+
+    def test_bounded_queues_and_failures(self):
+        in_flight = Counter()
+        max_in_flight = [0]
+        lock = threading.Lock()
+
+        def produce(value):
+            if value == 3:
+                raise IOError("download failed")
+            with lock:
+                in_flight["produced"] += 1
+                max_in_flight[0] = max(max_in_flight[0], in_flight["produced"])
+            return value
+
+        def consume(value):
+            time.sleep(0.02)
+            with lock:
+                in_flight["produced"] -= 1
+            return value * 10
+
+        stages = [PipelineStage("Produce", produce, 4), PipelineStage("Consume", consume, 1)]
+        results, failures = run_pipelined_stages(range(20), stages, queue_size=2)
+        self.assertEqual(sorted(results), [value * 10 for value in range(20) if value != 3])
+        self.assertEqual([(item, stage) for item, stage, _ in failures], [(3, "Produce")])
+        # Waiting in the queue, blocked on a full queue, or being consumed
+        self.assertLessEqual(max_in_flight[0], 2 + 4 + 1)
+
+class StandInDownloader:
+    """
+    Downloads and converts accessions by writing the FASTQ file of each accession to the input directory.
+    """
+    def __init__(self, records_by_accession):
+        self.records_by_accession = records_by_accession
+        self.accession_ids = []
+
+    def search_mapseq_data(self):
+        self.accession_ids = sorted(self.records_by_accession)
+
+    def create_session(self):
+        return nullcontext()
+
+    def download_sra_file(self, sra_id, output_dir, session):
+        if sra_id == "SRR000003":
+            raise IOError("Incomplete or corrupt download")
+        return os.path.join(output_dir, f"{sra_id}.sra")
+
+    def convert_sra_file(self, sra_path, output_dir):
+        sra_id = os.path.splitext(os.path.basename(sra_path))[0]
+        fastq_path = os.path.join(output_dir, f"{sra_id}.fastq")
+        with open(fastq_path, "w") as f:
+            for i, sequence in enumerate(self.records_by_accession[sra_id]):
+                f.write(f"@read{i}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+        return fastq_path
+
+class TestOverlappedRetrieval(unittest.TestCase):
+
+    def test_overlapped_retrieval(self):
+        rng = random.Random(0)
+        barcodes = ["".join(rng.choices("ACGT", k=30)) for _ in range(10)]
+        records_by_accession = {f"SRR00000{i}": [barcode + ANCHOR_SEQUENCE for barcode in barcodes[i:i + 4]] for i in range(5)}
+        expected = Counter(barcode for i in (0, 1, 2, 4) for barcode in barcodes[i:i + 4])  # SRR000003 fails to download
+
+        with tempfile.TemporaryDirectory() as directory:
+            input_directory = os.path.join(directory, "input")
+            output_directory = os.path.join(directory, "output")
+            for streaming in (False, True):
+                barcode_extractor = BarcodeExtractor(input_directory, output_directory, ANCHOR_SEQUENCE, streaming=streaming, num_processes=2)
+                extracted_barcodes = run_overlapped_retrieval(StandInDownloader(records_by_accession), barcode_extractor, input_directory,
+                                                              {"download": 2, "convert": 2, "extract": 2})
+                self.assertEqual(extracted_barcodes.to_counter(), expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,123 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) #Points to the directory containing projection_matrix.py.
+
+'''
+This test suite checks that the projection matrix maps every sample's barcodes onto the true barcode of their group,
+survives a save and load, and is written by run_pipeline from the per-sample count tables.
+'''
+import random
+import tempfile
+import unittest
+from collections import Counter
+import numpy as np
+from barcode_io import write_barcode_counts, write_barcode_table
+from main import run_pipeline
+from mapseq_barcode_analysis import MAPseqBarcodeAnalysis
+from projection_matrix import BarcodeLookup, ProjectionMatrix, ProjectionMatrixBuilder
+
+ANCHOR_SEQUENCE = "GTACTGCGGCCGCTACCTA"
+
+def random_barcode(rng):
+    return "".join(rng.choices("ACGT", k=30))
+
+def with_error(barcode, rng):
+    position = rng.randrange(len(barcode))
+    return barcode[:position] + rng.choice([base for base in "ACGT" if base != barcode[position]]) + barcode[position + 1:]
+
+class TestProjectionMatrix(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.true_barcodes = [random_barcode(rng) for _ in range(5)]
+        self.errors = {barcode: with_error(barcode, rng) for barcode in self.true_barcodes}
+        # Per sample: read counts of true barcodes and of their errors
+        self.samples = {
+            "area1": {self.true_barcodes[0]: 50, self.errors[self.true_barcodes[0]]: 2, self.true_barcodes[1]: 7},
+            "area2": {self.true_barcodes[1]: 30, self.errors[self.true_barcodes[1]]: 1, self.true_barcodes[2]: 4},
+            "area3": {self.true_barcodes[3]: 9, self.true_barcodes[4]: 12, "ACGTN" * 6: 3},
+        }
+        total_counts = Counter()
+        for barcode_counts in self.samples.values():
+            total_counts.update(barcode_counts)
+        self.unique_barcodes, self.labels, self.clustered_true_barcodes = MAPseqBarcodeAnalysis(None, None).cluster_barcodes(total_counts)
+
+    def expected_row(self, true_barcode):
+        return [sum(count for barcode, count in self.samples[sample].items() if barcode in (true_barcode, self.errors[true_barcode]))
+                for sample in sorted(self.samples)]
+
+    def test_lookup(self):
+        lookup = BarcodeLookup(["ACGT", "TTTT", "ACNT"], [3, 5, 7], barcode_length=4)
+        np.testing.assert_array_equal(lookup.lookup(["TTTT", "ACNT", "GGGG", "ACGT", "AC"]), [5, 7, -1, 3, -1])
+
+    def test_build_save_and_load(self):
+        builder = ProjectionMatrixBuilder(self.unique_barcodes, self.labels, self.clustered_true_barcodes)
+        with tempfile.TemporaryDirectory() as directory:
+            for sample in sorted(self.samples):
+                barcode_counts = self.samples[sample]
+                if sample == "area2":
+                    # Binary barcode tables are looked up by their packed barcodes
+                    table_file = os.path.join(directory, f"{sample}_barcodes.npy")
+                    write_barcode_table(table_file, list(barcode_counts), list(barcode_counts.values()))
+                    self.assertEqual(builder.add_sample_file(table_file), sample)
+                else:
+                    counts_file = os.path.join(directory, f"{sample}_barcode_counts.tsv")
+                    write_barcode_counts(counts_file, barcode_counts)
+                    self.assertEqual(builder.add_sample_file(counts_file), sample)
+            barcode_list_file = os.path.join(directory, "area1_barcodes.txt")
+            with open(barcode_list_file, "w") as f:
+                f.write("\n".join(self.samples["area1"]) + "\n")
+            with self.assertRaises(ValueError):
+                builder.add_sample_file(barcode_list_file)  # Barcode lists hold no read counts
+            builder.add_sample("unrelated", [random_barcode(random.Random(1))], [5])
+            self.assertEqual(builder.unassigned["unrelated"], 5)
+
+            matrix = builder.build()
+            self.assertEqual(matrix.shape, (len(self.clustered_true_barcodes), 4))
+            for true_barcode in self.true_barcodes:
+                self.assertEqual(matrix.row(true_barcode)[:3].tolist(), self.expected_row(true_barcode))
+            self.assertTrue(np.all(np.diff(matrix.indices[matrix.indptr[0]:matrix.indptr[1]]) > 0))
+
+            matrix_file = os.path.join(directory, "projection_matrix.npz")
+            matrix.save(matrix_file)
+            loaded = ProjectionMatrix.load(matrix_file)
+            self.assertEqual(loaded.barcodes, matrix.barcodes)
+            self.assertEqual(loaded.samples, ["area1", "area2", "area3", "unrelated"])
+            np.testing.assert_array_equal(loaded.to_dense(), matrix.to_dense())
+            try:
+                np.testing.assert_array_equal(loaded.to_scipy().toarray(), matrix.to_dense())
+            except ImportError:
+                pass  # SciPy is optional
+
+    def test_run_pipeline_writes_projection_matrix(self):
+        """
+        Every extraction mode fills the matrix with read counts, and only the samples of the run become columns, even
+        when the output directory holds true_barcodes.txt and the outputs of an earlier run.
+        """
+        rng = random.Random(2)
+        with tempfile.TemporaryDirectory() as directory:
+            input_directory = os.path.join(directory, "input")
+            output_directory = os.path.join(directory, "output")
+            os.makedirs(input_directory)
+            for sample, barcode_counts in self.samples.items():
+                reads = [barcode for barcode, count in barcode_counts.items() if "N" not in barcode for _ in range(count)]
+                rng.shuffle(reads)
+                with open(os.path.join(input_directory, f"{sample}.fastq"), "w") as f:
+                    for i, barcode in enumerate(reads):
+                        sequence = barcode + ANCHOR_SEQUENCE
+                        f.write(f"@read{i}\n{sequence}\n+\n{'I' * len(sequence)}\n")
+
+            os.makedirs(output_directory)
+            with open(os.path.join(output_directory, "stale_barcode_counts.tsv"), "w") as f:
+                f.write(f"{self.true_barcodes[0]}\t100\n")
+            for streaming_extraction in (False, True, False):
+                run_pipeline(None, None, input_directory, output_directory, user_provided_data=input_directory,
+                             streaming_extraction=streaming_extraction, num_processes=2)
+                matrix = ProjectionMatrix.load(os.path.join(output_directory, "projection_matrix.npz"))
+                self.assertEqual(matrix.samples, sorted(self.samples))
+                self.assertEqual(sorted(matrix.barcodes), sorted(self.true_barcodes))
+                for true_barcode in self.true_barcodes:
+                    self.assertEqual(matrix.row(true_barcode).tolist(), self.expected_row(true_barcode))
+
+if __name__ == "__main__":
+    unittest.main()
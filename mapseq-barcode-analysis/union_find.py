@@ -0,0 +1,144 @@
+"""
+THIS SCRIPT PROVIDES AN INTEGER-INDEXED DISJOINT-SET (UNION-FIND) STRUCTURE FOR GROUPING BARCODES INTO CONNECTED COMPONENTS.
+
+The parent and rank arrays are NumPy arrays of fixed size, so grouping millions of barcodes needs no recursion
+and no per-barcode Python objects.
+"""
+
+import numpy as np
+
+
+class DisjointSet:
+    """
+    This class implements union by rank and path compression over a NumPy parent array.
+    """
+
+    def __init__(self, size):
+        """
+        Initialize the structure with every element in its own set.
+
+        :param size: int, number of elements
+        """
+        self.parent = np.arange(size, dtype=np.int64)
+        self.rank = np.zeros(size, dtype=np.int8)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def extend(self, num_elements):
+        """
+        Add elements, each in its own set. The arrays grow geometrically, so adding n elements costs O(n) amortized.
+
+        :param num_elements: int, number of elements to add
+        :return: np.ndarray of int64, indices of the new elements
+        """
+        size = len(self.parent)
+        if self.parent.base is None or size + num_elements > len(self.parent.base):
+            capacity = max(2 * size, size + num_elements, 16)
+            parent = np.empty(capacity, dtype=np.int64)
+            rank = np.empty(capacity, dtype=np.int8)
+            parent[:size] = self.parent
+            rank[:size] = self.rank
+        else:
+            parent, rank = self.parent.base, self.rank.base
+        self.parent = parent[:size + num_elements]
+        self.rank = rank[:size + num_elements]
+        self.parent[size:] = np.arange(size, size + num_elements)
+        self.rank[size:] = 0
+        return np.arange(size, size + num_elements, dtype=np.int64)
+
+    def find(self, element):
+        """
+        Find the root of the set containing an element, compressing the path to it.
+
+        :param element: int, element index
+        :return: int, index of the root element
+        """
+        parent = self.parent
+        root = int(element)
+        while parent[root] != root:
+            root = int(parent[root])
+        while parent[element] != root:
+            parent[element], element = root, int(parent[element])
+        return root
+
+    def union(self, element1, element2):
+        """
+        Merge the sets containing two elements.
+
+        :param element1: int, first element index
+        :param element2: int, second element index
+        :return: bool, True if the elements were in different sets
+        """
+        root1, root2 = self.find(element1), self.find(element2)
+        if root1 == root2:
+            return False
+        if self.rank[root1] < self.rank[root2]:
+            root1, root2 = root2, root1
+        self.parent[root2] = root1
+        if self.rank[root1] == self.rank[root2]:
+            self.rank[root1] += 1
+        return True
+
+    def union_pairs(self, pairs):
+        """
+        Merge the sets of every pair of elements.
+
+        :param pairs: iterable of (int, int), or np.ndarray of shape (n, 2), element index pairs
+        """
+        if isinstance(pairs, np.ndarray):
+            pairs = pairs.tolist()
+        for element1, element2 in pairs:
+            self.union(element1, element2)
+
+    def union_arrays(self, first, second):
+        """
+        Merge the sets of every pair of elements, with whole-array operations instead of one union per pair.
+        In each round every root of a pair hooks under the smallest root it is paired with, and the paths are
+        compressed by pointer jumping. Every round merges at least one set into another for each group of sets that
+        still needs merging, so the loop ends, but the number of rounds depends on how the indices are arranged.
+
+        :param first: np.ndarray of int, first element of each pair
+        :param second: np.ndarray of int, second element of each pair
+        """
+        first = np.asarray(first, dtype=np.int64)
+        second = np.asarray(second, dtype=np.int64)
+        while len(first):
+            roots = self.roots()
+            roots1, roots2 = roots[first], roots[second]
+            different = roots1 != roots2
+            if not different.any():
+                break
+            first, second = first[different], second[different]
+            roots1, roots2 = roots1[different], roots2[different]
+            # A root only ever hooks under a smaller root, so no cycles are formed
+            np.minimum.at(self.parent, np.maximum(roots1, roots2), np.minimum(roots1, roots2))
+
+    def roots(self):
+        """
+        Compute the root of every element at once by pointer jumping on the parent array.
+
+        :return: np.ndarray of int64, root index of each element
+        """
+        roots = self.parent.copy()
+        while True:
+            next_roots = roots[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        self.parent[:] = roots
+        return roots
+
+    def labels(self):
+        """
+        Compute a component label for every element. Labels are numbered 0, 1, 2, ... in order of the first
+        element of each component.
+
+        :return: np.ndarray of int64, component label of each element
+        """
+        if len(self.parent) == 0:
+            return np.zeros(0, dtype=np.int64)
+        _, first_elements, inverse = np.unique(self.roots(), return_index=True, return_inverse=True)
+        relabel = np.empty(len(first_elements), dtype=np.int64)
+        relabel[np.argsort(first_elements)] = np.arange(len(first_elements))
+        return relabel[inverse.reshape(-1)]